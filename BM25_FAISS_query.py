@@ -1,37 +1,17 @@
 import os
-from langchain_community.document_loaders import PyPDFLoader
-
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import GPT4AllEmbeddings
+from chunk_store import load_chunk_store
+from bm25_index import load_bm25_index
+from hybrid import HybridRetriever
+from indexer import list_pdfs, sync_index
+from model_registry import get_embeddings
 from langchain_community.vectorstores import FAISS
-from langchain_community.retrievers import BM25Retriever
 
 
-embeddings = GPT4AllEmbeddings(model_file="models/vinallama-7b-chat_q5_0.gguf")
+embeddings = get_embeddings()
 
 def load_pdf_data():
-    pdf_path = "data\working.pdf"
-    loader = PyPDFLoader(pdf_path)
-    docs = loader.load()
-    
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=512,
-        chunk_overlap=50,
-        length_function=len,
-        add_start_index=True
-    )
-    all_splits = text_splitter.split_documents(docs)
-    
-    bm25_retriever = BM25Retriever.from_documents(all_splits)
-    bm25_retriever.k = 5 
-
-    vector_store = FAISS.from_documents(
-        all_splits, 
-        embeddings,
-        distance_strategy="METRIC_INNER_PRODUCT"
-    )
-    vector_store.save_local("vectorstores/db_faiss")
-
+    # Đồng bộ index với thư mục data/: chỉ embed chunk mới hoặc thay đổi
+    bm25_retriever, _, _ = sync_index(embeddings)
     return bm25_retriever
 
 def print_results(results, query):
@@ -44,32 +24,6 @@ def print_results(results, query):
     if not results:
         print("❌ Không tìm thấy kết quả phù hợp.")
 
-def hybrid_search(query, bm25_retriever, vector_store):
-    """
-    Hybrid search sử dụng cả BM25 và FAISS để tìm kiếm kết quả tốt nhất.
-    """
-    # Lấy kết quả từ cả hai phương pháp
-    bm25_docs = bm25_retriever.get_relevant_documents(query)[:5]  
-    faiss_docs = vector_store.similarity_search(query, k=5)  
-    
-    # Kết hợp kết quả theo tỷ lệ 50-50
-    seen_content = set()
-    final_docs = []
-    
-    # Xen kẽ kết quả từ cả hai nguồn
-    for i in range(max(len(bm25_docs), len(faiss_docs))):
-        if i < len(bm25_docs):
-            if bm25_docs[i].page_content not in seen_content:
-                seen_content.add(bm25_docs[i].page_content)
-                final_docs.append(bm25_docs[i])
-                
-        if i < len(faiss_docs):
-            if faiss_docs[i].page_content not in seen_content:
-                seen_content.add(faiss_docs[i].page_content)
-                final_docs.append(faiss_docs[i])
-    
-    return final_docs[:5]
-
 def preprocess_query(query):
     query = query.lower().strip()
     
@@ -87,6 +41,7 @@ def preprocess_query(query):
     return variations
 
 def enhanced_test_search(bm25_retriever, vector_store):
+    retriever = HybridRetriever(bm25_retriever, vector_store)
     while True:
         query = input("\nNhập câu hỏi của bạn (hoặc 'exit' để thoát): ").strip()
         if query.lower() == "exit":
@@ -95,31 +50,16 @@ def enhanced_test_search(bm25_retriever, vector_store):
             
         query_variations = preprocess_query(query)
         
-        all_results = []
-        for q in query_variations:
-            results = hybrid_search(q, bm25_retriever, vector_store)
-            all_results.extend(results)
-        
-        unique_results = list({doc.page_content: doc for doc in all_results}.values())
-        print_results(unique_results[:5], query)
+        # Các biến thể được embed và tìm kiếm trong một lượt, biến thể trùng bị bỏ qua
+        results = retriever.search_many(query_variations)
+        print_results([doc for doc, _ in results], query)
 
 if __name__ == "__main__":
-    if not os.path.exists("faiss_index"):
+    if not os.path.exists("vectorstores/db_faiss"):
         bm25_retriever = load_pdf_data()
     else:
-        pdf_path = "data\working.pdf"
-        loader = PyPDFLoader(pdf_path)
-        docs = loader.load()
-
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=512,
-            chunk_overlap=50,
-            length_function=len,
-            add_start_index=True
-        )
-        all_splits = text_splitter.split_documents(docs)
-        bm25_retriever = BM25Retriever.from_documents(all_splits)
-        bm25_retriever.k = 5
+        store = load_chunk_store(list_pdfs())
+        bm25_retriever = load_bm25_index(store)
 
     vector_store = FAISS.load_local("vectorstores/db_faiss", embeddings, allow_dangerous_deserialization=True)
 
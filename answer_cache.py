@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import faiss
+import numpy as np
+
+# Cau hinh
+ANSWER_CACHE_PATH = "vectorstores/answer_cache"
+
+
+class AnswerCache:
+    """Cache câu trả lời hai tầng: khớp chính xác (LRU) và khớp ngữ nghĩa (FAISS trên câu hỏi cũ)"""
+
+    def __init__(self,
+                 max_entries: int = 1000,
+                 ttl: float = 24 * 3600,
+                 semantic_threshold: float = 0.92,
+                 path: Optional[str] = None,
+                 version: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.semantic_threshold = semantic_threshold
+        self.path = path
+        self.version = version
+        self._lock = threading.Lock()
+
+        # Tầng 1: câu hỏi đã chuẩn hóa -> (câu trả lời, thời điểm tạo)
+        self._exact: "OrderedDict[str, tuple]" = OrderedDict()
+        # Tầng 2: id -> (câu hỏi, câu trả lời, thời điểm tạo, vector), thứ tự LRU
+        self._semantic: "OrderedDict[int, tuple]" = OrderedDict()
+        # Câu hỏi đã chuẩn hóa -> id trong tầng 2, để put lại cùng câu hỏi thay mục cũ thay vì thêm bản trùng
+        self._semantic_ids: Dict[str, int] = {}
+        self._index = None
+        self._next_id = 0
+
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0}
+
+        if path:
+            self.load()
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def clear(self) -> None:
+        with self._lock:
+            self._exact.clear()
+            self._semantic.clear()
+            self._semantic_ids.clear()
+            self._index = None
+
+    def set_version(self, version: str) -> None:
+        """Đổi phiên bản index/kho chunk: các câu trả lời cũ không còn đúng nên bị xóa"""
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    @staticmethod
+    def _as_unit_vector(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1).copy()
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _remove_semantic(self, entry_id: int) -> None:
+        entry = self._semantic.pop(entry_id, None)
+        if entry is not None and self._semantic_ids.get(entry[0]) == entry_id:
+            del self._semantic_ids[entry[0]]
+        if self._index is not None:
+            self._index.remove_ids(np.array([entry_id], dtype=np.int64))
+
+    def get_exact(self, key: str) -> Optional[str]:
+        """Tầng 1: tra theo câu hỏi đã chuẩn hóa (không tính miss, để tầng 2 quyết định)"""
+        with self._lock:
+            entry = self._exact.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry[1]):
+                del self._exact[key]
+                return None
+            self._exact.move_to_end(key)
+            self.stats["exact_hits"] += 1
+            return entry[0]
+
+    def get_semantic(self, vector) -> Optional[str]:
+        """Tầng 2: tìm câu hỏi cũ gần nhất theo cosine, trả lời nếu vượt ngưỡng"""
+        with self._lock:
+            if vector is not None and self._index is not None and self._index.ntotal:
+                scores, ids = self._index.search(self._as_unit_vector(vector), 1)
+                entry_id = int(ids[0][0])
+                if entry_id != -1 and scores[0][0] >= self.semantic_threshold:
+                    entry = self._semantic[entry_id]
+                    if self._expired(entry[2]):
+                        self._remove_semantic(entry_id)
+                    else:
+                        self._semantic.move_to_end(entry_id)
+                        self.stats["semantic_hits"] += 1
+                        return entry[1]
+
+            self.stats["misses"] += 1
+            return None
+
+    def get(self, key: str, vector=None) -> Optional[str]:
+        """Tra cache: thử khớp chính xác trước, sau đó khớp ngữ nghĩa"""
+        answer = self.get_exact(key)
+        if answer is not None:
+            return answer
+        return self.get_semantic(vector)
+
+    def put(self, key: str, answer: str, vector=None) -> None:
+        """Lưu câu trả lời, loại bỏ mục cũ nhất khi vượt giới hạn"""
+        now = time.time()
+        with self._lock:
+            self._exact[key] = (answer, now)
+            self._exact.move_to_end(key)
+            while len(self._exact) > self.max_entries:
+                self._exact.popitem(last=False)
+                self.stats["evictions"] += 1
+
+            if vector is not None:
+                self._add_semantic(key, answer, now, self._as_unit_vector(vector))
+
+    def _add_semantic(self, key: str, answer: str, created_at: float, unit: np.ndarray) -> None:
+        if key in self._semantic_ids:
+            self._remove_semantic(self._semantic_ids[key])
+        if self._index is None:
+            self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(unit.shape[1]))
+        entry_id = self._next_id
+        self._next_id += 1
+        self._index.add_with_ids(unit, np.array([entry_id], dtype=np.int64))
+        self._semantic[entry_id] = (key, answer, created_at, unit[0])
+        self._semantic_ids[key] = entry_id
+        while len(self._semantic) > self.max_entries:
+            self._remove_semantic(next(iter(self._semantic)))
+            self.stats["evictions"] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self.stats["exact_hits"] + self.stats["semantic_hits"] + self.stats["misses"]
+            hits = self.stats["exact_hits"] + self.stats["semantic_hits"]
+            return {
+                **self.stats,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "exact_size": len(self._exact),
+                "semantic_size": len(self._semantic),
+            }
+
+    def save(self) -> None:
+        """Ghi cache xuống đĩa (nếu được cấu hình đường dẫn)
+
+        Vector ghi trước vào file riêng của lần lưu, answers.json (trỏ tới file đó) thay sau cùng bằng
+        os.replace: bị ngắt giữa chừng hay có người đọc cùng lúc thì JSON và vector vẫn khớp nhau.
+        """
+        if not self.path:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock:
+            semantic = list(self._semantic.values())
+            vectors_file = f"vectors-{time.time_ns()}-{os.getpid()}.npy"
+            data = {
+                "version": self.version,
+                "vectors": vectors_file,
+                "exact": [[key, answer, created_at] for key, (answer, created_at) in self._exact.items()],
+                "semantic": [[key, answer, created_at] for key, answer, created_at, _ in semantic],
+            }
+            vectors = np.stack([vector for *_, vector in semantic]) if semantic else np.zeros((0, 0), np.float32)
+        tmp_suffix = f".{os.getpid()}.tmp"
+        vectors_path = os.path.join(self.path, vectors_file)
+        with open(vectors_path + tmp_suffix, "wb") as f:
+            np.save(f, vectors)
+        os.replace(vectors_path + tmp_suffix, vectors_path)
+        answers_path = os.path.join(self.path, "answers.json")
+        with open(answers_path + tmp_suffix, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(answers_path + tmp_suffix, answers_path)
+        # File vector của các lần lưu trước không còn được JSON nào trỏ tới
+        for name in os.listdir(self.path):
+            if name.endswith(".npy") and name.startswith("vectors") and name != vectors_file:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+
+    def load(self) -> None:
+        """Đọc cache đã lưu, bỏ qua mục đã hết hạn"""
+        answers_path = os.path.join(self.path, "answers.json")
+        if not os.path.exists(answers_path):
+            return
+        with open(answers_path, encoding="utf-8") as f:
+            data = json.load(f)
+        if self.version and data.get("version") != self.version:
+            return
+        self.version = data.get("version", "")
+        try:
+            vectors = np.load(os.path.join(self.path, data.get("vectors", "vectors.npy")))
+        except FileNotFoundError:
+            # Tiến trình khác vừa lưu đè: bỏ tầng ngữ nghĩa thay vì ghép JSON với vector của lần lưu khác
+            vectors = np.zeros((0, 0), np.float32)
+
+        for key, answer, created_at in data["exact"]:
+            if not self._expired(created_at):
+                self._exact[key] = (answer, created_at)
+        if len(vectors) != len(data["semantic"]):
+            return
+        for (key, answer, created_at), vector in zip(data["semantic"], vectors):
+            # Giữ thời điểm tạo gốc để TTL vẫn đúng sau khi khởi động lại
+            if not self._expired(created_at):
+                self._add_semantic(key, answer, created_at, self._as_unit_vector(vector))
@@ -0,0 +1,56 @@
+import random
+import time
+
+from langchain_community.retrievers import BM25Retriever
+from langchain_core.documents import Document
+
+from bm25_index import BM25Index
+
+# Âm tiết tiếng Việt để sinh corpus giả lập
+SYLLABLES = (
+    "nhân viên công ty nghỉ phép lương thưởng hợp đồng bảo hiểm thời gian làm việc quy định "
+    "trách nhiệm quyền lợi đào tạo đánh giá kỷ luật chế độ phúc lợi tăng ca chấm công "
+    "phòng ban quản lý dự án báo cáo tài liệu quy trình hồ sơ thủ tục văn phòng khách hàng"
+).split()
+
+
+def make_corpus(n_chunks: int, words_per_chunk: int = 80, seed: int = 42):
+    rng = random.Random(seed)
+    # Phân phối Zipf gần đúng: một số từ xuất hiện rất nhiều, đa số hiếm
+    vocab = SYLLABLES + [f"từ{i}" for i in range(5000)]
+    weights = [1.0 / (rank + 1) for rank in range(len(vocab))]
+    return [" ".join(rng.choices(vocab, weights, k=words_per_chunk)) for _ in range(n_chunks)]
+
+
+def make_queries(n: int = 50, seed: int = 7):
+    rng = random.Random(seed)
+    return [" ".join(rng.sample(SYLLABLES, 4)) for _ in range(n)]
+
+
+def time_queries(search, queries):
+    start = time.perf_counter()
+    for query in queries:
+        search(query)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+if __name__ == "__main__":
+    queries = make_queries()
+    print(f"{'chunks':>8} | {'build cũ':>9} | {'build mới':>9} | {'query cũ':>10} | {'query mới':>10} | tăng tốc")
+    for n_chunks in (1_000, 10_000, 100_000):
+        texts = make_corpus(n_chunks)
+        docs = [Document(page_content=text) for text in texts]
+
+        start = time.perf_counter()
+        retriever = BM25Retriever.from_documents(docs)
+        retriever.k = 5
+        old_build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = BM25Index.from_documents(docs)
+        new_build = time.perf_counter() - start
+
+        old_ms = time_queries(lambda q: retriever.get_relevant_documents(q)[:5], queries)
+        new_ms = time_queries(index.get_relevant_documents, queries)
+        print(f"{n_chunks:>8} | {old_build:>8.2f}s | {new_build:>8.2f}s | "
+              f"{old_ms:>8.2f}ms | {new_ms:>8.2f}ms | {old_ms / new_ms:.0f}x")
@@ -0,0 +1,58 @@
+import re
+import time
+
+from pattern_manager import PatternManager
+from smart_ans import preprocess_query
+
+# Bộ câu hỏi mẫu: chitchat, tài liệu và câu hỏi chung
+SAMPLE_QUERIES = [
+    "Xin chào, bạn khỏe không?",
+    "Bây giờ là mấy giờ rồi?",
+    "Hôm nay là thứ mấy?",
+    "Cảm ơn bạn rất nhiều nhé",
+    "Quy trình xin nghỉ phép gồm các bước nào?",
+    "Giải thích khái niệm thời gian làm việc linh hoạt là gì?",
+    "So sánh chế độ bảo hiểm của nhân viên chính thức và thử việc",
+    "Tôi có thể làm gì để bảo vệ môi trường?",
+    "Bạn thích màu gì nhất?",
+    "Liệt kê các nguồn tham khảo trong tài liệu",
+]
+
+
+def legacy_scan(pm: PatternManager, query: str):
+    """Cách cũ: tạo PatternManager mới và search từng pattern riêng lẻ"""
+    pm = PatternManager()
+    chitchat = [intent for intent, pattern in pm.chitchat_patterns.items() if re.search(pattern, query)]
+    doc = [intent for intent, pattern in pm.doc_patterns.items() if re.search(pattern, query)]
+    return chitchat, doc
+
+
+def engine_scan(pm: PatternManager, query: str):
+    """Cách mới: bộ nhận diện biên dịch sẵn, quét một lần"""
+    match = pm.match(query)
+    return match.chitchat_intents, match.doc_intents
+
+
+def run(fn, pm, queries, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for query in queries:
+            fn(pm, query)
+    elapsed = time.perf_counter() - start
+    return elapsed / (rounds * len(queries)) * 1e6
+
+
+if __name__ == "__main__":
+    pm = PatternManager()
+    queries = [preprocess_query(q) for q in SAMPLE_QUERIES]
+
+    # Kiểm tra hai cách cho cùng kết quả
+    for query in queries:
+        assert legacy_scan(pm, query) == engine_scan(pm, query), query
+
+    rounds = 2000
+    legacy_us = run(legacy_scan, pm, queries, rounds)
+    engine_us = run(engine_scan, pm, queries, rounds)
+    print(f"Cách cũ (PatternManager + re.search từng pattern): {legacy_us:.1f} µs/câu")
+    print(f"IntentEngine (quét một lần):                      {engine_us:.1f} µs/câu")
+    print(f"Nhanh hơn: {legacy_us / engine_us:.1f}x")
@@ -0,0 +1,52 @@
+import argparse
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from quantized_store import QuantizedVectorStore
+
+
+def make_vectors(n: int, dim: int, n_topics: int = 200, seed: int = 42) -> np.ndarray:
+    """Vector giả lập có cấu trúc cụm giống embedding của các chunk cùng chủ đề"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_topics, dim)).astype(np.float32)
+    topics = rng.integers(0, n_topics, size=n)
+    return centers[topics] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+
+
+def recall_at_k(found, truth, k: int = 5) -> float:
+    return np.mean([len(set(f[:k]) & set(t[:k])) / k for f, t in zip(found, truth)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="So sánh recall@5 và bộ nhớ: FAISS flat vs int8/nhị phân + rerank")
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 50_000])
+    args = parser.parse_args()
+
+    print(f"{'chunks':>8} | {'chế độ':>7} | {'recall@5':>8} | {'ms/query':>8} | {'RAM lọc (MB)':>12}")
+    for n in args.sizes:
+        vectors = make_vectors(n + args.queries, args.dim)
+        queries, vectors = vectors[:args.queries], vectors[args.queries:]
+
+        flat = faiss.IndexFlatL2(args.dim)
+        flat.add(vectors)
+        start = time.perf_counter()
+        _, truth = flat.search(queries, 5)
+        flat_ms = (time.perf_counter() - start) / len(queries) * 1000
+        print(f"{n:>8} | {'flat':>7} | {1.0:>8.3f} | {flat_ms:>8.2f} | {vectors.nbytes / 2 ** 20:>12.1f}")
+
+        for mode in ("int8", "binary"):
+            with tempfile.TemporaryDirectory() as path:
+                # Lưu rồi mở lại để vector float32 thật sự nằm trong file mmap
+                QuantizedVectorStore.from_vectors(vectors, mode).save(path)
+                store = QuantizedVectorStore.load(path)
+                start = time.perf_counter()
+                found = [store.search(query, 5)[0] for query in queries]
+                ms = (time.perf_counter() - start) / len(queries) * 1000
+                memory = store.memory_bytes()["codes"] / 2 ** 20
+                print(f"{n:>8} | {mode:>7} | {recall_at_k(found, truth):>8.3f} | {ms:>8.2f} | {memory:>12.1f}")
+                del store
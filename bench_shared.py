@@ -0,0 +1,107 @@
+import argparse
+import multiprocessing as mp
+import os
+import tempfile
+import time
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from bench_bm25 import make_corpus, make_queries
+from bm25_index import BM25Index
+from chunk_store import ChunkStore
+from generations import current_path
+from shared_index import SharedVectorStore, open_shared_index, store_signature
+
+
+class FixedEmbeddings:
+    """Embedding giả: chỉ cần model_id cho chữ ký index"""
+    model_id = "bench"
+
+
+def memory_mb() -> dict:
+    """RSS, PSS (phần chia đều của trang dùng chung) và bộ nhớ riêng của tiến trình"""
+    values = {}
+    with open("/proc/self/smaps_rollup", encoding="utf-8") as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:", "Private_Clean:", "Private_Dirty:"):
+                values[parts[0][:-1]] = int(parts[1]) / 1024
+    return {"rss": values["Rss"], "pss": values["Pss"],
+            "private": values["Private_Clean"] + values["Private_Dirty"]}
+
+
+def build(path: str, n_chunks: int, dim: int) -> None:
+    texts = make_corpus(n_chunks)
+    docs = [Document(page_content=text, metadata={"source": "bench.pdf", "page": i // 4, "start_index": 0})
+            for i, text in enumerate(texts)]
+    store = ChunkStore.save(os.path.join(path, "chunks"), docs,
+                            {"bench.pdf": {"size": 0, "mtime": 0, "sha256": ""}}, {})
+    BM25Index.from_documents(docs).save(os.path.join(path, "bm25"), store.signature())
+    index = faiss.IndexFlatL2(dim)
+    index.add(np.random.default_rng(0).normal(size=(n_chunks, dim)).astype(np.float32))
+    SharedVectorStore.save(index, os.path.join(path, "faiss"),
+                           signature=store_signature(store, FixedEmbeddings(), os.path.join(path, "db")))
+
+
+def worker(path: str, mode: str, dim: int, barrier, results) -> None:
+    base = memory_mb()
+    start = time.perf_counter()
+    if mode == "mmap":
+        bm25, vector_store = open_shared_index(
+            FixedEmbeddings(), os.path.join(path, "chunks"), os.path.join(path, "bm25"),
+            os.path.join(path, "faiss"), os.path.join(path, "db"))
+        index = vector_store.index
+        docs = bm25.docs
+    else:
+        # Cách cũ: mỗi worker đọc hết index vào RAM và giữ danh sách Document riêng
+        store = ChunkStore.load(os.path.join(path, "chunks"))
+        docs = store.documents()
+        bm25 = BM25Index.load(os.path.join(path, "bm25"), docs=docs)
+        bm25 = BM25Index(list(bm25.terms), np.array(bm25.indptr), np.array(bm25.doc_ids),
+                         np.array(bm25.weights), bm25.n_docs, docs, params=bm25.params)
+        index = faiss.read_index(os.path.join(current_path(os.path.join(path, "faiss")), "index.faiss"))
+    load_s = time.perf_counter() - start
+
+    rng = np.random.default_rng(os.getpid())
+    for query in make_queries(20):
+        ids, _ = bm25.search(query, 5)
+        _, found = index.search(rng.normal(size=(1, dim)).astype(np.float32), 5)
+        [docs[int(i)].page_content for i in list(ids) + list(found[0])]
+
+    # Đo khi tất cả worker đều đang giữ index
+    barrier.wait()
+    used = memory_mb()
+    results.put({"load_s": load_s, **{key: used[key] - base[key] for key in used}})
+    barrier.wait()
+
+
+def run(path: str, mode: str, n_workers: int, dim: int) -> dict:
+    ctx = mp.get_context("spawn")
+    barrier = ctx.Barrier(n_workers)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=worker, args=(path, mode, dim, barrier, results)) for _ in range(n_workers)]
+    for process in processes:
+        process.start()
+    rows = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return {key: float(np.mean([row[key] for row in rows])) for key in rows[0]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bộ nhớ mỗi worker: index mmap dùng chung vs mỗi worker một bản")
+    parser.add_argument("--chunks", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        build(path, args.chunks, args.dim)
+        print(f"{'chế độ':>6} | {'workers':>7} | {'load (ms)':>9} | {'RSS (MB)':>8} | {'PSS (MB)':>8} | {'riêng (MB)':>10}")
+        for mode in ("copy", "mmap"):
+            for n_workers in args.workers:
+                row = run(path, mode, n_workers, args.dim)
+                print(f"{mode:>6} | {n_workers:>7} | {row['load_s'] * 1000:>9.1f} | {row['rss']:>8.1f} | "
+                      f"{row['pss']:>8.1f} | {row['private']:>10.1f}")
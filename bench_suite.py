@@ -0,0 +1,304 @@
+import argparse
+import hashlib
+import json
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+import smart_ans
+from answer_cache import AnswerCache
+from bench_bm25 import SYLLABLES, make_corpus
+from bm25_index import BM25Index
+from chunk_store import SPLITTER_CONFIG, ChunkStore, assign_chunk_ids
+from model_registry import get_rss_mb
+from tracing import tracer
+from utils import hybrid_retriever_with_scores
+
+# Cau hinh
+EMBED_DIM = 256
+PROMPT_MS_PER_TOKEN = 0.2
+TOKEN_MS = 5.0
+ANSWER_TOKENS = 32
+RSS_SAMPLE_S = 0.002
+REGRESSION_THRESHOLD = 0.10
+# Chênh lệch tuyệt đối nhỏ hơn mức này là nhiễu đo, không tính là regression
+MIN_REGRESSION_MS = 0.1
+
+CHITCHAT_QUERIES = [
+    "Xin chào, bạn khỏe không?",
+    "Bây giờ là mấy giờ rồi?",
+    "Hôm nay là thứ mấy?",
+    "Cảm ơn bạn rất nhiều nhé",
+    "Tạm biệt, hẹn gặp lại",
+]
+DOCUMENT_TEMPLATES = [
+    "Quy định về {a} và {b} là gì?",
+    "Giải thích {a} {b} trong tài liệu",
+    "Liệt kê các bước {a} {b}",
+    "Tại sao cần {a} {b}?",
+    "So sánh {a} với {b}",
+]
+GENERAL_QUERIES = [
+    "Kể cho tôi một câu chuyện cười",
+    "Tôi muốn học lập trình Python",
+    "Cuối tuần này đi chơi đâu",
+    "Bạn có thích âm nhạc không",
+]
+
+
+class HashEmbeddings(Embeddings):
+    """Embedding giả, tất định: băm từng từ vào một chiều (feature hashing) rồi chuẩn hóa
+
+    Hai đoạn chung nhiều từ cho vector gần nhau nên kết quả FAISS vẫn có nghĩa.
+    """
+
+    def __init__(self, dim: int = EMBED_DIM):
+        self.dim = dim
+        self.model_id = f"hash-{dim}"
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            vector[value % self.dim] += 1.0 if value >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class FakeLlamaCpp:
+    """Thay LlamaCpp khi bench: độ trễ cố định theo số token prompt và số token sinh ra"""
+
+    def __init__(self, prompt_ms_per_token: float = PROMPT_MS_PER_TOKEN, token_ms: float = TOKEN_MS,
+                 answer_tokens: int = ANSWER_TOKENS):
+        self.prompt_ms_per_token = prompt_ms_per_token
+        self.token_ms = token_ms
+        self.answer_tokens = answer_tokens
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def stream(self, prompt: str, **kwargs):
+        time.sleep(self.get_num_tokens(prompt) * self.prompt_ms_per_token / 1000)
+        rng = random.Random(prompt)
+        for _ in range(self.answer_tokens):
+            time.sleep(self.token_ms / 1000)
+            yield rng.choice(SYLLABLES) + " "
+
+    def invoke(self, prompt: str, **kwargs) -> str:
+        return "".join(self.stream(prompt))
+
+
+def make_workload(n_queries: int, mix: Dict[str, float], seed: int = 7) -> List[tuple]:
+    """Danh sách (loại, câu hỏi) theo tỉ lệ `mix`, câu hỏi tài liệu không trùng nhau"""
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=n_queries)
+    workload = []
+    for kind in kinds:
+        if kind == "chitchat":
+            query = rng.choice(CHITCHAT_QUERIES)
+        elif kind == "document":
+            a, b = rng.sample(SYLLABLES, 2)
+            query = rng.choice(DOCUMENT_TEMPLATES).format(a=a, b=f"{b} {rng.choice(SYLLABLES)}")
+        else:
+            query = rng.choice(GENERAL_QUERIES)
+        workload.append((kind, query))
+    return workload
+
+
+class RssSampler:
+    """Lấy mẫu RSS trên thread nền trong lúc một giai đoạn chạy để biết đỉnh bộ nhớ"""
+
+    def __init__(self, interval: float = RSS_SAMPLE_S):
+        self.interval = interval
+        self.start_mb = self.peak_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, get_rss_mb())
+
+    def __enter__(self):
+        self.start_mb = self.peak_mb = get_rss_mb()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_mb = max(self.peak_mb, get_rss_mb())
+        return False
+
+
+def summarize(samples: List[float], wall_s: float, rss: Optional[RssSampler] = None) -> dict:
+    ms = np.array(samples) * 1000
+    return {"n": len(samples), "mean_ms": float(ms.mean()),
+            "p50_ms": float(np.percentile(ms, 50)), "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "throughput_per_s": len(samples) / wall_s if wall_s > 0 else 0.0,
+            "peak_rss_mb": rss.peak_mb if rss else None,
+            "rss_delta_mb": rss.peak_mb - rss.start_mb if rss else None}
+
+
+def timed_stage(name: str, items, fn, results: dict) -> list:
+    outputs, samples = [], []
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        for item in items:
+            t = time.perf_counter()
+            outputs.append(fn(item))
+            samples.append(time.perf_counter() - t)
+        wall = time.perf_counter() - start
+    results[name] = summarize(samples, wall, rss)
+    return outputs
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run_suite(n_chunks: int, n_queries: int, mix: Dict[str, float], seed: int = 42) -> dict:
+    results: Dict[str, dict] = {}
+    texts = make_corpus(n_chunks, seed=seed)
+    docs = [Document(page_content=text, metadata={"source": "bench.pdf", "page": i // 4})
+            for i, text in enumerate(texts)]
+    embeddings = HashEmbeddings()
+
+    # Dựng index như indexer.py (kho chunk mmap + BM25 trên kho): một lần đo, throughput tính theo chunk
+    store_dir = tempfile.mkdtemp(prefix="bench_suite_")
+    store = timed_stage("build_chunk_store", [docs], lambda d: ChunkStore.save(
+        store_dir, d, {"bench.pdf": {}}, SPLITTER_CONFIG), results)[0]
+    bm25 = timed_stage("build_bm25", [store], lambda s: BM25Index.from_texts(
+        [s.text(i) for i in range(len(s))], docs=s), results)[0]
+    vector_store = timed_stage("build_faiss", [docs], lambda d: FAISS.from_embeddings(
+        list(zip(texts, embeddings.embed_documents(texts))), embeddings, [doc.metadata for doc in d],
+        ids=assign_chunk_ids(d)), results)[0]
+    for stage in ("build_chunk_store", "build_bm25", "build_faiss"):
+        results[stage]["throughput_per_s"] = n_chunks / (results[stage]["mean_ms"] / 1000)
+
+    workload = make_workload(n_queries, mix)
+    timed_stage("classify_query", [query for _, query in workload], smart_ans.classify_query, results)
+    document_queries = [query for kind, query in workload if kind == "document"]
+    if document_queries:
+        timed_stage("hybrid_retriever", document_queries,
+                    lambda q: hybrid_retriever_with_scores(q, bm25, vector_store), results)
+
+    # smart_response đầu-cuối với LLM giả; cache câu trả lời mới, chỉ trong RAM
+    llm = FakeLlamaCpp()
+    smart_ans.get_llm = lambda *args, **kwargs: llm
+    smart_ans.answer_cache = AnswerCache()
+    spans: Dict[str, List[float]] = defaultdict(list)
+    tracer.listeners.append(lambda trace: [spans[span["name"]].append(span["duration_ms"] / 1000)
+                                           for span in trace.spans])
+    try:
+        for kind in mix:
+            queries = [query for k, query in workload if k == kind]
+            if queries:
+                timed_stage(f"smart_response/{kind}", queries,
+                            lambda q: smart_ans.smart_response(q, bm25, vector_store), results)
+    finally:
+        tracer.listeners.pop()
+        shutil.rmtree(store_dir, ignore_errors=True)
+    # Phân rã theo span của tracing.py (không đo RSS riêng từng span)
+    for name, samples in spans.items():
+        results[f"span/{name}"] = summarize(samples, sum(samples))
+
+    return {"meta": {"commit": git_commit(), "python": sys.version.split()[0], "platform": platform.platform(),
+                     "chunks": n_chunks, "queries": n_queries, "mix": mix, "seed": seed,
+                     "embed_dim": EMBED_DIM, "token_ms": TOKEN_MS, "created_at": time.time()},
+            "stages": results}
+
+
+def print_results(run: dict) -> None:
+    print(f"{'giai đoạn':<28} | {'n':>5} | {'p50 (ms)':>9} | {'p95 (ms)':>9} | {'p99 (ms)':>9} | "
+          f"{'/s':>9} | {'RSS đỉnh (MB)':>13}")
+    for name, row in run["stages"].items():
+        rss = f"{row['peak_rss_mb']:>13.1f}" if row["peak_rss_mb"] is not None else f"{'-':>13}"
+        print(f"{name:<28} | {row['n']:>5} | {row['p50_ms']:>9.2f} | {row['p95_ms']:>9.2f} | "
+              f"{row['p99_ms']:>9.2f} | {row['throughput_per_s']:>9.1f} | {rss}")
+
+
+def compare(base: dict, new: dict, threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """In chênh lệch p50/p95/p99 giữa hai lần chạy, trả về các giai đoạn bị chậm hơn quá ngưỡng"""
+    print(f"So sánh {base['meta'].get('commit') or 'base'} -> {new['meta'].get('commit') or 'new'} "
+          f"(ngưỡng {threshold:.0%})")
+    for key in ("chunks", "queries", "mix", "seed"):
+        if base["meta"].get(key) != new["meta"].get(key):
+            print(f"⚠️ Cấu hình khác nhau ({key}): {base['meta'].get(key)} vs {new['meta'].get(key)}")
+    print(f"{'giai đoạn':<28} | {'p50':>17} | {'p95':>17} | {'p99':>17}")
+    regressions = []
+    for name, old in base["stages"].items():
+        row = new["stages"].get(name)
+        if row is None:
+            continue
+        cells, slower = [], False
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            change = (row[metric] - old[metric]) / old[metric] if old[metric] > 0 else 0.0
+            slower |= (metric != "p99_ms" and change > threshold
+                       and row[metric] - old[metric] > MIN_REGRESSION_MS)
+            cells.append(f"{row[metric]:>8.2f} ({change:+5.0%})")
+        if slower:
+            regressions.append(name)
+        print(f"{name:<28} | {' | '.join(cells)}{'  ⚠️ chậm hơn' if slower else ''}")
+    return regressions
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark offline cho pipeline RAG với embedding và LLM giả")
+    parser.add_argument("--chunks", type=int, default=5_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--mix", type=parse_mix, default="chitchat=0.3,document=0.5,general=0.2",
+                        help="Tỉ lệ loại câu hỏi, ví dụ chitchat=0.3,document=0.5,general=0.2")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="Lưu kết quả ra file JSON để so sánh về sau")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="So sánh hai file kết quả")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="Tỉ lệ chậm hơn (p50/p95) bị coi là regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        runs = []
+        for path in args.compare:
+            with open(path, encoding="utf-8") as f:
+                runs.append(json.load(f))
+        regressions = compare(*runs, threshold=args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    result = run_suite(args.chunks, args.queries, args.mix, args.seed)
+    print_results(result)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"💾 Đã lưu kết quả vào {args.out}")
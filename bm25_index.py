@@ -0,0 +1,271 @@
+import json
+import os
+from collections import Counter
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from chunk_store import ChunkStore
+from generations import commit_generation, current_path, new_generation
+
+# Cau hinh
+BM25_INDEX_PATH = "vectorstores/bm25_index"
+INDEX_VERSION = 2
+
+
+def default_tokenize(text: str) -> List[str]:
+    """Tách từ giống BM25Retriever mặc định của LangChain"""
+    return text.split()
+
+
+class TermVocabulary:
+    """Từ điển đã sắp theo byte UTF-8: một buffer + mảng offsets đọc bằng mmap, tra bằng tìm kiếm nhị phân
+
+    Thay cho dict {từ: id} để các worker mở cùng index không phải giải mã và giữ riêng một bản từ điển.
+    """
+
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _bytes(self, i: int) -> bytes:
+        return bytes(self.buffer[self.offsets[i]:self.offsets[i + 1]])
+
+    def index(self, term: str) -> int:
+        key = term.encode("utf-8")
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if self._bytes(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low if low < len(self) and self._bytes(low) == key else -1
+
+    def __contains__(self, term: str) -> bool:
+        return self.index(term) != -1
+
+    def get(self, term: str, default=None):
+        i = self.index(term)
+        return default if i == -1 else i
+
+    def __getitem__(self, term: str) -> int:
+        i = self.index(term)
+        if i == -1:
+            raise KeyError(term)
+        return i
+
+    def __iter__(self):
+        return (self._bytes(i).decode("utf-8") for i in range(len(self)))
+
+    @staticmethod
+    def save(terms: Sequence[str], path: str) -> None:
+        """Ghi từ điển vào `path`: thư mục thế hệ mới do BM25Index.save tạo, chưa ai mmap"""
+        encoded = [term.encode("utf-8") for term in terms]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(data) for data in encoded], dtype=np.int64)
+        with open(os.path.join(path, "terms.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+        np.save(os.path.join(path, "term_offsets.npy"), offsets)
+
+    @classmethod
+    def load(cls, path: str) -> "TermVocabulary":
+        terms_path = os.path.join(path, "terms.bin")
+        if os.path.getsize(terms_path) > 0:
+            buffer = np.memmap(terms_path, dtype=np.uint8, mode="r")
+        else:
+            buffer = np.zeros(0, dtype=np.uint8)
+        return cls(buffer, np.load(os.path.join(path, "term_offsets.npy"), mmap_mode="r"))
+
+
+class BM25Index:
+    """BM25 dùng inverted index: ma trận trọng số BM25 dạng CSR theo từ (term x chunk)"""
+
+    def __init__(self, terms: Sequence[str], indptr, doc_ids, weights, n_docs: int,
+                 docs: Optional[Sequence[Document]] = None,
+                 tokenize: Callable[[str], List[str]] = default_tokenize,
+                 params: Optional[dict] = None):
+        self.terms = terms
+        if isinstance(terms, TermVocabulary):
+            self.vocab = terms
+        else:
+            self.vocab = {term: i for i, term in enumerate(terms)}
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.n_docs = n_docs
+        self.docs = docs
+        self.tokenize = tokenize
+        self.params = params or {}
+        self.k = 5
+
+    @classmethod
+    def from_texts(cls, texts: Sequence[str], docs: Optional[Sequence[Document]] = None,
+                   k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25,
+                   tokenize: Callable[[str], List[str]] = default_tokenize) -> "BM25Index":
+        """Tính sẵn trọng số BM25 (cùng công thức BM25Okapi) cho mọi cặp (từ, chunk)"""
+        vocab = {}
+        rows, cols, tfs = [], [], []
+        doc_lens = np.zeros(len(texts), dtype=np.float32)
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lens[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                rows.append(vocab.setdefault(term, len(vocab)))
+                cols.append(doc_id)
+                tfs.append(tf)
+
+        n_docs = len(texts)
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int32)
+        tfs = np.asarray(tfs, dtype=np.float32)
+        avgdl = float(doc_lens.mean()) if n_docs else 0.0
+
+        # IDF giống rank_bm25: idf âm được thay bằng epsilon * idf trung bình
+        df = np.bincount(rows, minlength=len(vocab)).astype(np.float64)
+        idf = np.log(n_docs - df + 0.5) - np.log(df + 0.5)
+        if len(idf):
+            idf[idf < 0] = epsilon * idf.mean()
+
+        norm = k1 * (1 - b + b * doc_lens[cols] / avgdl) if avgdl else np.full(len(cols), k1, dtype=np.float32)
+        weights = (idf[rows] * tfs * (k1 + 1) / (tfs + norm)).astype(np.float32)
+
+        # Đánh số lại từ theo thứ tự byte UTF-8 để lưu được thành TermVocabulary
+        terms = sorted(vocab, key=lambda term: term.encode("utf-8"))
+        rank = np.empty(len(vocab), dtype=np.int64)
+        rank[[vocab[term] for term in terms]] = np.arange(len(terms))
+        rows = rank[rows]
+
+        # Sắp theo từ để có posting list liền mạch cho mỗi từ
+        order = np.argsort(rows, kind="stable")
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(vocab)))
+
+        params = {"k1": k1, "b": b, "epsilon": epsilon, "avgdl": avgdl}
+        return cls(terms, indptr, cols[order], weights[order], n_docs, docs, tokenize, params)
+
+    @classmethod
+    def from_documents(cls, documents: Sequence[Document], **kwargs) -> "BM25Index":
+        return cls.from_texts([doc.page_content for doc in documents], docs=documents, **kwargs)
+
+    def _term_counts(self, query: str) -> Counter:
+        """Số lần xuất hiện của các từ có trong từ điển, theo id từ (mỗi từ chỉ tra một lần)"""
+        counts = Counter()
+        for term, count in Counter(self.tokenize(query)).items():
+            term_id = self.vocab.get(term)
+            if term_id is not None:
+                counts[term_id] = count
+        return counts
+
+    def search(self, query: str, k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Trả về (chunk ids, điểm) của top-k chunk"""
+        k = k or self.k
+        counts = self._term_counts(query)
+        if not counts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        # Nhân vector truy vấn thưa với ma trận CSR: gom posting list của các từ rồi cộng dồn
+        segments = [(self.indptr[term_id], self.indptr[term_id + 1], count)
+                    for term_id, count in counts.items()]
+        ids = np.concatenate([self.doc_ids[start:end] for start, end, _ in segments])
+        weights = np.concatenate([self.weights[start:end] * count for start, end, count in segments])
+        scores = np.bincount(ids, weights=weights, minlength=self.n_docs)
+
+        # Chọn top-k bằng argpartition rồi chỉ sắp xếp k phần tử
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            top = np.argpartition(-scores[candidates], k - 1)[:k]
+            candidates = candidates[top]
+        order = np.argsort(-scores[candidates], kind="stable")
+        top_ids = candidates[order]
+        return top_ids, scores[top_ids]
+
+    def search_many(self, queries: Sequence[str], k: Optional[int] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Chấm điểm nhiều câu truy vấn trong một lượt: mỗi posting list chỉ được đọc một lần"""
+        k = k or self.k
+        counts = [self._term_counts(query) for query in queries]
+        term_ids = sorted({term_id for count in counts for term_id in count})
+        if not term_ids:
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in queries]
+
+        postings = {term_id: (self.doc_ids[self.indptr[term_id]:self.indptr[term_id + 1]],
+                              self.weights[self.indptr[term_id]:self.indptr[term_id + 1]])
+                    for term_id in term_ids}
+        # Ma trận điểm (số truy vấn x số chunk) được cộng dồn bằng một lần bincount
+        flat_ids, flat_weights = [], []
+        for row, count in enumerate(counts):
+            for term_id, times in count.items():
+                ids, weights = postings[term_id]
+                flat_ids.append(ids.astype(np.int64) + row * self.n_docs)
+                flat_weights.append(weights * times)
+        scores = np.bincount(
+            np.concatenate(flat_ids),
+            weights=np.concatenate(flat_weights),
+            minlength=len(queries) * self.n_docs
+        ).reshape(len(queries), self.n_docs)
+
+        results = []
+        for row in scores:
+            candidates = np.flatnonzero(row)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-row[candidates], k - 1)[:k]]
+            top_ids = candidates[np.argsort(-row[candidates], kind="stable")]
+            results.append((top_ids, row[top_ids]))
+        return results
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        """Giữ nguyên giao diện của BM25Retriever để dùng thay thế trực tiếp"""
+        ids, _ = self.search(query)
+        return [self.docs[i] for i in ids]
+
+    def invoke(self, query: str) -> List[Document]:
+        return self.get_relevant_documents(query)
+
+    def save(self, path: str = BM25_INDEX_PATH, signature: str = "") -> None:
+        """Lưu index vào một thế hệ mới (không ghi đè file worker đang mmap), các mảng được đọc lại bằng mmap"""
+        gen_path = new_generation(path)
+        np.save(os.path.join(gen_path, "indptr.npy"), self.indptr)
+        np.save(os.path.join(gen_path, "doc_ids.npy"), self.doc_ids)
+        np.save(os.path.join(gen_path, "weights.npy"), self.weights)
+        TermVocabulary.save(list(self.terms), gen_path)
+        meta = {"version": INDEX_VERSION, "n_docs": self.n_docs, "params": self.params, "signature": signature}
+        with open(os.path.join(gen_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        commit_generation(path, gen_path)
+
+    @classmethod
+    def load(cls, path: str = BM25_INDEX_PATH, docs: Optional[Sequence[Document]] = None,
+             signature: Optional[str] = None) -> Optional["BM25Index"]:
+        """Mở index đã lưu (mọi mảng và từ điển đều mmap), trả về None nếu chưa có hoặc không khớp với kho chunk"""
+        path = current_path(path)
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION:
+            return None
+        if signature is not None and meta.get("signature") != signature:
+            return None
+        return cls(
+            TermVocabulary.load(path),
+            np.load(os.path.join(path, "indptr.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "doc_ids.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "weights.npy"), mmap_mode="r"),
+            meta["n_docs"], docs, params=meta["params"]
+        )
+
+
+def load_bm25_index(store: ChunkStore, path: str = BM25_INDEX_PATH) -> BM25Index:
+    """Mở BM25 index của kho chunk, tự dựng lại khi kho chunk thay đổi"""
+    signature = store.signature()
+    index = BM25Index.load(path, docs=store, signature=signature)
+    if index is None:
+        texts = [store.text(i) for i in range(len(store))]
+        index = BM25Index.from_texts(texts, docs=store)
+        index.save(path, signature)
+    return index
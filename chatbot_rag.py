@@ -1,40 +1,148 @@
-from utils import initialize_retrievers
-from smart_ans import smart_response
+import argparse
+import sys
+
+from startup import StartupReport, Warmup
+
+# Chỉ import module nhẹ lúc khởi động: langchain, FAISS, LlamaCpp, GPT4All được import trong load_pipeline
+startup = StartupReport()
+with startup.step("import", "pattern_manager"):
+    from pattern_manager import PatternManager
+
+# PatternManager riêng để trả lời chitchat khi pipeline chưa load xong (cùng pattern với smart_ans)
+with startup.step("load", "PatternManager"):
+    pattern_manager = PatternManager()
 
 # Khởi tạo retrievers một lần
 bm25_retriever, vector_store = None, None
 
-def initialize():
+def load_pipeline():
+    """Import các module nặng rồi load index và LLM (chạy trên thread nền khi khởi động nhanh)"""
     global bm25_retriever, vector_store
-    bm25_retriever, vector_store = initialize_retrievers()
+    with startup.step("import", "model_registry (LlamaCpp, GPT4All)"):
+        import model_registry
+    with startup.step("import", "utils (FAISS, BM25, kho chunk)"):
+        import utils
+    with startup.step("import", "smart_ans (prompt, cache)"):
+        import smart_ans
+    with startup.step("import", "indexer"):
+        import indexer
+    with startup.step("load", "retrievers"):
+        bm25_retriever, vector_store = utils.initialize_retrievers()
+        # initialize_retrievers trả (None, None) khi lỗi: báo lỗi để warm-up không bị coi là xong,
+        # câu hỏi sau sẽ load lại
+        if bm25_retriever is None or vector_store is None:
+            raise RuntimeError("Không khởi tạo được retrievers")
+    # Câu trả lời đã cache và id chunk trong phiên chỉ còn đúng khi kho chunk và index không đổi
+    with startup.step("load", "phiên bản index"):
+        version = indexer.index_version()
+        smart_ans.answer_cache.set_version(version)
+        smart_ans.session_store.set_version(version)
+    # Load sẵn LLM để câu hỏi đầu tiên không phải chờ
+    with startup.step("load", "LLM"):
+        model_registry.get_llm()
 
-def rag_search(query):
+warmup = Warmup(load_pipeline)
+# Một người dùng trên dòng lệnh: một phiên hội thoại để câu hỏi nối tiếp có ngữ cảnh
+CLI_SESSION = "cli"
+
+def initialize():
+    warmup.wait()
+    from model_registry import get_llm_stats
+    for stats in get_llm_stats():
+        print(f"📊 Model: {stats['model_path']} | load: {stats['load_time_s']:.2f}s | "
+              f"RSS: {stats['rss_now_mb']:.0f}MB")
+
+def rag_search(query, session_id=None):
     try:
-        global bm25_retriever, vector_store
-        if bm25_retriever is None or vector_store is None:
+        if not warmup.done:
             initialize()
-        response = smart_response(query, bm25_retriever, vector_store)
+        from smart_ans import smart_response
+        response = smart_response(query, bm25_retriever, vector_store, session_id)
         return response
     except Exception as e:
         print(f"\n❌ Lỗi: {str(e)}")
         return "Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi của bạn."
 
+def rag_search_stream(query, stats=None, session_id=None):
+    """Giống rag_search nhưng yield từng token ngay khi LLM sinh ra"""
+    try:
+        if not warmup.done:
+            # Chitchat có sẵn câu trả lời: không cần chờ pipeline load xong
+            answer = pattern_manager.direct_answer(query)
+            if answer is not None:
+                # Vẫn ghi vào phiên để câu hỏi sau khi load xong có đủ lịch sử (session_store chỉ cần numpy)
+                if session_id:
+                    from session_store import session_store
+                    session_store.add_turn(session_id, query, answer)
+                yield answer
+                return
+            print("⏳ Đang tải index và model...", flush=True)
+            initialize()
+        from smart_ans import smart_response_stream
+        yield from smart_response_stream(query, bm25_retriever, vector_store, stats, session_id)
+    except Exception as e:
+        print(f"\n❌ Lỗi: {str(e)}")
+        yield "Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi của bạn."
+
+def shutdown():
+    """Giải phóng tài nguyên nếu pipeline đã load xong (thread nền đang load thì dừng cùng tiến trình)"""
+    global bm25_retriever, vector_store
+    vector_store = None
+    bm25_retriever = None
+    if warmup.done:
+        from model_registry import shutdown_llm
+        from smart_ans import answer_cache
+        shutdown_llm()
+        answer_cache.save()
+        print(f"📊 Cache câu trả lời: {answer_cache.get_stats()}")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chatbot RAG (VinaLLaMA)")
+    parser.add_argument("--eager", action="store_true",
+                        help="Load index và LLM xong rồi mới hiện dấu nhắc (cách cũ)")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="In thời gian từng bước khởi động khi thoát")
+    args = parser.parse_args()
     try:
-        initialize()  # Khởi tạo ngay từ đầu
+        if args.eager:
+            initialize()  # Khởi tạo ngay từ đầu
+        else:
+            # Load trên thread nền trong lúc người dùng gõ câu hỏi đầu tiên
+            warmup.start()
         while True:
             try:
-                query = input("\nNhập câu hỏi của bạn (hoặc 'exit' để thoát): ")
+                startup.mark("dấu nhắc đầu tiên")
+                query = input("\nNhập câu hỏi của bạn (hoặc 'exit' để thoát, '/startup' xem thời gian khởi động, "
+                              "'/new' bắt đầu hội thoại mới): ")
                 if query.lower() == "exit":
                     print("👋 Tạm biệt!")
                     break
-                
-                response = rag_search(query)
-                if response:
-                    print("\nCâu trả lời:", response)
+                if query.strip() == "/startup":
+                    print(startup.format())
+                    continue
+                if query.strip() == "/new":
+                    from session_store import session_store
+                    session_store.clear(CLI_SESSION)
+                    print("🆕 Đã bắt đầu hội thoại mới.")
+                    continue
+
+                # In câu trả lời ngay khi từng token được sinh ra
+                stats = {}
+                answered = False
+                for piece in rag_search_stream(query, stats, CLI_SESSION):
+                    if not answered and piece:
+                        startup.mark("câu trả lời đầu tiên")
+                        print("\nCâu trả lời: ", end="", flush=True)
+                        answered = True
+                    print(piece, end="", flush=True)
+                if answered:
+                    print()
+                    if stats.get("tokens"):
+                        print(f"⏱️ Token đầu tiên: {stats['first_token_s']:.2f}s | "
+                              f"Tổng: {stats['total_s']:.2f}s | {stats['tokens']} tokens")
                 else:
                     print("\n❌ Không tìm được câu trả lời phù hợp.")
-                    
+
             except KeyboardInterrupt:
                 print("\n👋 Tạm biệt!")
                 break
@@ -42,8 +150,6 @@ if __name__ == "__main__":
                 print(f"\n❌ Lỗi: {str(e)}")
                 print("Vui lòng thử lại.")
     finally:
-        # Giải phóng tài nguyên
-        if vector_store:
-            vector_store = None
-        if bm25_retriever:
-            bm25_retriever = None
+        shutdown()
+        if args.startup_report:
+            print(startup.format())
@@ -0,0 +1,324 @@
+import hashlib
+import itertools
+import json
+import os
+import time
+from array import array
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from pypdf import PdfReader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from generations import commit_generation, current_path, new_generation
+
+# Cau hinh
+PDF_PATH = "data/working.pdf"
+CHUNK_STORE_PATH = "vectorstores/chunk_store"
+STORE_VERSION = 1
+# Số trang mỗi tác vụ đọc PDF trong process pool, và số tác vụ được chạy trước tối đa
+PAGES_PER_TASK = 8
+MAX_PENDING_TASKS = 16
+
+SPLITTER_CONFIG = {
+    "chunk_size": 512,
+    "chunk_overlap": 50,
+    "separators": ["\n\n", "\n", ".", "!", "?", ";", ":", ",", " ", ""],
+}
+
+
+def file_sha256(path: str) -> str:
+    """Tính hash nội dung file (đọc theo từng khối để không tốn RAM)"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_hash(text: str) -> bytes:
+    """Hash nội dung một chunk (20 bytes)"""
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def count_pages(pdf_path: str) -> int:
+    return len(PdfReader(pdf_path).pages)
+
+
+def _extract_pages(task: Tuple[str, int, int]) -> List[Tuple[int, str]]:
+    """Chạy trong process con: lấy text của các trang [start, end), giống PyPDFLoader"""
+    pdf_path, start, end = task
+    reader = PdfReader(pdf_path)
+    return [(page, reader.pages[page].extract_text()) for page in range(start, end)]
+
+
+def _ordered_map(pool: Optional[Executor], fn: Callable, tasks: Iterable, max_pending: int) -> Iterator:
+    """map theo đúng thứ tự, giữ tối đa max_pending tác vụ đang chạy để bộ nhớ không tăng theo số trang"""
+    if pool is None:
+        yield from map(fn, tasks)
+        return
+    tasks = iter(tasks)
+    pending = deque(pool.submit(fn, task) for task in itertools.islice(tasks, max_pending))
+    while pending:
+        result = pending.popleft().result()
+        for task in itertools.islice(tasks, 1):
+            pending.append(pool.submit(fn, task))
+        yield result
+
+
+def iter_pdf_pages(pdf_path: str, pool: Optional[Executor] = None,
+                   pages_per_task: int = PAGES_PER_TASK) -> Iterator[Document]:
+    """Đọc lần lượt từng trang PDF (song song trong process pool nếu có), theo đúng thứ tự trang"""
+    n_pages = count_pages(pdf_path)
+    tasks = [(pdf_path, start, min(start + pages_per_task, n_pages)) for start in range(0, n_pages, pages_per_task)]
+    for pages in _ordered_map(pool, _extract_pages, tasks, MAX_PENDING_TASKS):
+        for page, text in pages:
+            yield Document(page_content=text, metadata={"source": pdf_path, "page": page})
+
+
+def iter_pdf_chunks(pdf_path: str, config: dict = SPLITTER_CONFIG,
+                    pool: Optional[Executor] = None) -> Iterator[Document]:
+    """Chia chunk theo từng trang ngay khi trang được đọc xong, không giữ cả PDF trong bộ nhớ"""
+    text_splitter = RecursiveCharacterTextSplitter(
+        **config,
+        length_function=len,
+        add_start_index=True
+    )
+    for page in iter_pdf_pages(pdf_path, pool):
+        yield from text_splitter.split_documents([page])
+
+
+def split_pdf(pdf_path: str, config: dict = SPLITTER_CONFIG) -> List[Document]:
+    """Đọc PDF và chia thành chunks"""
+    return list(iter_pdf_chunks(pdf_path, config))
+
+
+def _stable_ids(pairs: Iterable[Tuple[str, str]]) -> List[str]:
+    ids = []
+    seen: Dict[str, int] = {}
+    for source, text in pairs:
+        key = source + "\0" + text
+        chunk_id = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        count = seen.get(chunk_id, 0)
+        seen[chunk_id] = count + 1
+        ids.append(chunk_id if count == 0 else f"{chunk_id}#{count}")
+    return ids
+
+
+def assign_chunk_ids(documents: Iterable[Document]) -> List[str]:
+    """Tạo id ổn định cho mỗi chunk từ nguồn và nội dung (chunk trùng nội dung được đánh số)"""
+    return _stable_ids((doc.metadata["source"], doc.page_content) for doc in documents)
+
+
+class ChunkStore:
+    """Kho chunk lưu trên đĩa: một buffer UTF-8 liền mạch + các mảng song song, đọc bằng mmap"""
+
+    def __init__(self, path: str, meta: dict, texts, offsets, pages, starts, source_ids, hashes):
+        self.path = path
+        self.meta = meta
+        self.sources: List[str] = meta["source_paths"]
+        self.texts = texts
+        self.offsets = offsets
+        self.pages = pages
+        self.starts = starts
+        self.source_ids = source_ids
+        self.hashes = hashes
+        self._canonical: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def text(self, i: int) -> str:
+        return bytes(self.texts[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def metadata(self, i: int) -> dict:
+        return {
+            "source": self.sources[self.source_ids[i]],
+            "page": int(self.pages[i]),
+            "start_index": int(self.starts[i]),
+        }
+
+    def document(self, i: int) -> Document:
+        return Document(page_content=self.text(i), metadata=self.metadata(i))
+
+    def __getitem__(self, i: int) -> Document:
+        return self.document(i)
+
+    def documents(self) -> List[Document]:
+        return [self.document(i) for i in range(len(self))]
+
+    def chunk_ids(self) -> List[str]:
+        """Id ổn định của từng chunk (giống assign_chunk_ids), đọc text theo chỉ số, không tạo Document"""
+        return _stable_ids((self.sources[self.source_ids[i]], self.text(i)) for i in range(len(self)))
+
+    def canonical_ids(self) -> np.ndarray:
+        """Id của chunk đầu tiên có cùng nội dung cho mỗi chunk, dùng để loại trùng trên số nguyên"""
+        if self._canonical is None:
+            if len(self) == 0:
+                self._canonical = np.zeros(0, dtype=np.int64)
+            else:
+                _, first, inverse = np.unique(np.asarray(self.hashes), return_index=True, return_inverse=True)
+                self._canonical = first[inverse.reshape(-1)].astype(np.int64)
+        return self._canonical
+
+    def hash_hex(self, i: int) -> str:
+        return bytes(self.hashes[i]).hex()
+
+    def signature(self) -> str:
+        """Chữ ký của toàn bộ kho (thứ tự + nội dung chunk), dùng để biết index phụ thuộc có cũ không"""
+        digest = hashlib.sha1(json.dumps(self.meta["splitter"], sort_keys=True).encode("utf-8"))
+        digest.update(np.ascontiguousarray(self.hashes).tobytes())
+        return digest.hexdigest()
+
+    @classmethod
+    def load(cls, path: str = CHUNK_STORE_PATH) -> Optional["ChunkStore"]:
+        """Mở thế hệ hiện tại của kho chunk bằng mmap, trả về None nếu chưa có hoặc sai phiên bản"""
+        root = current_path(path)
+        meta_path = os.path.join(root, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != STORE_VERSION:
+            return None
+
+        texts_path = os.path.join(root, "texts.bin")
+        if os.path.getsize(texts_path) > 0:
+            texts = np.memmap(texts_path, dtype=np.uint8, mode="r")
+        else:
+            texts = np.zeros(0, dtype=np.uint8)
+
+        def load_array(name):
+            return np.load(os.path.join(root, name + ".npy"), mmap_mode="r")
+
+        return cls(
+            path, meta, texts,
+            load_array("offsets"), load_array("pages"), load_array("starts"),
+            load_array("source_ids"), load_array("hashes")
+        )
+
+    @classmethod
+    def save(cls, path: str, documents: Iterable[Document], sources: Dict[str, dict],
+             config: dict) -> "ChunkStore":
+        """Ghi danh sách chunk vào một thế hệ mới và mở lại bằng mmap"""
+        writer = ChunkStoreWriter(path, sources)
+        for doc in documents:
+            writer.add(doc.page_content, doc.metadata)
+        return writer.commit(config)
+
+
+class ChunkStoreWriter:
+    """Ghi kho chunk theo luồng vào một thế hệ mới: text xuống đĩa ngay khi chunk được tạo
+
+    Chỉ giữ các mảng số (~44 byte mỗi chunk) trong RAM, không giữ Document. Thế hệ đang được
+    worker mmap không bị ghi đè (cắt ngắn file đang map gây SIGBUS).
+    """
+
+    def __init__(self, path: str, sources: Dict[str, dict]):
+        self.path = path
+        self.sources = sources
+        self._source_index = {source: i for i, source in enumerate(sources)}
+        self.gen_path = new_generation(path)
+        self._texts = open(os.path.join(self.gen_path, "texts.bin"), "wb")
+        self._offsets = array("q", [0])
+        self._pages = array("i")
+        self._starts = array("q")
+        self._source_ids = array("i")
+        self._hashes = bytearray()
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def add(self, text: str, metadata: dict) -> None:
+        data = text.encode("utf-8")
+        self._texts.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+        self._pages.append(int(metadata.get("page", 0)))
+        self._starts.append(int(metadata.get("start_index", 0)))
+        self._source_ids.append(self._source_index[metadata["source"]])
+        self._hashes += hashlib.sha1(data).digest()
+
+    def commit(self, config: dict) -> ChunkStore:
+        """Ghi các mảng và meta rồi mới chuyển sang thế hệ mới: bị ngắt giữa chừng thì kho cũ vẫn nguyên vẹn"""
+        self._texts.close()
+        np.save(os.path.join(self.gen_path, "offsets.npy"), np.frombuffer(self._offsets, dtype=np.int64))
+        np.save(os.path.join(self.gen_path, "pages.npy"), np.frombuffer(self._pages, dtype=np.int32))
+        np.save(os.path.join(self.gen_path, "starts.npy"), np.frombuffer(self._starts, dtype=np.int64))
+        np.save(os.path.join(self.gen_path, "source_ids.npy"), np.frombuffer(self._source_ids, dtype=np.int32))
+        np.save(os.path.join(self.gen_path, "hashes.npy"), np.frombuffer(bytes(self._hashes), dtype="S20"))
+        meta = {
+            "version": STORE_VERSION,
+            "splitter": config,
+            "source_paths": list(self.sources),
+            "sources": self.sources,
+            "count": len(self),
+        }
+        with open(os.path.join(self.gen_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        commit_generation(self.path, self.gen_path)
+        return ChunkStore.load(self.path)
+
+
+def _source_info(pdf_path: str, previous: Optional[dict]) -> dict:
+    """Thông tin nhận diện file nguồn, chỉ hash lại khi kích thước hoặc mtime thay đổi"""
+    stat = os.stat(pdf_path)
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime:
+        return previous
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_sha256(pdf_path)}
+
+
+def load_chunk_store(pdf_paths=(PDF_PATH,), path: str = CHUNK_STORE_PATH,
+                     config: dict = SPLITTER_CONFIG, workers: Optional[int] = None) -> ChunkStore:
+    """Mở kho chunk, chỉ chia lại các PDF có nội dung hoặc cấu hình splitter thay đổi
+
+    Trang PDF được đọc song song bằng `workers` process (mặc định theo số CPU, 1 = không dùng pool).
+    """
+    store = ChunkStore.load(path)
+    same_config = store is not None and store.meta["splitter"] == json.loads(json.dumps(config))
+    previous = store.meta["sources"] if same_config else {}
+
+    sources = {pdf_path: _source_info(pdf_path, previous.get(pdf_path)) for pdf_path in pdf_paths}
+    if same_config and sources == previous:
+        return store
+
+    unchanged = {pdf_path for pdf_path, info in sources.items()
+                 if previous.get(pdf_path) and previous[pdf_path]["sha256"] == info["sha256"]}
+    pool = ProcessPoolExecutor(max_workers=workers) if len(unchanged) < len(sources) and workers != 1 else None
+    # Chunk được ghi thẳng vào thế hệ mới của kho ngay khi được chia, không gom thành danh sách Document
+    writer = ChunkStoreWriter(path, sources)
+    try:
+        for pdf_path in sources:
+            if pdf_path in unchanged:
+                # PDF không đổi: chép lại chunk cũ từ kho
+                source_id = store.sources.index(pdf_path)
+                for i in np.flatnonzero(np.asarray(store.source_ids) == source_id):
+                    writer.add(store.text(i), store.metadata(i))
+                continue
+
+            print(f"📄 Đang chia lại tài liệu {pdf_path}...")
+            start = time.perf_counter()
+            n_chunks = 0
+            for doc in iter_pdf_chunks(pdf_path, config, pool):
+                doc.metadata["source"] = pdf_path
+                writer.add(doc.page_content, doc.metadata)
+                n_chunks += 1
+            elapsed = max(time.perf_counter() - start, 1e-9)
+            n_pages = count_pages(pdf_path)
+            print(f"   {n_pages} trang, {n_chunks} chunks trong {elapsed:.1f}s "
+                  f"({n_pages / elapsed:.1f} trang/s, {n_chunks / elapsed:.1f} chunks/s)")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    # Bỏ mmap của kho cũ để thế hệ cũ được dọn khi không còn ai dùng
+    store = None
+    return writer.commit(config)
+
+
+def load_chunks(pdf_paths=(PDF_PATH,), path: str = CHUNK_STORE_PATH,
+                config: dict = SPLITTER_CONFIG) -> List[Document]:
+    """Lấy danh sách chunk dạng Document từ kho chunk"""
+    return load_chunk_store(pdf_paths, path, config).documents()
@@ -0,0 +1,64 @@
+from typing import Callable, Dict, List, Tuple
+
+from langchain_core.documents import Document
+
+
+def _subtract_spans(start: int, end: int, taken: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Các đoạn con của [start, end) chưa nằm trong những đoạn đã chọn"""
+    pieces = [(start, end)]
+    for taken_start, taken_end in taken:
+        next_pieces = []
+        for piece_start, piece_end in pieces:
+            if taken_end <= piece_start or taken_start >= piece_end:
+                next_pieces.append((piece_start, piece_end))
+                continue
+            if piece_start < taken_start:
+                next_pieces.append((piece_start, taken_start))
+            if taken_end < piece_end:
+                next_pieces.append((taken_end, piece_end))
+        pieces = next_pieces
+    return pieces
+
+
+def pack_context(scored_docs: List[Tuple[Document, float]],
+                 count_tokens: Callable[[str], int],
+                 budget: int,
+                 separator: str = "\n") -> Tuple[str, Dict[str, int]]:
+    """Ghép context theo điểm liên quan cho tới khi hết ngân sách token
+
+    Phần chồng lấn (chunk_overlap) giữa các chunk cùng trang được cắt bỏ dựa trên start_index.
+    """
+    separator_tokens = count_tokens(separator) if separator else 0
+    taken: Dict[tuple, List[Tuple[int, int]]] = {}
+    parts: List[str] = []
+    used = 0
+    info = {"candidates": len(scored_docs), "chunks": 0, "dropped": 0, "trimmed_chars": 0}
+
+    for doc, _ in sorted(scored_docs, key=lambda item: item[1], reverse=True):
+        text = doc.page_content
+        start = doc.metadata.get("start_index")
+        if start is not None:
+            key = (doc.metadata.get("source"), doc.metadata.get("page"))
+            spans = taken.setdefault(key, [])
+            pieces = _subtract_spans(start, start + len(text), spans)
+            kept = " ".join(text[piece_start - start:piece_end - start] for piece_start, piece_end in pieces)
+            info["trimmed_chars"] += len(text) - sum(piece_end - piece_start for piece_start, piece_end in pieces)
+            text = kept.strip()
+        if not text:
+            info["dropped"] += 1
+            continue
+
+        cost = count_tokens(text) + (separator_tokens if parts else 0)
+        if used + cost > budget:
+            # Chunk này không vừa, thử các chunk nhỏ hơn phía sau
+            info["dropped"] += 1
+            continue
+
+        parts.append(text)
+        used += cost
+        info["chunks"] += 1
+        if start is not None:
+            spans.append((start, start + len(doc.page_content)))
+
+    info["tokens"] = used
+    return separator.join(parts), info
@@ -0,0 +1,114 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from metrics import Histogram
+
+# Cau hinh
+BATCH_WINDOW_MS = 5.0
+MAX_BATCH = 32
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+WAIT_MS_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100)
+
+
+class _Request:
+    __slots__ = ("texts", "future", "enqueued")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future: Future = Future()
+        self.enqueued = time.monotonic()
+
+
+class MicroBatchEmbeddings(Embeddings):
+    """Gom các lời gọi embed đồng thời thành một lần gọi model
+
+    Lời gọi đầu tiên mở một cửa sổ `window_ms`; mọi lời gọi đến trong cửa sổ đó (tối đa
+    `max_batch` đoạn) được embed chung rồi trả kết quả về đúng từng nơi gọi. Cửa sổ lớn hơn
+    cho batch lớn hơn (thông lượng cao) nhưng mỗi câu hỏi phải chờ lâu hơn; `window_ms=0`
+    tắt gom batch.
+    """
+
+    def __init__(self, embeddings: Embeddings, window_ms: float = BATCH_WINDOW_MS, max_batch: int = MAX_BATCH):
+        self.embeddings = embeddings
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.wait_ms = Histogram(WAIT_MS_BUCKETS)
+        self._cond = threading.Condition()
+        self._pending: List[_Request] = []
+        self._pending_texts = 0
+        self._thread = None
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        client = getattr(self.embeddings, "client", None)
+        if client is not None and hasattr(client, "embed"):
+            # GPT4AllEmbeddings.embed_documents gọi model từng đoạn một, Embed4All.embed nhận cả danh sách
+            return [list(map(float, vector)) for vector in client.embed(texts)]
+        return self.embeddings.embed_documents(texts)
+
+    # ---- Giao diện Embeddings ----
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        if self.window_ms <= 0 or len(texts) >= self.max_batch:
+            # Đã đủ lớn (ví dụ lúc ingest): gọi thẳng, không chờ cửa sổ
+            self.batch_sizes.observe(len(texts))
+            return self._embed_batch(texts)
+        request = _Request(list(texts))
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                self._thread.start()
+            self._pending.append(request)
+            self._pending_texts += len(texts)
+            self._cond.notify()
+        return request.future.result()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    # ---- Thread gom batch ----
+    def _take_batch(self) -> List[_Request]:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = self._pending[0].enqueued + self.window_ms / 1000
+            while self._pending_texts < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, size = [], 0
+            while self._pending and (not batch or size + len(self._pending[0].texts) <= self.max_batch):
+                request = self._pending.pop(0)
+                batch.append(request)
+                size += len(request.texts)
+            self._pending_texts -= size
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            texts = [text for request in batch for text in request.texts]
+            now = time.monotonic()
+            self.batch_sizes.observe(len(texts))
+            for request in batch:
+                self.wait_ms.observe((now - request.enqueued) * 1000)
+            try:
+                vectors = self._embed_batch(texts)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            offset = 0
+            for request in batch:
+                request.future.set_result(vectors[offset:offset + len(request.texts)])
+                offset += len(request.texts)
+
+    def get_stats(self) -> dict:
+        return {"window_ms": self.window_ms, "max_batch": self.max_batch,
+                "batch_size": self.batch_sizes.snapshot(), "wait_ms": self.wait_ms.snapshot()}
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, mỗi tiến trình nên dùng một thư mục cache riêng
+    fcntl = None
+
+# Cau hinh
+EMBEDDING_CACHE_PATH = "vectorstores/embedding_cache"
+KEY_BYTES = 20
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+class CachedEmbeddings(Embeddings):
+    """Bọc model embedding: vector lưu trong file float32 (mmap) theo hash nội dung + LRU trong RAM
+
+    Nhiều tiến trình (indexer, CLI, worker của server) có thể dùng chung một thư mục cache:
+    mọi lần ghi thêm đều giữ file lock, số dòng được tính theo kích thước file chứ không theo bộ nhớ riêng.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_id: str,
+                 path: str = EMBEDDING_CACHE_PATH, lru_size: int = 1024):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.path = path
+        self.lru_size = lru_size
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._rows: Dict[bytes, int] = {}
+        # Số dòng trên đĩa đã nạp vào _rows (kể cả dòng trùng key do hai tiến trình cùng ghi)
+        self._n_rows = 0
+        self._dim: Optional[int] = None
+        self._vectors = None
+        self.stats = {"lru_hits": 0, "disk_hits": 0, "misses": 0, "model_calls": 0}
+        self._open()
+
+    # ---- Lưu trữ trên đĩa ----
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool = True):
+        """Khóa giữa các tiến trình dùng chung thư mục cache (nhả khi đóng file)"""
+        with open(self._file("lock"), "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _open(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        with self._file_lock():
+            meta = self._read_meta()
+            if meta.get("model_id") != self.model_id:
+                # Model embedding đổi: vector cũ không còn dùng được
+                for name in ("keys.bin", "vectors.f32"):
+                    if os.path.exists(self._file(name)):
+                        os.remove(self._file(name))
+                self._write_meta({"model_id": self.model_id, "dim": None})
+            self._refresh()
+
+    def _read_meta(self) -> dict:
+        if not os.path.exists(self._file("meta.json")):
+            return {}
+        with open(self._file("meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_meta(self, meta: dict) -> None:
+        with open(self._file("meta.json") + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(self._file("meta.json") + ".tmp", self._file("meta.json"))
+
+    def _disk_rows(self) -> int:
+        """Số dòng đã ghi đủ cả key và vector (phòng khi một lượt ghi bị ngắt giữa chừng)"""
+        paths = (self._file("keys.bin"), self._file("vectors.f32"))
+        if not self._dim or not all(os.path.exists(path) for path in paths):
+            return 0
+        return min(os.path.getsize(paths[0]) // KEY_BYTES, os.path.getsize(paths[1]) // (4 * self._dim))
+
+    def _refresh(self) -> None:
+        """Nạp các dòng mà tiến trình khác đã ghi thêm; gọi khi đang giữ file lock"""
+        if self._dim is None:
+            self._dim = self._read_meta().get("dim")
+        n_rows = self._disk_rows()
+        if n_rows <= self._n_rows:
+            return
+        with open(self._file("keys.bin"), "rb") as f:
+            f.seek(self._n_rows * KEY_BYTES)
+            keys = f.read((n_rows - self._n_rows) * KEY_BYTES)
+        for i in range(n_rows - self._n_rows):
+            # Key trùng (hai tiến trình cùng embed một đoạn): giữ dòng đầu tiên
+            self._rows.setdefault(keys[i * KEY_BYTES:(i + 1) * KEY_BYTES], self._n_rows + i)
+        self._n_rows = n_rows
+        self._remap()
+
+    def _remap(self) -> None:
+        if self._n_rows and self._dim:
+            self._vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32,
+                                      mode="r", shape=(self._n_rows, self._dim))
+        else:
+            self._vectors = None
+
+    def _append(self, keys: List[bytes], vectors: np.ndarray) -> None:
+        with self._file_lock():
+            self._refresh()
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                self._write_meta({"model_id": self.model_id, "dim": self._dim})
+            fresh = [i for i, key in enumerate(keys) if key not in self._rows]
+            if not fresh:
+                return
+            # Dòng mới bắt đầu sau dòng cuối cùng trên đĩa, bỏ phần đuôi ghi dở để key và vector thẳng hàng
+            start = self._disk_rows()
+            for name, row_bytes in (("vectors.f32", 4 * self._dim), ("keys.bin", KEY_BYTES)):
+                if os.path.exists(self._file(name)) and os.path.getsize(self._file(name)) > start * row_bytes:
+                    os.truncate(self._file(name), start * row_bytes)
+            # Ghi vector trước rồi mới ghi key
+            with open(self._file("vectors.f32"), "ab") as f:
+                f.write(np.ascontiguousarray(vectors[fresh], dtype=np.float32).tobytes())
+            with open(self._file("keys.bin"), "ab") as f:
+                f.write(b"".join(keys[i] for i in fresh))
+            for offset, i in enumerate(fresh):
+                self._rows[keys[i]] = start + offset
+            self._n_rows = start + len(fresh)
+            self._remap()
+
+    # ---- LRU trong RAM ----
+    def _remember(self, key: bytes, vector: np.ndarray) -> None:
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _lookup(self, key: bytes) -> Optional[np.ndarray]:
+        vector = self._lru.get(key)
+        if vector is not None:
+            self._lru.move_to_end(key)
+            self.stats["lru_hits"] += 1
+            return vector
+        row = self._rows.get(key)
+        if row is not None:
+            vector = np.array(self._vectors[row])
+            self._remember(key, vector)
+            self.stats["disk_hits"] += 1
+            return vector
+        return None
+
+    # ---- Giao diện Embeddings ----
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Chỉ gửi các đoạn chưa có trong cache sang model, trong một lần gọi"""
+        keys = [text_hash(text) for text in texts]
+        results: List[Optional[np.ndarray]] = [None] * len(texts)
+        missing: Dict[bytes, List[int]] = OrderedDict()
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._lookup(key)
+                if vector is None:
+                    missing.setdefault(key, []).append(i)
+                else:
+                    results[i] = vector
+            if missing:
+                # Tiến trình khác có thể vừa embed các đoạn này
+                with self._file_lock(exclusive=False):
+                    self._refresh()
+                for key in list(missing):
+                    vector = self._lookup(key)
+                    if vector is not None:
+                        for i in missing.pop(key):
+                            results[i] = vector
+
+        if missing:
+            miss_texts = [texts[positions[0]] for positions in missing.values()]
+            vectors = np.array(self.embeddings.embed_documents(miss_texts), dtype=np.float32)
+            with self._lock:
+                self.stats["misses"] += len(miss_texts)
+                self.stats["model_calls"] += 1
+                new_keys = [key for key in missing if key not in self._rows]
+                new_vectors = [vector for key, vector in zip(missing, vectors) if key not in self._rows]
+                if new_keys:
+                    self._append(new_keys, np.stack(new_vectors))
+                for (key, positions), vector in zip(missing.items(), vectors):
+                    self._remember(key, vector)
+                    for i in positions:
+                        results[i] = vector
+
+        return [vector.tolist() for vector in results]
+
+    def cached(self, texts: List[str]) -> Optional[np.ndarray]:
+        """Vector đã có trong cache của các đoạn, None nếu thiếu bất kỳ đoạn nào; không gọi model"""
+        with self._lock:
+            vectors = [self._lookup(text_hash(text)) for text in texts]
+        if any(vector is None for vector in vectors):
+            return None
+        return np.stack(vectors) if vectors else None
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {**self.stats, "stored": len(self._rows), "lru": len(self._lru)}
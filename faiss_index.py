@@ -0,0 +1,276 @@
+import argparse
+import json
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+# Cau hinh
+VECTOR_DB_PATH = "vectorstores/db_faiss"
+INDEX_PARAMS_FILE = "index_params.json"
+MAX_TRAIN_VECTORS = 100_000
+# Số chunk tra cache embedding mỗi lượt khi lấy vector từ index nén
+RECONSTRUCT_BATCH = 256
+
+# Giá trị tham số tìm kiếm được thử khi tune
+SEARCH_SWEEP = {
+    "ivf_flat": ("nprobe", [1, 2, 4, 8, 16, 32, 64, 128]),
+    "ivf_pq": ("nprobe", [1, 2, 4, 8, 16, 32, 64, 128]),
+    "hnsw": ("efSearch", [16, 32, 64, 128, 256, 512]),
+}
+
+
+def choose_index_type(n_vectors: int) -> str:
+    """Chọn loại index theo kích thước corpus"""
+    if n_vectors < 5_000:
+        return "flat"
+    if n_vectors < 100_000:
+        return "hnsw"
+    if n_vectors < 1_000_000:
+        return "ivf_flat"
+    return "ivf_pq"
+
+
+def _pq_subquantizers(dim: int, max_m: int = 64) -> int:
+    """Số sub-quantizer lớn nhất (<= max_m, mỗi sub-vector >= 8 chiều) chia hết số chiều"""
+    for m in range(max(1, min(max_m, dim // 8)), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def factory_string(kind: str, n_vectors: int, dim: int) -> str:
+    nlist = max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39 or 1))
+    if kind == "flat":
+        return "Flat"
+    if kind == "hnsw":
+        return "HNSW32"
+    if kind == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    if kind == "ivf_pq":
+        m = _pq_subquantizers(dim)
+        # Mã 8 bit cần ~39 * 256 điểm để train, corpus nhỏ dùng mã 4 bit
+        nbits = 8 if n_vectors >= 39 * 256 else 4
+        return f"OPQ{m},IVF{nlist},PQ{m}x{nbits}"
+    raise ValueError(f"Loại index không hợp lệ: {kind}")
+
+
+def faiss_metric(vector_store: FAISS) -> int:
+    if vector_store.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+        return faiss.METRIC_INNER_PRODUCT
+    return faiss.METRIC_L2
+
+
+def build_index(vectors: np.ndarray, kind: str, metric: int = faiss.METRIC_L2,
+                factory: Optional[str] = None):
+    """Tạo và train index FAISS theo loại, thêm toàn bộ vector theo đúng thứ tự"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    factory = factory or factory_string(kind, len(vectors), vectors.shape[1])
+    index = faiss.index_factory(vectors.shape[1], factory, metric)
+    if not index.is_trained:
+        # IVF/PQ chỉ cần một mẫu đại diện để train
+        if len(vectors) > MAX_TRAIN_VECTORS:
+            sample = np.random.default_rng(0).choice(len(vectors), MAX_TRAIN_VECTORS, replace=False)
+            index.train(vectors[np.sort(sample)])
+        else:
+            index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def set_search_param(index, name: str, value) -> None:
+    faiss.ParameterSpace().set_index_parameter(index, name, value)
+
+
+def exact_vectors(index) -> bool:
+    """Index giữ nguyên vector gốc (Flat, HNSW-Flat, IVF-Flat) nên dựng lại được chính xác"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return not isinstance(index, faiss.IndexPreTransform) and isinstance(
+            faiss.downcast_index(ivf), faiss.IndexIVFFlat)
+    return isinstance(index, (faiss.IndexFlat, faiss.IndexHNSWFlat))
+
+
+def store_vectors(vector_store: FAISS) -> np.ndarray:
+    """Lấy lại vector của toàn bộ chunk theo thứ tự trong index, không bao giờ gọi model embedding
+
+    Index giữ vector gốc được dựng lại trực tiếp (IVF cần direct map). Index nén (PQ) chỉ có vector
+    xấp xỉ: lấy bản chính xác trong cache embedding, thiếu chunk nào thì báo lỗi thay vì embed lại cả corpus.
+    """
+    index = vector_store.index
+    if exact_vectors(index):
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.make_direct_map()
+        return index.reconstruct_n(0, index.ntotal)
+    cached = getattr(vector_store.embeddings, "cached", None)
+    vectors = np.empty((index.ntotal, index.d), dtype=np.float32)
+    for start in range(0, index.ntotal, RECONSTRUCT_BATCH):
+        texts = [vector_store.docstore.search(vector_store.index_to_docstore_id[i]).page_content
+                 for i in range(start, min(start + RECONSTRUCT_BATCH, index.ntotal))]
+        batch = cached(texts) if cached is not None else None
+        if batch is None:
+            raise RuntimeError(f"Index nén không giữ vector gốc và cache embedding thiếu vector của chunk "
+                               f"{start}..{start + len(texts) - 1}: xóa index rồi chạy lại indexer.py để embed lại")
+        vectors[start:start + len(texts)] = batch
+    return vectors
+
+
+def index_memory_bytes(index) -> int:
+    return len(faiss.serialize_index(index))
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray, k: int = 5) -> float:
+    hits = sum(len(set(row_found[:k]) & set(row_truth[:k]) - {-1}) for row_found, row_truth in zip(found, truth))
+    return hits / (len(truth) * k)
+
+
+def _time_search(index, queries: np.ndarray, k: int) -> Tuple[np.ndarray, float]:
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    return found, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def tune(vectors: np.ndarray, queries: np.ndarray, metric: int,
+         kinds: Optional[List[str]] = None, k: int = 5, target_recall: float = 0.95) -> Tuple[List[dict], dict]:
+    """Quét tham số tìm kiếm của từng loại index, so với index flat, trả về bảng kết quả và cấu hình được chọn"""
+    flat = build_index(vectors, "flat", metric)
+    truth, flat_ms = _time_search(flat, queries, k)
+    rows = [{"kind": "flat", "factory": "Flat", "param": None, "value": None, "recall": 1.0,
+             "latency_ms": flat_ms, "memory_mb": index_memory_bytes(flat) / 2 ** 20}]
+
+    kinds = kinds or ["hnsw", "ivf_flat", "ivf_pq"]
+    for kind in kinds:
+        factory = factory_string(kind, len(vectors), vectors.shape[1])
+        start = time.perf_counter()
+        index = build_index(vectors, kind, metric, factory)
+        build_s = time.perf_counter() - start
+        memory_mb = index_memory_bytes(index) / 2 ** 20
+        param, values = SEARCH_SWEEP[kind]
+        for value in values:
+            set_search_param(index, param, value)
+            found, latency_ms = _time_search(index, queries, k)
+            rows.append({"kind": kind, "factory": factory, "param": param, "value": value,
+                         "recall": recall_at_k(found, truth, k), "latency_ms": latency_ms,
+                         "memory_mb": memory_mb, "build_s": build_s})
+
+    # Cấu hình nhanh nhất đạt recall mục tiêu (flat luôn đạt nên luôn có lựa chọn)
+    eligible = [row for row in rows if row["recall"] >= target_recall]
+    chosen = min(eligible, key=lambda row: row["latency_ms"])
+    return rows, chosen
+
+
+def save_index(vector_store: FAISS, index, params: dict, path: str = VECTOR_DB_PATH) -> None:
+    """Thay index của vector store và lưu cùng thư mục với db_faiss"""
+    vector_store.index = index
+    vector_store.save_local(path)
+    with open(os.path.join(path, INDEX_PARAMS_FILE), "w", encoding="utf-8") as f:
+        json.dump(params, f, indent=2)
+
+
+def load_index_params(path: str = VECTOR_DB_PATH) -> Dict:
+    params_path = os.path.join(path, INDEX_PARAMS_FILE)
+    if not os.path.exists(params_path):
+        return {"kind": "flat", "factory": "Flat"}
+    with open(params_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def apply_index_params(vector_store: FAISS, path: str = VECTOR_DB_PATH) -> Dict:
+    """Áp lại tham số tìm kiếm (nprobe/efSearch) đã chọn khi tune sau khi load index"""
+    params = load_index_params(path)
+    if params.get("param"):
+        set_search_param(vector_store.index, params["param"], params["value"])
+    return params
+
+
+def rebuild_index(vector_store: FAISS, path: str = VECTOR_DB_PATH, vectors: Optional[np.ndarray] = None) -> Dict:
+    """Dựng lại index theo loại đã chọn khi tune (sau khi dựng lại toàn bộ hoặc xóa vector)"""
+    params = load_index_params(path)
+    if params["kind"] == "flat" and vectors is None:
+        return params
+    vectors = store_vectors(vector_store) if vectors is None else vectors
+    # nlist phụ thuộc số vector nên tính lại factory theo corpus hiện tại
+    index = build_index(vectors, params["kind"], faiss_metric(vector_store))
+    if params.get("param"):
+        set_search_param(index, params["param"], params["value"])
+    vector_store.index = index
+    return params
+
+
+def delete_ids(vector_store: FAISS, ids: List[str], path: str = VECTOR_DB_PATH) -> None:
+    """Xóa chunk khỏi vector store, dựng lại index với các loại không phải Flat
+
+    FAISS.delete của LangChain đánh lại số thứ tự index_to_docstore_id theo giả định remove_ids
+    dồn vị trí; chỉ IndexFlat làm vậy. IVF giữ nguyên nhãn cũ và HNSW không hỗ trợ remove_ids,
+    nên với các loại đó index được dựng lại từ vector của các chunk còn lại.
+    """
+    if isinstance(vector_store.index, faiss.IndexFlat):
+        vector_store.delete(ids)
+        return
+    removed = set(ids)
+    vectors = store_vectors(vector_store)
+    keep = [i for i in range(len(vectors)) if vector_store.index_to_docstore_id[i] not in removed]
+    vector_store.docstore.delete(list(removed))
+    vector_store.index_to_docstore_id = {
+        new: vector_store.index_to_docstore_id[old] for new, old in enumerate(keep)
+    }
+    rebuild_index(vector_store, path, vectors[keep])
+
+
+def _print_rows(rows: List[dict]) -> None:
+    print(f"{'index':<24} {'tham số':<14} {'recall@5':>9} {'ms/query':>9} {'RAM (MB)':>9}")
+    for row in rows:
+        param = f"{row['param']}={row['value']}" if row["param"] else "-"
+        print(f"{row['factory']:<24} {param:<14} {row['recall']:>9.3f} "
+              f"{row['latency_ms']:>9.3f} {row['memory_mb']:>9.1f}")
+
+
+if __name__ == "__main__":
+    from model_registry import get_embeddings
+
+    parser = argparse.ArgumentParser(description="Dựng và tune index FAISS (Flat/HNSW/IVF/IVF-PQ)")
+    parser.add_argument("--path", default=VECTOR_DB_PATH)
+    parser.add_argument("--queries", help="File câu hỏi kiểm tra, mỗi dòng một câu")
+    parser.add_argument("--held-out", type=int, default=200, help="Số vector lấy ra làm truy vấn khi không có file câu hỏi")
+    parser.add_argument("--kinds", nargs="+", choices=["hnsw", "ivf_flat", "ivf_pq"])
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--save", action="store_true", help="Lưu index được chọn vào thư mục db_faiss")
+    args = parser.parse_args()
+
+    embeddings = get_embeddings()
+    vector_store = FAISS.load_local(args.path, embeddings, allow_dangerous_deserialization=True)
+    vectors = store_vectors(vector_store)
+    metric = faiss_metric(vector_store)
+
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+        queries = np.array(embeddings.embed_documents(questions), dtype=np.float32)
+        corpus = vectors
+    else:
+        # Lấy ngẫu nhiên một phần vector làm truy vấn và loại chúng khỏi tập được index
+        rng = np.random.default_rng(0)
+        held_out = rng.choice(len(vectors), size=min(args.held_out, len(vectors) // 10 or 1), replace=False)
+        mask = np.ones(len(vectors), dtype=bool)
+        mask[held_out] = False
+        queries, corpus = vectors[held_out], vectors[mask]
+
+    print(f"🔧 Tune trên {len(corpus)} vector ({vectors.shape[1]} chiều), {len(queries)} truy vấn. "
+          f"Gợi ý theo kích thước: {choose_index_type(len(vectors))}")
+    rows, chosen = tune(corpus, queries, metric, args.kinds, target_recall=args.target_recall)
+    _print_rows(rows)
+    print(f"\n✅ Chọn: {chosen['factory']} {chosen['param'] or ''}={chosen['value'] or ''} "
+          f"(recall@5={chosen['recall']:.3f}, {chosen['latency_ms']:.3f} ms/query)")
+
+    if args.save:
+        index = build_index(vectors, chosen["kind"], metric, chosen["factory"])
+        if chosen["param"]:
+            set_search_param(index, chosen["param"], chosen["value"])
+        save_index(vector_store, index, chosen, args.path)
+        print(f"💾 Đã lưu index vào {args.path}")
@@ -0,0 +1,43 @@
+import os
+import shutil
+import time
+
+# Cau hinh
+CURRENT_FILE = "CURRENT"
+# Giữ lại thế hệ liền trước để worker vừa đọc CURRENT cũ vẫn mở được file của nó
+KEEP_GENERATIONS = 2
+
+
+def current_path(path: str) -> str:
+    """Thư mục chứa file của thế hệ hiện tại (index cũ chưa chia thế hệ nằm ngay trong `path`)"""
+    try:
+        with open(os.path.join(path, CURRENT_FILE), encoding="utf-8") as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return path
+    return os.path.join(path, name)
+
+
+def new_generation(path: str) -> str:
+    """Tạo thư mục cho thế hệ mới, chưa ai mở tới cho đến khi commit_generation"""
+    gen_path = os.path.join(path, f"gen-{time.time_ns():020d}-{os.getpid()}")
+    os.makedirs(gen_path)
+    return gen_path
+
+
+def commit_generation(path: str, gen_path: str, keep: int = KEEP_GENERATIONS) -> None:
+    """Trỏ CURRENT sang thế hệ mới (os.replace là nguyên tử) rồi xóa các thế hệ cũ
+
+    File của một thế hệ không bao giờ bị ghi đè hay cắt ngắn: worker đang mmap thế hệ cũ vẫn đọc được
+    (trên POSIX file đã xóa còn tồn tại tới khi hết được map), lần mở sau chỉ thấy thế hệ mới.
+    """
+    pointer = os.path.join(path, CURRENT_FILE)
+    name = os.path.basename(gen_path)
+    with open(f"{pointer}.{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+        f.write(name)
+    os.replace(f"{pointer}.{os.getpid()}.tmp", pointer)
+    # Thế hệ cũ hơn (kể cả lượt ghi bị ngắt giữa chừng), chỉ giữ lại `keep - 1` thế hệ liền trước
+    older = sorted(entry for entry in os.listdir(path) if entry.startswith("gen-") and entry < name)
+    for entry in older[:max(0, len(older) - (keep - 1))]:
+        # Windows không cho xóa file đang được map: để lần commit sau dọn tiếp
+        shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
@@ -0,0 +1,536 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+
+from chunk_store import ChunkStore, chunk_hash
+from tracing import tracer
+
+# Cau hinh
+# MMR: 1.0 chỉ xét độ liên quan, nhỏ hơn thì phạt chunk giống chunk đã chọn (chỉ dùng khi bật, xem utils.mmr_lambda)
+MMR_LAMBDA = 0.7
+# Số ứng viên (sau khi kết hợp hai nhánh) đưa vào MMR
+MMR_POOL = 20
+
+# Thread pool dùng chung: FAISS và bước embedding nhả GIL nên chạy song song được với BM25
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid")
+# Bật direct map của index IVF (để dựng lại vector theo vị trí) chỉ một lần cho mỗi index
+_direct_map_lock = threading.Lock()
+
+
+def bm25_search(bm25_retriever, query: str, k: int) -> List[Tuple[Document, float]]:
+    """Nhánh BM25: trả về (document, điểm), điểm càng cao càng liên quan"""
+    with tracer.span("bm25"):
+        if hasattr(bm25_retriever, "search"):
+            ids, scores = bm25_retriever.search(query, k)
+            return [(bm25_retriever.docs[i], float(score)) for i, score in zip(ids, scores)]
+        # BM25Retriever của LangChain không trả điểm: dùng thứ hạng làm điểm
+        docs = bm25_retriever.get_relevant_documents(query)[:k]
+        return [(doc, float(len(docs) - rank)) for rank, doc in enumerate(docs)]
+
+
+def faiss_search(vector_store, query: str, k: int, query_vector=None) -> List[Tuple[Document, float]]:
+    """Nhánh FAISS: trả về (document, điểm), điểm càng cao càng liên quan"""
+    with tracer.span("faiss", embedded=query_vector is None):
+        if query_vector is not None:
+            # Dùng lại vector đã embed sẵn (ví dụ từ bước tra cache), không embed lại
+            results = vector_store.similarity_search_with_score_by_vector(query_vector, k=k)
+        else:
+            results = vector_store.similarity_search_with_score(query, k=k)
+    if vector_store.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+        return [(doc, float(score)) for doc, score in results]
+    # Khoảng cách L2: càng nhỏ càng gần nên đổi dấu
+    return [(doc, -float(score)) for doc, score in results]
+
+
+def bm25_search_many(bm25_retriever, queries: List[str], k: int) -> List[List[Tuple[Document, float]]]:
+    """Nhánh BM25 cho nhiều câu truy vấn cùng lúc"""
+    if hasattr(bm25_retriever, "search_many"):
+        with tracer.span("bm25", queries=len(queries)):
+            return [[(bm25_retriever.docs[i], float(score)) for i, score in zip(ids, scores)]
+                    for ids, scores in bm25_retriever.search_many(queries, k)]
+    return [bm25_search(bm25_retriever, query, k) for query in queries]
+
+
+def _query_matrix(vector_store, queries: List[str], query_vectors=None) -> np.ndarray:
+    """Ma trận vector câu hỏi (bản sao float32), embed một lần nếu chưa có"""
+    if query_vectors is not None:
+        return np.array(np.atleast_2d(query_vectors), dtype=np.float32)
+    with tracer.span("embedding", queries=len(queries)):
+        return np.array(vector_store.embeddings.embed_documents(queries), dtype=np.float32)
+
+
+def faiss_search_many(vector_store, queries: List[str], k: int,
+                      query_vectors=None) -> List[List[Tuple[Document, float]]]:
+    """Nhánh FAISS cho nhiều câu truy vấn: embed một lần, search một lần với ma trận truy vấn"""
+    vectors = _query_matrix(vector_store, queries, query_vectors)
+    if hasattr(vector_store, "search_many"):
+        # Kho vector nén (QuantizedVectorStore): điểm đã theo quy ước càng cao càng liên quan
+        with tracer.span("faiss", queries=len(queries)):
+            return [[(vector_store.docs[i], float(score)) for i, score in zip(ids, scores)]
+                    for ids, scores in vector_store.search_many(vectors, k)]
+    if vector_store._normalize_L2:
+        faiss.normalize_L2(vectors)
+    with tracer.span("faiss", queries=len(queries)):
+        scores, indices = vector_store.index.search(vectors, k)
+
+    sign = 1.0 if vector_store.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT else -1.0
+    results = []
+    for row_scores, row_indices in zip(scores, indices):
+        row = []
+        for score, i in zip(row_scores, row_indices):
+            if i == -1:
+                continue
+            doc = vector_store.docstore.search(vector_store.index_to_docstore_id[i])
+            row.append((doc, sign * float(score)))
+        results.append(row)
+    return results
+
+
+def chunk_table(bm25_retriever, vector_store) -> Optional[ChunkStore]:
+    """Bảng chunk dạng mảng dùng chung cho hai nhánh, None nếu phải làm việc trên Document
+
+    Cần BM25Index trên ChunkStore, và kho vector cùng thứ tự với bảng hoặc FAISS của LangChain
+    (vị trí vector được ánh xạ sang id chunk qua docstore).
+    """
+    table = getattr(bm25_retriever, "docs", None)
+    if not isinstance(table, ChunkStore) or not hasattr(bm25_retriever, "search_many"):
+        return None
+    if getattr(vector_store, "docs", None) is table or hasattr(vector_store, "index_to_docstore_id"):
+        return table
+    return None
+
+
+def _table_rows(vector_store, table: ChunkStore) -> Optional[np.ndarray]:
+    """Vị trí vector -> id chunk trong bảng (-1 nếu không có), None khi vector đã theo thứ tự bảng
+
+    Với FAISS của LangChain, ánh xạ dựng một lần theo hash nội dung rồi giữ trên kho vector.
+    """
+    if getattr(vector_store, "docs", None) is table:
+        return None
+    rows = getattr(vector_store, "_table_rows", None)
+    if rows is None:
+        # Đọc hash qua bytes thô: phần tử kiểu S20 bị cắt các byte 0 ở cuối
+        width = table.hashes.dtype.itemsize
+        digests = np.ascontiguousarray(table.hashes).tobytes()
+        row_of: Dict[bytes, int] = {}
+        for i in range(len(table)):
+            row_of.setdefault(digests[i * width:(i + 1) * width], i)
+        rows = np.full(vector_store.index.ntotal, -1, dtype=np.int64)
+        for position, doc_id in vector_store.index_to_docstore_id.items():
+            doc = vector_store.docstore.search(doc_id)
+            if isinstance(doc, Document):
+                rows[position] = row_of.get(chunk_hash(doc.page_content), -1)
+        vector_store._table_rows = rows
+    return rows
+
+
+def bm25_search_ids(bm25_retriever, queries: List[str], k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Nhánh BM25 trên bảng chunk: (id chunk, điểm) cho mỗi câu truy vấn"""
+    with tracer.span("bm25", queries=len(queries)):
+        return bm25_retriever.search_many(queries, k)
+
+
+def faiss_search_ids(vector_store, table: ChunkStore, queries: List[str], k: int,
+                     query_vectors=None) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Nhánh FAISS trên bảng chunk: (id chunk, điểm càng cao càng gần) cho mỗi câu truy vấn"""
+    vectors = _query_matrix(vector_store, queries, query_vectors)
+    rows = _table_rows(vector_store, table)
+    if rows is None:
+        # SharedVectorStore / QuantizedVectorStore: vị trí vector chính là id chunk
+        with tracer.span("faiss", queries=len(queries)):
+            return vector_store.search_many(vectors, k)
+    if vector_store._normalize_L2:
+        faiss.normalize_L2(vectors)
+    with tracer.span("faiss", queries=len(queries)):
+        scores, positions = vector_store.index.search(vectors, k)
+
+    sign = 1.0 if vector_store.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT else -1.0
+    results = []
+    for row_scores, row_positions in zip(scores, positions):
+        ids = np.where(row_positions >= 0, rows[row_positions], -1)
+        keep = ids >= 0
+        results.append((ids[keep], sign * row_scores[keep]))
+    return results
+
+
+def dedupe_queries(queries: List[str]) -> List[str]:
+    """Bỏ biến thể rỗng hoặc trùng lặp, giữ nguyên thứ tự"""
+    seen = set()
+    unique = []
+    for query in queries:
+        query = query.strip()
+        if query and query not in seen:
+            seen.add(query)
+            unique.append(query)
+    return unique
+
+
+def _normalize(results: List[Tuple[Document, float]]) -> List[float]:
+    """Chuẩn hóa min-max điểm của một nhánh về [0, 1]"""
+    if not results:
+        return []
+    scores = [score for _, score in results]
+    low, high = min(scores), max(scores)
+    if high == low:
+        return [1.0] * len(scores)
+    return [(score - low) / (high - low) for score in scores]
+
+
+def _normalize_scores(scores: np.ndarray) -> np.ndarray:
+    """Chuẩn hóa min-max mảng điểm của một nhánh về [0, 1]"""
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(scores) == 0:
+        return scores
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+def fuse_results(legs: List[Tuple[List[Tuple[Document, float]], float]],
+                 method: str = "rrf", rrf_k: int = 60) -> List[Tuple[Document, float]]:
+    """Kết hợp kết quả các nhánh theo RRF hoặc điểm chuẩn hóa có trọng số, loại trùng theo nội dung"""
+    fused: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+    for results, weight in legs:
+        if method == "rrf":
+            contributions = [weight / (rrf_k + rank + 1) for rank in range(len(results))]
+        elif method == "weighted":
+            contributions = [weight * score for score in _normalize(results)]
+        else:
+            raise ValueError(f"Phương pháp kết hợp không hợp lệ: {method}")
+
+        for (doc, _), contribution in zip(results, contributions):
+            key = doc.page_content
+            docs.setdefault(key, doc)
+            fused[key] = fused.get(key, 0.0) + contribution
+
+    ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+    return [(docs[key], score) for key, score in ranked]
+
+
+def fuse_ids(legs: List[Tuple[np.ndarray, np.ndarray, float]],
+             method: str = "rrf", rrf_k: int = 60) -> Tuple[np.ndarray, np.ndarray]:
+    """Như fuse_results nhưng trên id chunk: (id, điểm kết hợp) giảm dần
+
+    Các nhánh nối thành một mảng, cộng dồn đóng góp bằng bincount; điểm bằng nhau giữ thứ tự xuất hiện.
+    """
+    if method not in ("rrf", "weighted"):
+        raise ValueError(f"Phương pháp kết hợp không hợp lệ: {method}")
+    all_ids, contributions = [], []
+    for ids, scores, weight in legs:
+        if len(ids) == 0:
+            continue
+        if method == "rrf":
+            contributions.append(weight / (rrf_k + np.arange(1, len(ids) + 1, dtype=np.float64)))
+        else:
+            contributions.append(weight * _normalize_scores(scores))
+        all_ids.append(np.asarray(ids, dtype=np.int64))
+    if not all_ids:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    unique, first, inverse = np.unique(np.concatenate(all_ids), return_index=True, return_inverse=True)
+    fused = np.bincount(inverse.reshape(-1), weights=np.concatenate(contributions), minlength=len(unique))
+    order = np.lexsort((first, -fused))
+    return unique[order], fused[order]
+
+
+def _positions(vector_store) -> Dict[str, int]:
+    """Nội dung chunk -> vị trí vector trong index, dựng một lần cho mỗi kho vector"""
+    positions = getattr(vector_store, "_mmr_positions", None)
+    if positions is None:
+        if hasattr(vector_store, "docs"):
+            docs = vector_store.docs
+            texts = (docs.text(i) if hasattr(docs, "text") else docs[i].page_content for i in range(len(docs)))
+        else:
+            texts = (vector_store.docstore.search(vector_store.index_to_docstore_id[i]).page_content
+                     for i in range(vector_store.index.ntotal))
+        positions = {}
+        for i, text in enumerate(texts):
+            positions.setdefault(text, i)
+        vector_store._mmr_positions = positions
+    return positions
+
+
+def stored_vectors(vector_store, docs: List[Document]) -> Optional[np.ndarray]:
+    """Vector đã lưu của các chunk ứng viên, không embed lại"""
+    positions = _positions(vector_store)
+    ids = np.array([positions.get(doc.page_content, -1) for doc in docs], dtype=np.int64)
+    return _gather_vectors(vector_store, ids, lambda: [doc.page_content for doc in docs])
+
+
+def _reconstruct(index, positions: np.ndarray) -> Optional[np.ndarray]:
+    """Dựng lại vector từ index; IVF cần direct map (IVF-PQ cho vector xấp xỉ), None nếu không được"""
+    try:
+        return index.reconstruct_batch(positions)
+    except RuntimeError:
+        pass
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return None
+    with _direct_map_lock:
+        try:
+            return index.reconstruct_batch(positions)
+        except RuntimeError:
+            ivf.make_direct_map()
+    return index.reconstruct_batch(positions)
+
+
+def _gather_vectors(vector_store, positions: np.ndarray,
+                    texts: Callable[[], List[str]]) -> Optional[np.ndarray]:
+    """Vector đã lưu tại các vị trí trong index, không bao giờ embed lại trên đường trả lời câu hỏi
+
+    Thứ tự: vector float32 mmap của kho nén, vector dựng lại từ index Flat/HNSW, vector trong file
+    cache embedding (`texts()` chỉ được gọi lúc này), cuối cùng vector dựng lại từ IVF. None nếu không có.
+    """
+    found = (positions >= 0).all()
+    if found and isinstance(getattr(vector_store, "vectors", None), np.ndarray):
+        # QuantizedVectorStore giữ vector float32 gốc (mmap) để rerank
+        return np.asarray(vector_store.vectors[np.sort(positions)])[np.argsort(np.argsort(positions))]
+    index = getattr(vector_store, "index", None)
+    if found and index is not None and faiss.try_extract_index_ivf(index) is None:
+        vectors = _reconstruct(index, positions)
+        if vectors is not None:
+            return vectors
+    # Index nén (IVF-PQ...) chỉ dựng lại được vector xấp xỉ: ưu tiên bản chính xác trong cache embedding
+    cached = getattr(vector_store.embeddings, "cached", None)
+    vectors = cached(texts()) if cached is not None else None
+    if vectors is None and found and index is not None:
+        vectors = _reconstruct(index, positions)
+    return vectors
+
+
+def table_vectors(vector_store, table: ChunkStore, ids: np.ndarray) -> Optional[np.ndarray]:
+    """Vector đã lưu của các chunk theo id trong bảng chunk"""
+    rows = _table_rows(vector_store, table)
+    if rows is None:
+        positions = np.asarray(ids, dtype=np.int64)
+    else:
+        position_of = getattr(vector_store, "_table_positions", None)
+        if position_of is None:
+            # Nghịch đảo của _table_rows: id chunk -> vị trí vector (-1 nếu không có)
+            position_of = np.full(len(table), -1, dtype=np.int64)
+            found = np.flatnonzero(rows >= 0)
+            position_of[rows[found[::-1]]] = found[::-1]
+            vector_store._table_positions = position_of
+        positions = position_of[ids]
+    return _gather_vectors(vector_store, positions, lambda: [table.text(int(i)) for i in ids])
+
+
+def mmr_select(query_vectors: np.ndarray, vectors: np.ndarray, k: int,
+               lambda_mult: float = MMR_LAMBDA) -> List[int]:
+    """Maximal marginal relevance: chọn lần lượt ứng viên có λ·cos(câu hỏi) − (1−λ)·cos lớn nhất với tập đã chọn
+
+    Cosine giữa câu hỏi và các ứng viên, giữa các ứng viên với nhau tính trong một phép nhân ma trận;
+    mỗi bước chỉ cập nhật độ giống lớn nhất với tập đã chọn. Nhiều câu hỏi (biến thể) thì lấy cosine lớn nhất.
+    """
+    n = len(vectors)
+    if n == 0 or k <= 0:
+        return []
+    query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+    stacked = np.vstack([query_vectors, np.asarray(vectors, dtype=np.float32)])
+    norms = np.linalg.norm(stacked, axis=1, keepdims=True)
+    unit = stacked / np.where(norms > 0, norms, 1.0)
+    cosine = unit[len(query_vectors):] @ unit.T
+    relevance = cosine[:, :len(query_vectors)].max(axis=1)
+    similarity = cosine[:, len(query_vectors):]
+
+    selected = [int(np.argmax(relevance))]
+    chosen = np.zeros(n, dtype=bool)
+    chosen[selected[0]] = True
+    max_similarity = similarity[selected[0]].copy()
+    for _ in range(min(k, n) - 1):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[chosen] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        chosen[best] = True
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return selected
+
+
+def diversify(vector_store, fused: List[Tuple[Document, float]], query_vectors, k: int,
+              lambda_mult: float = MMR_LAMBDA) -> List[Tuple[Document, float]]:
+    """Chọn lại k chunk từ tập ứng viên đã kết hợp theo MMR, giữ điểm kết hợp ban đầu"""
+    if len(fused) <= 1:
+        return fused[:k]
+    with tracer.span("mmr", pool=len(fused)):
+        vectors = stored_vectors(vector_store, [doc for doc, _ in fused])
+        if vectors is None:
+            return fused[:k]
+        selected = mmr_select(query_vectors, vectors, k, lambda_mult)
+    return [fused[i] for i in selected]
+
+
+def diversify_ids(vector_store, table: ChunkStore, ids: np.ndarray, scores: np.ndarray, query_vectors,
+                  k: int, lambda_mult: float = MMR_LAMBDA) -> Tuple[np.ndarray, np.ndarray]:
+    """Như diversify nhưng trên id chunk của bảng"""
+    if len(ids) <= 1:
+        return ids[:k], scores[:k]
+    with tracer.span("mmr", pool=len(ids)):
+        vectors = table_vectors(vector_store, table, ids)
+        if vectors is None:
+            return ids[:k], scores[:k]
+        selected = mmr_select(query_vectors, vectors, k, lambda_mult)
+    return ids[selected], scores[selected]
+
+
+class HybridRetriever:
+    """Tìm kiếm lai BM25 + FAISS: hai nhánh chạy song song, kết hợp theo điểm
+
+    Khi có bảng chunk (ChunkStore), hai nhánh chỉ trả về id + điểm; Document chỉ được dựng cho top-k cuối.
+    """
+
+    def __init__(self, bm25_retriever, vector_store,
+                 k: int = 5,
+                 bm25_k: int = 5,
+                 faiss_k: int = 5,
+                 bm25_weight: float = 0.5,
+                 faiss_weight: float = 0.5,
+                 fusion: str = "rrf",
+                 rrf_k: int = 60,
+                 mmr_lambda: Optional[float] = None,
+                 mmr_pool: int = MMR_POOL):
+        self.bm25_retriever = bm25_retriever
+        self.vector_store = vector_store
+        self.k = k
+        self.bm25_k = bm25_k
+        self.faiss_k = faiss_k
+        self.bm25_weight = bm25_weight
+        self.faiss_weight = faiss_weight
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        # mmr_lambda=None: giữ thứ tự kết hợp, không đa dạng hóa
+        self.mmr_lambda = mmr_lambda
+        self.mmr_pool = mmr_pool
+        self.table = chunk_table(bm25_retriever, vector_store)
+
+    def max_score(self) -> float:
+        """Điểm kết hợp lớn nhất có thể (chunk đứng đầu cả hai nhánh), để quy điểm về [0, 1]"""
+        weights = self.bm25_weight + self.faiss_weight
+        return weights / (self.rrf_k + 1) if self.fusion == "rrf" else weights
+
+    def _leg_k(self, k: int) -> int:
+        # Khi dùng MMR, mỗi nhánh lấy đủ để tạo tập ứng viên lớn hơn k
+        return max(k, self.mmr_pool) if self.mmr_lambda is not None else k
+
+    def _submit_faiss(self, search: Callable, queries: List[str], query_vectors):
+        """Gửi nhánh FAISS vào pool, trả về future của (kết quả, vector câu hỏi)
+
+        Khi MMR cần vector câu hỏi, câu hỏi được embed ngay trên thread của nhánh FAISS
+        (nhánh BM25 vẫn chạy song song) và vector đó được dùng lại cho bước MMR.
+        """
+        def leg():
+            vectors = query_vectors
+            if vectors is not None or self.mmr_lambda is not None:
+                vectors = _query_matrix(self.vector_store, queries, query_vectors)
+            return search(vectors), vectors
+        return _executor.submit(tracer.wrap(leg))
+
+    def _select(self, fused: List[Tuple[Document, float]], query_vectors, k: int) -> List[Tuple[Document, float]]:
+        if self.mmr_lambda is None:
+            return fused[:k]
+        return diversify(self.vector_store, fused[:self.mmr_pool], query_vectors, k, self.mmr_lambda)
+
+    def search_ids(self, queries: List[str], k: Optional[int] = None,
+                   query_vectors=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Tìm kiếm trên bảng chunk: (id chunk, điểm kết hợp), loại trùng và kết hợp trên số nguyên"""
+        faiss_future = self._submit_faiss(
+            lambda vectors: faiss_search_ids(self.vector_store, self.table, queries, self._leg_k(self.faiss_k),
+                                             vectors), queries, query_vectors)
+        bm25_results = bm25_search_ids(self.bm25_retriever, queries, self._leg_k(self.bm25_k))
+        faiss_results, query_vectors = faiss_future.result()
+
+        # Chunk trùng nội dung quy về cùng một id trước khi kết hợp
+        canonical = self.table.canonical_ids()
+        legs = [(canonical[ids], scores, self.bm25_weight) for ids, scores in bm25_results]
+        legs += [(canonical[ids], scores, self.faiss_weight) for ids, scores in faiss_results]
+        ids, scores = fuse_ids(legs, method=self.fusion, rrf_k=self.rrf_k)
+        k = k or self.k
+        if self.mmr_lambda is None:
+            return ids[:k], scores[:k]
+        return diversify_ids(self.vector_store, self.table, ids[:self.mmr_pool], scores[:self.mmr_pool],
+                             query_vectors, k, self.mmr_lambda)
+
+    def rank_ids(self, ids, query_vectors, k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Xếp hạng lại một tập id chunk có sẵn theo cosine với câu hỏi, không chạy hai nhánh tìm kiếm"""
+        merged = self.table.canonical_ids()[np.asarray(ids, dtype=np.int64)]
+        _, first = np.unique(merged, return_index=True)
+        ids = merged[np.sort(first)]
+        k = k or self.k
+        if len(ids) == 0:
+            return ids, np.zeros(0, dtype=np.float32)
+        with tracer.span("warm_rank", pool=len(ids)):
+            vectors = table_vectors(self.vector_store, self.table, ids)
+            if vectors is None:
+                # Không có vector đã lưu: giữ thứ tự của tập chunk ấm (mới nhất trước)
+                scores = 1.0 / np.arange(1, min(k, len(ids)) + 1)
+                return ids[:k], scores
+            queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+            unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+            scores = (unit @ queries.T).max(axis=1)
+            order = np.argsort(-scores, kind="stable")
+        if self.mmr_lambda is None:
+            return ids[order[:k]], scores[order[:k]]
+        pool = order[:self.mmr_pool]
+        return diversify_ids(self.vector_store, self.table, ids[pool], scores[pool], queries, k, self.mmr_lambda)
+
+    def documents(self, ids: np.ndarray, scores: np.ndarray) -> List[Tuple[Document, float]]:
+        """Dựng (document, điểm) từ bảng chunk cho kết quả cuối"""
+        return [(self.table.document(int(i)), float(score)) for i, score in zip(ids, scores)]
+
+    def search_with_scores(self, query: str, k: Optional[int] = None,
+                           query_vector=None) -> List[Tuple[Document, float]]:
+        """Chạy song song hai nhánh và trả về (document, điểm kết hợp)"""
+        if self.table is not None:
+            return self.documents(*self.search_ids([query], k, query_vector))
+        # Nhánh FAISS chậm hơn (embedding + search) nên gửi vào pool trước,
+        # nhánh BM25 chạy ngay trên thread hiện tại trong lúc chờ
+        faiss_future = self._submit_faiss(
+            lambda vectors: faiss_search(self.vector_store, query, self._leg_k(self.faiss_k),
+                                         None if vectors is None else vectors[0]), [query], query_vector)
+        bm25_results = bm25_search(self.bm25_retriever, query, self._leg_k(self.bm25_k))
+        faiss_results, query_vector = faiss_future.result()
+
+        fused = fuse_results(
+            [(bm25_results, self.bm25_weight), (faiss_results, self.faiss_weight)],
+            method=self.fusion,
+            rrf_k=self.rrf_k
+        )
+        return self._select(fused, query_vector, k or self.k)
+
+    def search_many(self, queries: List[str], k: Optional[int] = None) -> List[Tuple[Document, float]]:
+        """Tìm kiếm gộp cho nhiều biến thể câu hỏi: một lần embed, một lần search mỗi nhánh"""
+        queries = dedupe_queries(queries)
+        if not queries:
+            return []
+        if self.table is not None:
+            return self.documents(*self.search_ids(queries, k))
+        faiss_future = self._submit_faiss(
+            lambda vectors: faiss_search_many(self.vector_store, queries, self._leg_k(self.faiss_k), vectors),
+            queries, None)
+        bm25_results = bm25_search_many(self.bm25_retriever, queries, self._leg_k(self.bm25_k))
+        faiss_results, query_vectors = faiss_future.result()
+
+        legs = [(results, self.bm25_weight) for results in bm25_results]
+        legs += [(results, self.faiss_weight) for results in faiss_results]
+        fused = fuse_results(legs, method=self.fusion, rrf_k=self.rrf_k)
+        return self._select(fused, query_vectors, k or self.k)
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        return [doc for doc, _ in self.search_with_scores(query)]
+
+    def invoke(self, query: str) -> List[Document]:
+        return self.get_relevant_documents(query)
+
+
+def hybrid_search(query: str, bm25_retriever, vector_store, k: int = 5, **kwargs) -> List[Document]:
+    """Hybrid search dùng chung cho utils, query và BM25_FAISS_query"""
+    retriever = HybridRetriever(bm25_retriever, vector_store, k=k, **kwargs)
+    return retriever.get_relevant_documents(query)
@@ -0,0 +1,188 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+from typing import List, Optional, Tuple
+
+from langchain_community.vectorstores import FAISS
+
+from bm25_index import BM25_INDEX_PATH, BM25Index, load_bm25_index
+from chunk_store import CHUNK_STORE_PATH, SPLITTER_CONFIG, load_chunk_store
+from faiss_index import apply_index_params, delete_ids, rebuild_index
+from generations import current_path
+from ingest import CHECKPOINT_PATH, EMBED_BATCH_SIZE, embed_in_batches, job_key
+from model_registry import EMBEDDING_MODEL, get_embeddings
+from shared_index import SHARED_FAISS_PATH, SharedVectorStore, save_shared_index, store_signature
+
+# Cau hinh
+DATA_DIR = "data"
+VECTOR_DB_PATH = "vectorstores/db_faiss"
+MANIFEST_PATH = "vectorstores/manifest.json"
+
+
+def list_pdfs(data_dir: str = DATA_DIR) -> List[str]:
+    """Liệt kê các file PDF trong thư mục dữ liệu"""
+    return sorted(glob.glob(os.path.join(data_dir, "*.pdf")))
+
+
+def load_manifest(path: str = MANIFEST_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, path: str = MANIFEST_PATH) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def sync_index(embeddings,
+               data_dir: str = DATA_DIR,
+               db_path: str = VECTOR_DB_PATH,
+               manifest_path: str = MANIFEST_PATH,
+               store_path: str = CHUNK_STORE_PATH,
+               bm25_path: str = BM25_INDEX_PATH,
+               shared_path: str = SHARED_FAISS_PATH,
+               batch_size: int = EMBED_BATCH_SIZE,
+               workers: Optional[int] = None,
+               checkpoint_path: str = CHECKPOINT_PATH) -> Tuple[BM25Index, FAISS, dict]:
+    """Đồng bộ index với thư mục PDF: chỉ embed chunk mới, xóa vector của chunk đã mất
+
+    PDF được đọc song song (`workers` process) và chunk được ghi thẳng vào kho chunk;
+    chunk được đọc lại theo chỉ số và embed theo batch `batch_size` (không giữ danh sách Document),
+    có checkpoint để chạy lại sau khi bị ngắt không phải embed lại từ đầu.
+    """
+    start = time.perf_counter()
+    pdf_paths = list_pdfs(data_dir)
+    store = load_chunk_store(pdf_paths, store_path, workers=workers)
+    chunk_ids = store.chunk_ids()
+
+    manifest = load_manifest(manifest_path)
+    index_exists = os.path.exists(os.path.join(db_path, "index.faiss"))
+    # Chỉ cập nhật từng phần khi index cũ được tạo cùng model embedding và cấu hình splitter
+    reusable = (
+        index_exists
+        and manifest.get("embedding_model") == EMBEDDING_MODEL
+        and manifest.get("splitter") == json.loads(json.dumps(SPLITTER_CONFIG))
+    )
+    indexed_ids = set()
+    if reusable:
+        for info in manifest.get("files", {}).values():
+            indexed_ids.update(info["chunk_ids"])
+
+    current_ids = set(chunk_ids)
+    new_rows = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id not in indexed_ids]
+    stale_ids = sorted(indexed_ids - current_ids)
+
+    def pairs(rows):
+        return ((chunk_ids[i], store.document(i)) for i in rows)
+
+    embed_stats = {"chunks": 0, "chunks_per_s": 0.0, "resumed_from": 0}
+    if reusable:
+        vector_store = FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
+        apply_index_params(vector_store, db_path)
+        if stale_ids:
+            delete_ids(vector_store, stale_ids, db_path)
+        if new_rows:
+            key = job_key("add", EMBEDDING_MODEL, stale_ids, [chunk_ids[i] for i in new_rows])
+            vector_store, embed_stats = embed_in_batches(vector_store, embeddings, pairs(new_rows), key,
+                                                         batch_size, checkpoint_path, total=len(new_rows))
+    else:
+        if not len(store):
+            raise ValueError(f"Không có chunk nào để index trong {data_dir}")
+        key = job_key("full", EMBEDDING_MODEL, chunk_ids)
+        vector_store, embed_stats = embed_in_batches(
+            None, embeddings, pairs(range(len(store))), key, batch_size, checkpoint_path,
+            total=len(store), distance_strategy="METRIC_INNER_PRODUCT"
+        )
+        # Giữ loại index (HNSW/IVF...) đã chọn bằng faiss_index.py
+        rebuild_index(vector_store, db_path)
+    if new_rows or stale_ids or not reusable:
+        vector_store.save_local(db_path)
+
+    # BM25 chỉ cần tách từ, không cần embedding: index được dựng lại khi kho chunk thay đổi
+    bm25_retriever = load_bm25_index(store, bm25_path)
+
+    # Bản FAISS theo thứ tự kho chunk cho các worker mở bằng mmap (shared_index.py)
+    if SharedVectorStore.load(shared_path, signature=store_signature(store, embeddings, db_path)) is None:
+        save_shared_index(store, vector_store, embeddings, shared_path, db_path)
+
+    files = {}
+    for chunk_id, source_id in zip(chunk_ids, store.source_ids):
+        source = store.sources[source_id]
+        if source not in files:
+            files[source] = {"sha256": store.meta["sources"][source]["sha256"], "chunk_ids": []}
+        files[source]["chunk_ids"].append(chunk_id)
+    save_manifest({
+        "embedding_model": EMBEDDING_MODEL,
+        "splitter": SPLITTER_CONFIG,
+        "updated_at": time.time(),
+        "files": files,
+    }, manifest_path)
+
+    report = {
+        "files": len(pdf_paths),
+        "chunks": len(store),
+        "embedded": len(new_rows) if reusable else len(store),
+        "removed": len(stale_ids),
+        "full_rebuild": not reusable,
+        "resumed_from": embed_stats["resumed_from"],
+        "chunks_per_s": embed_stats["chunks_per_s"],
+        "seconds": time.perf_counter() - start,
+    }
+    print(f"📚 Index: {report['files']} file, {report['chunks']} chunks | "
+          f"embed mới: {report['embedded']} ({report['chunks_per_s']:.1f} chunks/s) | "
+          f"xóa: {report['removed']} | {report['seconds']:.1f}s")
+    return bm25_retriever, vector_store, report
+
+
+def index_version(db_path: str = VECTOR_DB_PATH, store_path: str = CHUNK_STORE_PATH) -> str:
+    """Phiên bản hiện tại của kho chunk + FAISS index, đổi mỗi khi index được cập nhật"""
+    digest = hashlib.sha1()
+    # Mỗi lần ghi kho chunk tạo một thư mục thế hệ mới nên đường dẫn đã đổi theo phiên bản
+    for path in (os.path.join(current_path(store_path), "meta.json"), os.path.join(db_path, "index.faiss")):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _snapshot(data_dir: str) -> dict:
+    return {path: (os.stat(path).st_size, os.stat(path).st_mtime) for path in list_pdfs(data_dir)}
+
+
+def watch(embeddings, data_dir: str = DATA_DIR, interval: float = 5.0) -> None:
+    """Theo dõi thư mục dữ liệu và đồng bộ index mỗi khi có PDF thay đổi"""
+    sync_index(embeddings, data_dir)
+    last = _snapshot(data_dir)
+    print(f"👀 Đang theo dõi thư mục {data_dir} (Ctrl+C để dừng)...")
+    try:
+        while True:
+            time.sleep(interval)
+            current = _snapshot(data_dir)
+            if current != last:
+                sync_index(embeddings, data_dir)
+                last = current
+    except KeyboardInterrupt:
+        print("\n👋 Dừng theo dõi.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Đồng bộ index BM25/FAISS với thư mục PDF")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--watch", action="store_true", help="Theo dõi thư mục và cập nhật liên tục")
+    parser.add_argument("--interval", type=float, default=5.0)
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Số chunk mỗi lần embed")
+    parser.add_argument("--workers", type=int, help="Số process đọc PDF (mặc định theo số CPU)")
+    args = parser.parse_args()
+
+    embeddings = get_embeddings()
+    if args.watch:
+        watch(embeddings, args.data_dir, args.interval)
+    else:
+        sync_index(embeddings, args.data_dir, batch_size=args.batch_size, workers=args.workers)
@@ -0,0 +1,131 @@
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import time
+from typing import Iterable, Iterator, Optional, Tuple
+
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+# Cau hinh
+EMBED_BATCH_SIZE = 64
+CHECKPOINT_PATH = "vectorstores/ingest_checkpoint"
+# Lưu checkpoint sau mỗi N batch (lưu FAISS index tốn I/O nên không lưu sau từng batch)
+CHECKPOINT_EVERY = 8
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def job_key(*parts) -> str:
+    """Khóa của một lượt ingest: checkpoint chỉ được dùng lại cho đúng lượt đó"""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class IngestProgress:
+    """In tiến độ và tốc độ (chunks/s) tối đa mỗi `interval` giây"""
+
+    def __init__(self, total: int, done: int = 0, interval: float = 1.0):
+        self.total = total
+        self.done = done
+        self.resumed = done
+        self.interval = interval
+        self.start = time.perf_counter()
+        self._last_print = 0.0
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.perf_counter() - self.start
+        return (self.done - self.resumed) / elapsed if elapsed > 0 else 0.0
+
+    def update(self, n: int) -> None:
+        self.done += n
+        now = time.perf_counter()
+        if now - self._last_print >= self.interval or self.done == self.total:
+            self._last_print = now
+            print(f"\r🧮 Embedding: {self.done}/{self.total} chunks | {self.rate:.1f} chunks/s",
+                  end="", flush=True)
+
+    def finish(self) -> dict:
+        if self.done > self.resumed:
+            print()
+        return {"chunks": self.done - self.resumed, "seconds": time.perf_counter() - self.start,
+                "chunks_per_s": self.rate, "resumed_from": self.resumed}
+
+
+def _load_checkpoint(path: str, key: str, embeddings) -> Tuple[Optional[FAISS], int]:
+    state_path = os.path.join(path, "state.json")
+    if not os.path.exists(state_path):
+        return None, 0
+    with open(state_path, encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get("key") != key:
+        return None, 0
+    vector_store = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    return vector_store, state["committed"]
+
+
+def _save_checkpoint(path: str, key: str, vector_store: FAISS, committed: int) -> None:
+    # Ghi ra thư mục tạm rồi mới thay thế: bị ngắt giữa chừng thì index và state không lệch nhau
+    tmp_path = path + ".tmp"
+    vector_store.save_local(tmp_path)
+    with open(os.path.join(tmp_path, "state.json"), "w", encoding="utf-8") as f:
+        json.dump({"key": key, "committed": committed, "saved_at": time.time()}, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def embed_in_batches(vector_store: Optional[FAISS],
+                     embeddings,
+                     pairs: Iterable[Tuple[str, Document]],
+                     key: str,
+                     batch_size: int = EMBED_BATCH_SIZE,
+                     checkpoint_path: str = CHECKPOINT_PATH,
+                     checkpoint_every: int = CHECKPOINT_EVERY,
+                     total: Optional[int] = None,
+                     **faiss_kwargs) -> Tuple[Optional[FAISS], dict]:
+    """Embed (chunk_id, document) theo từng batch giới hạn và thêm dần vào index
+
+    `pairs` có thể là generator (kèm `total`): mỗi lần chỉ một batch Document được tạo ra.
+    Định kỳ lưu checkpoint; chạy lại cùng lượt (cùng `key`) sau khi bị ngắt sẽ tiếp tục
+    từ batch cuối cùng đã lưu thay vì embed lại từ đầu.
+    """
+    total = len(pairs) if total is None else total
+    restored, committed = _load_checkpoint(checkpoint_path, key, embeddings)
+    if restored is not None:
+        print(f"♻️ Tiếp tục từ checkpoint: {committed}/{total} chunks đã embed")
+        vector_store = restored
+
+    progress = IngestProgress(total, committed)
+    for n_batches, batch in enumerate(batched(itertools.islice(pairs, committed, None), batch_size), start=1):
+        ids = [chunk_id for chunk_id, _ in batch]
+        texts = [doc.page_content for _, doc in batch]
+        metadatas = [doc.metadata for _, doc in batch]
+        text_embeddings = list(zip(texts, embeddings.embed_documents(texts)))
+        if vector_store is None:
+            vector_store = FAISS.from_embeddings(text_embeddings, embeddings, metadatas, ids, **faiss_kwargs)
+        else:
+            vector_store.add_embeddings(text_embeddings, metadatas, ids)
+        committed += len(batch)
+        progress.update(len(batch))
+        if n_batches % checkpoint_every == 0 and committed < total:
+            _save_checkpoint(checkpoint_path, key, vector_store, committed)
+
+    if os.path.exists(checkpoint_path):
+        shutil.rmtree(checkpoint_path)
+    return vector_store, progress.finish()
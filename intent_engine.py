@@ -0,0 +1,135 @@
+import re
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+# Ký tự đặc biệt của regex, pattern chứa các ký tự này không phải danh sách từ khóa thuần
+_REGEX_META = set(".^$*+?{}[]\\|()")
+
+
+class IntentMatch(NamedTuple):
+    chitchat_intents: List[str]
+    doc_intents: List[str]
+    chitchat_score: float
+    doc_score: float
+
+
+def split_literal_alternation(pattern: str) -> Optional[List[str]]:
+    """Tách pattern dạng '(a|b|c)' thành danh sách từ khóa, trả về None nếu là regex phức tạp"""
+    body = pattern
+    if body.startswith("(") and body.endswith(")"):
+        body = body[1:-1]
+    keywords = body.split("|")
+    for keyword in keywords:
+        if not keyword or any(char in _REGEX_META for char in keyword):
+            return None
+    return keywords
+
+
+def _trie_to_regex(node: dict) -> str:
+    """Chuyển trie thành regex, nhánh sâu nhất được ưu tiên (greedy)"""
+    is_end = "" in node
+    branches = [re.escape(char) + _trie_to_regex(child)
+                for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ""
+    if len(branches) == 1:
+        body = branches[0]
+    else:
+        body = "(?:" + "|".join(branches) + ")"
+    if is_end:
+        return "(?:" + body + ")?"
+    return body
+
+
+class IntentEngine:
+    """Bộ nhận diện intent biên dịch sẵn: quét câu hỏi một lần cho tất cả pattern"""
+
+    def __init__(self,
+                 chitchat_patterns: Dict[str, str],
+                 doc_patterns: Dict[str, str],
+                 chitchat_weights: Optional[Dict[str, float]] = None,
+                 doc_weights: Optional[Dict[str, float]] = None):
+        self.weights = {
+            "chitchat": chitchat_weights or {},
+            "doc": doc_weights or {},
+        }
+        # Thứ tự intent giữ nguyên thứ tự khai báo trong PatternManager
+        self._order: Dict[str, List[str]] = {"chitchat": [], "doc": []}
+        self._keywords: Dict[str, Set[Tuple[str, str]]] = {}
+        self._intent_keywords: Dict[Tuple[str, str], List[str]] = {}
+        self._fallback: Dict[Tuple[str, str], re.Pattern] = {}
+        self._regex: Optional[re.Pattern] = None
+        self._labels: Dict[str, Set[Tuple[str, str]]] = {}
+
+        for intent, pattern in chitchat_patterns.items():
+            self.set_pattern("chitchat", intent, pattern)
+        for intent, pattern in doc_patterns.items():
+            self.set_pattern("doc", intent, pattern)
+
+    def set_pattern(self, group: str, intent: str, pattern: str) -> None:
+        """Thêm hoặc thay pattern của một intent, chỉ cập nhật phần từ khóa của intent đó"""
+        label = (group, intent)
+        if intent not in self._order[group]:
+            self._order[group].append(intent)
+
+        # Gỡ từ khóa cũ của intent
+        for keyword in self._intent_keywords.pop(label, []):
+            owners = self._keywords.get(keyword)
+            if owners is not None:
+                owners.discard(label)
+                if not owners:
+                    del self._keywords[keyword]
+        self._fallback.pop(label, None)
+
+        keywords = split_literal_alternation(pattern)
+        if keywords is None:
+            # Regex phức tạp: giữ lại để search riêng
+            self._fallback[label] = re.compile(pattern)
+        else:
+            self._intent_keywords[label] = keywords
+            for keyword in keywords:
+                self._keywords.setdefault(keyword, set()).add(label)
+
+        # Biên dịch lại lần sau khi match
+        self._regex = None
+
+    def _compile(self) -> None:
+        trie: dict = {}
+        for keyword in self._keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[""] = True
+
+        # Mỗi từ khóa dài nhất tìm được tại một vị trí kéo theo các từ khóa là tiền tố của nó
+        self._labels = {}
+        for keyword in self._keywords:
+            labels: Set[Tuple[str, str]] = set()
+            for end in range(1, len(keyword) + 1):
+                labels |= self._keywords.get(keyword[:end], set())
+            self._labels[keyword] = labels
+
+        body = _trie_to_regex(trie)
+        # Lookahead để tìm được từ khóa bắt đầu ở mọi vị trí, kể cả chồng lấn nhau
+        self._regex = re.compile("(?=(" + body + "))") if body else re.compile(r"(?!x)x")
+
+    def match(self, text: str) -> IntentMatch:
+        """Quét câu hỏi một lần, trả về mọi intent khớp và điểm có trọng số"""
+        if self._regex is None:
+            self._compile()
+
+        matched: Set[Tuple[str, str]] = set()
+        for found in self._regex.finditer(text):
+            keyword = found.group(1)
+            if keyword:
+                matched |= self._labels[keyword]
+        for label, regex in self._fallback.items():
+            if label not in matched and regex.search(text):
+                matched.add(label)
+
+        chitchat_intents = [intent for intent in self._order["chitchat"]
+                            if ("chitchat", intent) in matched]
+        doc_intents = [intent for intent in self._order["doc"]
+                       if ("doc", intent) in matched]
+        chitchat_score = sum(self.weights["chitchat"].get(intent, 1.0) for intent in chitchat_intents)
+        doc_score = sum(self.weights["doc"].get(intent, 1.0) for intent in doc_intents)
+        return IntentMatch(chitchat_intents, doc_intents, chitchat_score, doc_score)
@@ -0,0 +1,38 @@
+import bisect
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+
+class Histogram:
+    """Đếm số mẫu theo khoảng (bucket) cố định, an toàn khi nhiều thread cùng ghi
+
+    `buckets` là các cận trên tăng dần; mẫu lớn hơn cận cuối rơi vào bucket "+Inf".
+    """
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def totals(self) -> Tuple[List[int], float, int]:
+        """(số mẫu mỗi bucket, tổng, số mẫu) đọc cùng một lúc"""
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            labels = [f"<={bound:g}" for bound in self.buckets] + ["+Inf"]
+            return {"count": self.count,
+                    "mean": self.sum / self.count if self.count else 0.0,
+                    "max": self.max,
+                    "buckets": dict(zip(labels, self.counts))}
@@ -0,0 +1,144 @@
+import gc
+import os
+import threading
+import time
+
+from langchain_community.embeddings import GPT4AllEmbeddings
+from langchain_community.llms import LlamaCpp
+
+from embedding_batcher import MicroBatchEmbeddings
+from embedding_cache import CachedEmbeddings
+from tracing import tracer
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Cau hinh mac dinh cho VinaLLaMA
+MODEL_PATH = "models/vinallama-7b-chat_q5_0.gguf"
+EMBEDDING_MODEL = "models/vinallama-7b-chat_q5_0.gguf"
+LLM_CONFIG = {
+    "temperature": 0.3,
+    "max_tokens": 512,
+    "n_ctx": 2048,
+    "top_p": 0.9,
+    "verbose": False,
+    "n_gpu_layers": 32,
+    "n_batch": 512,
+}
+# Tham số lấy mẫu: truyền theo từng lần gọi (llm.invoke(..., temperature=...)), không load thêm model
+SAMPLING_PARAMS = ("temperature", "top_p", "top_k", "max_tokens", "repeat_penalty")
+# Gom embed câu hỏi đồng thời: chờ tối đa EMBED_BATCH_WINDOW_MS hoặc đủ EMBED_MAX_BATCH đoạn
+EMBED_BATCH_WINDOW_MS = 5.0
+EMBED_MAX_BATCH = 32
+
+# Registry dùng chung cho toàn tiến trình: mỗi cấu hình model chỉ load một lần
+_lock = threading.Lock()
+_models = {}
+_stats = {}
+_embeddings = None
+
+
+def get_rss_mb() -> float:
+    """Lấy bộ nhớ RSS hiện tại của tiến trình (MB)"""
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss / (1024 * 1024)
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def _make_key(model_path: str, overrides: dict, replica: int = 0) -> tuple:
+    return (os.path.normpath(model_path), tuple(sorted(overrides.items())), replica)
+
+
+def get_llm(model_path: str = MODEL_PATH, replica: int = 0, **overrides) -> LlamaCpp:
+    """Lấy LLM đã load sẵn, chỉ load lần đầu tiên được gọi
+
+    `replica` > 0 cho thêm một bản model độc lập (context llama.cpp riêng) để sinh song song.
+    `overrides` chỉ dành cho tham số lúc load (n_ctx, n_gpu_layers...); tham số lấy mẫu truyền khi gọi.
+    """
+    sampling = sorted(set(overrides) & set(SAMPLING_PARAMS))
+    if sampling:
+        raise ValueError(f"{', '.join(sampling)} là tham số lấy mẫu: truyền khi gọi invoke/stream, "
+                         f"không truyền vào get_llm (sẽ load thêm một bản model)")
+    key = _make_key(model_path, overrides, replica)
+    llm = _models.get(key)
+    if llm is not None:
+        return llm
+
+    with _lock:
+        # Kiểm tra lại sau khi có lock, tránh load hai lần khi nhiều thread cùng gọi
+        llm = _models.get(key)
+        if llm is not None:
+            return llm
+
+        config = {**LLM_CONFIG, **overrides}
+        rss_before = get_rss_mb()
+        start = time.perf_counter()
+        llm = LlamaCpp(model_path=model_path, **config)
+        load_time = time.perf_counter() - start
+        rss_after = get_rss_mb()
+
+        _models[key] = llm
+        tracer.record("llm_construction", load_time, _start=start, model=os.path.basename(model_path), replica=replica)
+        _stats[key] = {
+            "model_path": model_path,
+            "replica": replica,
+            "load_time_s": load_time,
+            "rss_before_mb": rss_before,
+            "rss_after_mb": rss_after,
+            "rss_delta_mb": rss_after - rss_before,
+            "loaded_at": time.time(),
+        }
+        print(f"✅ Đã load model {model_path} trong {load_time:.2f}s "
+              f"(RSS: {rss_before:.0f}MB -> {rss_after:.0f}MB)")
+        return llm
+
+
+def get_embeddings() -> CachedEmbeddings:
+    """Embedding model dùng chung, có cache vector theo hash nội dung
+
+    Cache đứng trước bộ gom batch: câu hỏi đã có vector không phải chờ cửa sổ gom.
+    """
+    global _embeddings
+    if _embeddings is None:
+        with _lock:
+            if _embeddings is None:
+                batcher = MicroBatchEmbeddings(GPT4AllEmbeddings(model_file=EMBEDDING_MODEL),
+                                               window_ms=EMBED_BATCH_WINDOW_MS, max_batch=EMBED_MAX_BATCH)
+                tracer.register("embed_batch_size", batcher.batch_sizes)
+                tracer.register("embed_batch_wait_ms", batcher.wait_ms)
+                _embeddings = CachedEmbeddings(batcher, model_id=os.path.basename(EMBEDDING_MODEL))
+    return _embeddings
+
+
+def get_embedding_stats() -> dict:
+    """Thống kê cache embedding và histogram kích thước batch / thời gian chờ của bộ gom batch"""
+    if _embeddings is None:
+        return {}
+    return {"cache": _embeddings.get_stats(), "batcher": _embeddings.embeddings.get_stats()}
+
+
+def get_llm_stats() -> list:
+    """Thống kê thời gian load và bộ nhớ của các model đang được giữ"""
+    rss_now = get_rss_mb()
+    return [{**stats, "rss_now_mb": rss_now} for stats in _stats.values()]
+
+
+def shutdown_llm() -> None:
+    """Giải phóng tất cả model đang được giữ trong registry"""
+    with _lock:
+        for llm in _models.values():
+            client = getattr(llm, "client", None)
+            if client is not None and hasattr(client, "close"):
+                client.close()
+        _models.clear()
+        _stats.clear()
+    gc.collect()
@@ -1,7 +1,7 @@
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
-import requests
 import pytz
+from intent_engine import IntentEngine, IntentMatch
 
 class PatternManager:
     def __init__(self):
@@ -45,6 +45,26 @@ class PatternManager:
             'reference': r'(tham khảo|nguồn|trích dẫn|cite)',
             
         }
+
+        # Trọng số khi tính điểm chitchat/document
+        self.chitchat_weights: Dict[str, float] = {
+            'greeting': 1.5,
+            'emotion': 1.3,
+            'personal': 1.2,
+            'smalltalk': 1.1,
+            'opinion': 0.9
+        }
+
+        self.doc_weights: Dict[str, float] = {
+            'technical': 1.5,
+            'analyze': 1.3,
+            'find': 1.2,
+            'what': 1.1,
+            'how': 1.1
+        }
+
+        # Bộ nhận diện intent biên dịch sẵn, chỉ tạo khi cần
+        self._engine = None
         
         self.responses: Dict[str, List[str]] = {
             'greeting': [
@@ -92,13 +112,33 @@ class PatternManager:
             'chat_fuck': ["ê ê không chửi thề nha mày, đcm mày",]
         }
 
+    @property
+    def engine(self) -> IntentEngine:
+        """Bộ nhận diện intent được biên dịch một lần từ các pattern"""
+        if self._engine is None:
+            self._engine = IntentEngine(
+                self.chitchat_patterns,
+                self.doc_patterns,
+                self.chitchat_weights,
+                self.doc_weights
+            )
+        return self._engine
+
+    def match(self, text: str) -> IntentMatch:
+        """Quét một lần, trả về tất cả intent khớp và điểm chitchat/document"""
+        return self.engine.match(text)
+
     def add_chitchat_pattern(self, intent: str, pattern: str) -> None:
         """Thêm pattern mới cho chitchat"""
         self.chitchat_patterns[intent] = pattern
+        if self._engine is not None:
+            self._engine.set_pattern("chitchat", intent, pattern)
 
     def add_doc_pattern(self, intent: str, pattern: str) -> None:
         """Thêm pattern mới cho document"""
         self.doc_patterns[intent] = pattern
+        if self._engine is not None:
+            self._engine.set_pattern("doc", intent, pattern)
 
     def add_response(self, intent: str, responses: List[str]) -> None:
         """Thêm câu trả lời cho một intent"""
@@ -131,21 +171,24 @@ class PatternManager:
         return f"{weekday}, ngày {current_date.strftime('%d/%m/%Y')}"
 
 
+    def direct_answer(self, text: str) -> Optional[str]:
+        """Câu trả lời chitchat có sẵn (không cần retrieval hay LLM), nếu có"""
+        responses = self.get_responses(text)
+        if responses[0] not in ["DOCUMENT_QUERY", "GENERAL_QUERY"]:
+            return responses[0]
+        return None
+
     def get_responses(self, text: str) -> List[str]:
         """Cập nhật phương thức get_responses"""
-        import re
         text = text.lower()
+        match = self.match(text)
         
         # Kiểm tra trước nếu là câu hỏi liên quan đến tài liệu
-        for intent, pattern in self.doc_patterns.items():
-            if re.search(pattern, text):
-                return ["DOCUMENT_QUERY", intent]
+        if match.doc_intents:
+            return ["DOCUMENT_QUERY", match.doc_intents[0]]
         
         # Nếu không phải câu hỏi tài liệu, kiểm tra các intent chitchat
-        found_intents = []
-        for intent, pattern in self.chitchat_patterns.items():
-            if re.search(pattern, text):
-                found_intents.append(intent)
+        found_intents = match.chitchat_intents
                 
         # Xử lý theo thứ tự ưu tiên cho chitchat
         if 'time' in found_intents:
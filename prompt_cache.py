@@ -0,0 +1,82 @@
+import hashlib
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+
+from tracing import tracer
+
+
+class PrefixState(NamedTuple):
+    key: str
+    tokens: list
+    state: object
+    eval_s: float
+
+
+def static_prefix(template: str) -> str:
+    """Phần cố định ở đầu template, trước biến đầu tiên ({context}, {question}...)"""
+    index = template.find("{")
+    return template if index == -1 else template[:index]
+
+
+class PromptPrefixCache:
+    """Lưu KV state của llama.cpp sau khi đã đánh giá phần system prompt cố định của mỗi template"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states: Dict[tuple, PrefixState] = {}
+        self.stats = {"hits": 0, "restores": 0, "builds": 0}
+
+    def _build(self, client, key: str, prefix: str) -> PrefixState:
+        # Tách token giống create_completion của llama-cpp-python để khớp tiền tố
+        tokens = client.tokenize(prefix.encode("utf-8"), special=True)
+        start = time.perf_counter()
+        client.reset()
+        client.eval(tokens)
+        eval_s = time.perf_counter() - start
+        self.stats["builds"] += 1
+        return PrefixState(key, list(tokens), client.save_state(), eval_s)
+
+    def prepare(self, llm, name: str, prompt) -> Optional[PrefixState]:
+        """Đưa context của llama.cpp về trạng thái đã đánh giá xong phần prefix của template
+
+        llama-cpp-python tự bỏ qua đoạn token đầu trùng với context hiện tại, nên sau bước này
+        chỉ phần context + câu hỏi phải đánh giá lại.
+        """
+        client = getattr(llm, "client", None)
+        if client is None or not hasattr(client, "save_state"):
+            return None
+
+        prefix = static_prefix(prompt.template)
+        if not prefix:
+            return None
+        # Khóa theo nội dung prefix và model: template đổi thì state cũ bị thay
+        key = hashlib.sha1(f"{id(client)}:{prefix}".encode("utf-8")).hexdigest()
+
+        # Mỗi bản model (replica) có context riêng nên giữ state riêng
+        slot = (name, id(client))
+        with self._lock, tracer.span("prompt_prefix", template=name) as span:
+            entry = self._states.get(slot)
+            if entry is None or entry.key != key:
+                entry = self._build(client, key, prefix)
+                self._states[slot] = entry
+                span.set(cache_hit=False)
+                return entry
+
+            n = len(entry.tokens)
+            if client.n_tokens >= n and list(client.input_ids[:n]) == entry.tokens:
+                # Context hiện tại đã bắt đầu bằng prefix này (ví dụ câu hỏi trước cùng loại)
+                self.stats["hits"] += 1
+            else:
+                client.load_state(entry.state)
+                self.stats["restores"] += 1
+            span.set(cache_hit=True)
+            return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._states.clear()
+
+
+# Cache dùng chung cho toàn tiến trình
+prompt_prefix_cache = PromptPrefixCache()
@@ -0,0 +1,238 @@
+import json
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+
+from chunk_store import ChunkStore, assign_chunk_ids
+from faiss_index import store_vectors
+from generations import commit_generation, current_path, new_generation
+
+# Cau hinh
+QUANTIZED_STORE_PATH = "vectorstores/quantized_store"
+STORE_VERSION = 1
+MODES = ("int8", "binary")
+# Số ứng viên được tính lại bằng vector float32 = k * hệ số
+SHORTLIST_FACTOR = {"int8": 10, "binary": 40}
+# Giới hạn bộ nhớ tạm khi giải mã int8 theo khối (số phần tử float32)
+BLOCK_ELEMENTS = 1 << 22
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Vị trí của k điểm cao nhất, đã sắp xếp giảm dần"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class QuantizedVectorStore:
+    """Nhánh FAISS dạng nén: lọc sơ bộ trên mã int8/nhị phân, tính lại shortlist bằng vector float32 (mmap)
+
+    Dùng thay vector store của LangChain trong HybridRetriever; thứ tự vector trùng thứ tự kho chunk.
+    """
+
+    def __init__(self, mode: str, vectors, codes, norms, params: dict,
+                 docs: Optional[Sequence[Document]] = None, embeddings=None,
+                 metric: str = "l2", shortlist_factor: Optional[int] = None):
+        if mode not in MODES:
+            raise ValueError(f"Chế độ lượng tử hóa không hợp lệ: {mode}")
+        self.mode = mode
+        self.vectors = vectors
+        self.codes = codes
+        self.norms = norms
+        self.params = params
+        self.docs = docs
+        self.embeddings = embeddings
+        self.metric = metric
+        self.shortlist_factor = shortlist_factor or SHORTLIST_FACTOR[mode]
+        # Giữ giao diện giống FAISS của LangChain cho các hàm trong hybrid.py
+        self.distance_strategy = (DistanceStrategy.MAX_INNER_PRODUCT if metric == "ip"
+                                  else DistanceStrategy.EUCLIDEAN_DISTANCE)
+        self._normalize_L2 = False
+        self._binary_index = None
+        if mode == "binary":
+            # Mã nhị phân chỉ bằng 1/32 vector float32: nạp vào IndexBinaryFlat để tính Hamming bằng popcount
+            self._binary_index = faiss.IndexBinaryFlat(codes.shape[1] * 8)
+            self._binary_index.add(np.ascontiguousarray(codes))
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    # ---- Lượng tử hóa ----
+    @staticmethod
+    def quantize(vectors: np.ndarray, mode: str) -> Tuple[np.ndarray, dict]:
+        """Mã hóa vector: int8 theo min/max từng chiều, hoặc 1 bit/chiều theo dấu so với trung bình"""
+        if mode == "int8":
+            low = vectors.min(axis=0)
+            scale = (vectors.max(axis=0) - low) / 255.0
+            scale[scale == 0] = 1.0
+            codes = np.clip(np.rint((vectors - low) / scale) - 128, -128, 127).astype(np.int8)
+            return codes, {"low": low.astype(np.float32), "scale": scale.astype(np.float32)}
+        if mode == "binary":
+            mean = vectors.mean(axis=0)
+            return np.packbits(vectors > mean, axis=1), {"mean": mean.astype(np.float32)}
+        raise ValueError(f"Chế độ lượng tử hóa không hợp lệ: {mode}")
+
+    @classmethod
+    def from_vectors(cls, vectors: np.ndarray, mode: str = "int8", **kwargs) -> "QuantizedVectorStore":
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        codes, params = cls.quantize(vectors, mode)
+        norms = np.einsum("ij,ij->i", vectors, vectors).astype(np.float32)
+        return cls(mode, vectors, codes, norms, params, **kwargs)
+
+    # ---- Tìm kiếm ----
+    def _shortlist(self, query: np.ndarray, n: int) -> np.ndarray:
+        """Lọc sơ bộ trên mã nén: chỉ số của n chunk có điểm gần đúng cao nhất"""
+        if self.mode == "binary":
+            bits = np.packbits(query > self.params["mean"])[None, :]
+            _, ids = self._binary_index.search(bits, min(n, len(self.codes)))
+            return ids[0][ids[0] >= 0]
+        return _top_k(self._approx_scores(query), n)
+
+    def _approx_scores(self, query: np.ndarray) -> np.ndarray:
+        """Điểm gần đúng từ mã int8, càng cao càng gần"""
+        # x ≈ low + (code + 128) * scale  =>  q·x ≈ q·(low + 128 * scale) + (q * scale)·code
+        low, scale = self.params["low"], self.params["scale"]
+        bias = float(query @ (low + 128 * scale))
+        weights = query * scale
+        dots = np.empty(len(self.codes), dtype=np.float32)
+        block = max(1, BLOCK_ELEMENTS // self.codes.shape[1])
+        for start in range(0, len(self.codes), block):
+            dots[start:start + block] = self.codes[start:start + block].astype(np.float32) @ weights
+        dots += bias
+        if self.metric == "ip":
+            return dots
+        # Bỏ ||q||² vì không đổi thứ hạng
+        return 2 * dots - self.norms
+
+    def _exact_scores(self, query: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        # Đọc các dòng theo thứ tự tăng dần cho thân thiện với page cache
+        order = np.argsort(ids)
+        rows = np.asarray(self.vectors[ids[order]], dtype=np.float32)
+        dots = np.empty(len(ids), dtype=np.float32)
+        dots[order] = rows @ query
+        if self.metric == "ip":
+            return dots
+        return -(float(query @ query) - 2 * dots + self.norms[ids])
+
+    def search(self, query_vector, k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """Trả về (chỉ số chunk, điểm): điểm là tích vô hướng, hoặc -khoảng cách L2²"""
+        query = np.asarray(query_vector, dtype=np.float32)
+        shortlist = self._shortlist(query, k * self.shortlist_factor)
+        exact = self._exact_scores(query, shortlist)
+        top = _top_k(exact, k)
+        return shortlist[top], exact[top]
+
+    def search_many(self, query_vectors, k: int = 5) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return [self.search(vector, k) for vector in np.asarray(query_vectors, dtype=np.float32)]
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 4) -> List[Tuple[Document, float]]:
+        """Cùng quy ước với FAISS của LangChain: L2 trả về khoảng cách (càng nhỏ càng gần)"""
+        ids, scores = self.search(embedding, k)
+        sign = 1.0 if self.metric == "ip" else -1.0
+        return [(self.docs[i], sign * float(score)) for i, score in zip(ids, scores)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def memory_bytes(self) -> dict:
+        """Bộ nhớ phải đọc cho mỗi truy vấn (mã nén) so với bản float32 đầy đủ"""
+        return {"codes": int(self.codes.nbytes + self.norms.nbytes), "float32": int(self.vectors.nbytes)}
+
+    # ---- Lưu trữ ----
+    def save(self, path: str = QUANTIZED_STORE_PATH, signature: str = "") -> None:
+        """Ghi vào một thế hệ mới, không ghi đè vectors.f32/codes.npy mà worker khác đang mmap"""
+        gen_path = new_generation(path)
+        with open(os.path.join(gen_path, "vectors.f32"), "wb") as f:
+            f.write(np.ascontiguousarray(self.vectors, dtype=np.float32).tobytes())
+        np.save(os.path.join(gen_path, "codes.npy"), self.codes)
+        np.save(os.path.join(gen_path, "norms.npy"), self.norms)
+        for name, value in self.params.items():
+            np.save(os.path.join(gen_path, f"{name}.npy"), value)
+        meta = {
+            "version": STORE_VERSION,
+            "mode": self.mode,
+            "metric": self.metric,
+            "count": len(self.vectors),
+            "dim": int(self.vectors.shape[1]),
+            "params": sorted(self.params),
+            "signature": signature,
+        }
+        with open(os.path.join(gen_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        commit_generation(path, gen_path)
+
+    @classmethod
+    def load(cls, path: str = QUANTIZED_STORE_PATH, docs: Optional[Sequence[Document]] = None,
+             embeddings=None, signature: Optional[str] = None,
+             mode: Optional[str] = None) -> Optional["QuantizedVectorStore"]:
+        """Mở thế hệ hiện tại của kho (mọi mảng đọc bằng mmap), None nếu chưa có hoặc không khớp"""
+        path = current_path(path)
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != STORE_VERSION:
+            return None
+        if signature is not None and meta.get("signature") != signature:
+            return None
+        if mode is not None and meta.get("mode") != mode:
+            return None
+
+        vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r",
+                            shape=(meta["count"], meta["dim"]))
+        params = {name: np.load(os.path.join(path, f"{name}.npy")) for name in meta["params"]}
+        return cls(
+            meta["mode"],
+            vectors,
+            np.load(os.path.join(path, "codes.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "norms.npy"), mmap_mode="r"),
+            params, docs, embeddings, meta["metric"]
+        )
+
+
+def vectors_in_store_order(vector_store: FAISS, store: ChunkStore) -> np.ndarray:
+    """Lấy vector từ FAISS index và sắp lại theo thứ tự chunk của kho chunk
+
+    Index tạo trước khi có id chunk ổn định (id FAISS là uuid) được ánh xạ lại theo nguồn + nội dung
+    của document trong docstore; vẫn thiếu chunk thì báo lỗi để chạy lại indexer.py.
+    """
+    vectors = store_vectors(vector_store)
+    doc_ids = [vector_store.index_to_docstore_id[i] for i in range(len(vectors))]
+    position = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+    chunk_ids = store.chunk_ids()
+    if any(chunk_id not in position for chunk_id in chunk_ids):
+        docs = [vector_store.docstore.search(doc_id) for doc_id in doc_ids]
+        if all(isinstance(doc, Document) and "source" in doc.metadata for doc in docs):
+            position = {chunk_id: i for i, chunk_id in enumerate(assign_chunk_ids(docs))}
+        missing = sum(chunk_id not in position for chunk_id in chunk_ids)
+        if missing:
+            raise ValueError(f"FAISS index không khớp kho chunk ({missing}/{len(chunk_ids)} chunk không có vector), "
+                             f"hãy chạy lại indexer.py")
+    return vectors[[position[chunk_id] for chunk_id in chunk_ids]]
+
+
+def load_quantized_store(store: ChunkStore, embeddings, mode: str = "int8",
+                         path: str = QUANTIZED_STORE_PATH,
+                         db_path: str = "vectorstores/db_faiss") -> QuantizedVectorStore:
+    """Mở kho vector nén của kho chunk, tự dựng lại từ FAISS index khi kho chunk hoặc model thay đổi"""
+    signature = f"{store.signature()}:{getattr(embeddings, 'model_id', '')}"
+    quantized = QuantizedVectorStore.load(path, docs=store, embeddings=embeddings, signature=signature, mode=mode)
+    if quantized is None:
+        vector_store = FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
+        metric = "ip" if vector_store.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT else "l2"
+        quantized = QuantizedVectorStore.from_vectors(vectors_in_store_order(vector_store, store), mode, metric=metric)
+        quantized.save(path, signature)
+        del vector_store
+        # Mở lại bằng mmap để không giữ bản float32 trong RAM
+        quantized = QuantizedVectorStore.load(path, docs=store, embeddings=embeddings)
+    return quantized
@@ -1,28 +1,24 @@
+import time
 from langchain.chains import RetrievalQA, LLMChain
 from langchain.prompts import PromptTemplate
-from langchain_community.embeddings import GPT4AllEmbeddings
 from langchain_community.vectorstores import FAISS
-from langchain_community.llms import LlamaCpp
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.document_loaders import PyPDFLoader
-from langchain.retrievers import BM25Retriever
+from model_registry import get_embeddings, get_llm, shutdown_llm
+from prompt_cache import prompt_prefix_cache
+from chunk_store import load_chunk_store
+from bm25_index import load_bm25_index
+from hybrid import hybrid_search
+from indexer import list_pdfs
 
 # Cau hinh
 model_file = "models/vinallama-7b-chat_q5_0.gguf"
 vector_db_path = "vectorstores/db_faiss"
+# Nhiệt độ sinh riêng của query.py, truyền theo từng lần gọi để dùng chung model trong registry
+temperature = 0.2
 
 # Load LLM
 def load_llm(model_file):
-    llm = LlamaCpp(
-        model_path=model_file,
-        temperature=0.2,
-        max_tokens=512,
-        n_ctx=2048,
-        top_p=0.9,
-        verbose=False,
-        n_gpu_layers=32,
-        n_batch=512       
-    )
+    # Dùng registry để model chỉ load một lần cho cả tiến trình
+    llm = get_llm(model_file)
     return llm
 
 # Tao prompt template
@@ -38,60 +34,47 @@ def create_qa_chain(prompt, llm, bm25_retriever, vector_store):
         
     def qa_chain(query):
         context = get_context(query)
-        chain = LLMChain(llm=llm, prompt=prompt)
+        chain = LLMChain(llm=llm, prompt=prompt, llm_kwargs={"temperature": temperature})
         response = chain.run(context=context, question=query)
         return {"result": response}
         
     return qa_chain
 
+# Tao chain dang stream: yield tung token ngay khi LLM sinh ra
+def create_qa_stream(prompt, llm, bm25_retriever, vector_store):
+    def qa_stream(query, stats=None):
+        stats = stats if stats is not None else {}
+        start = time.perf_counter()
+        docs = hybrid_search(query, bm25_retriever, vector_store)
+        context = "\n".join([doc.page_content for doc in docs])
+        
+        # Phần system prompt cố định đã được đánh giá sẵn trong KV cache
+        prompt_prefix_cache.prepare(llm, "query_document", prompt)
+        tokens = 0
+        for piece in llm.stream(prompt.format(context=context, question=query), temperature=temperature):
+            if tokens == 0:
+                stats["first_token_s"] = time.perf_counter() - start
+            tokens += 1
+            yield piece
+        stats["total_s"] = time.perf_counter() - start
+        stats["tokens"] = tokens
+        
+    return qa_stream
+
 # Read tu VectorDB
 def read_vectors_db():
-    # Đọc PDF và tạo chunks
-    loader = PyPDFLoader("data/working.pdf")
-    docs = loader.load()
-    
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=512,
-        chunk_overlap=50,
-        separators=["\n\n", "\n", ".", "!", "?", ";", ":", ",", " ", ""],
-        length_function=len,
-        add_start_index=True
-    )
-    all_splits = text_splitter.split_documents(docs)
+    # Lấy chunks từ kho đã lưu thay vì đọc lại PDF
+    store = load_chunk_store(list_pdfs())
     
     # Tạo BM25 retriever
-    bm25_retriever = BM25Retriever.from_documents(all_splits)
-    bm25_retriever.k = 5
+    bm25_retriever = load_bm25_index(store)
     
     # Tạo FAISS retriever
-    embedding_model = GPT4AllEmbeddings(model_file=r"models\vinallama-7b-chat_q5_0.gguf")
+    embedding_model = get_embeddings()
     db = FAISS.load_local(vector_db_path, embedding_model, allow_dangerous_deserialization=True)
     
     return bm25_retriever, db
 
-def hybrid_search(query, bm25_retriever, vector_store):
-    # Lấy kết quả từ cả hai phương pháp
-    bm25_docs = bm25_retriever.get_relevant_documents(query)[:5]
-    faiss_docs = vector_store.similarity_search(query, k=5)
-    
-    # Kết hợp và loại bỏ trùng lặp
-    seen_content = set()
-    final_docs = []
-    
-    # Xen kẽ kết quả từ cả hai nguồn
-    for i in range(max(len(bm25_docs), len(faiss_docs))):
-        if i < len(bm25_docs):
-            if bm25_docs[i].page_content not in seen_content:
-                seen_content.add(bm25_docs[i].page_content)
-                final_docs.append(bm25_docs[i])
-                
-        if i < len(faiss_docs):
-            if faiss_docs[i].page_content not in seen_content:
-                seen_content.add(faiss_docs[i].page_content)
-                final_docs.append(faiss_docs[i])
-    
-    return final_docs[:5]
-
 def main():
     # Khởi tạo các thành phần
     bm25_retriever, vector_store = read_vectors_db()
@@ -102,8 +85,8 @@ def main():
     {context}<|im_end|>\n<|im_start|>user\n{question}<|im_end|>\n<|im_start|>assistant"""
     prompt = creat_prompt(template)
     
-    # Tạo chain với hybrid search
-    llm_chain = create_qa_chain(prompt, llm, bm25_retriever, vector_store)
+    # Tạo chain với hybrid search (dạng stream)
+    qa_stream = create_qa_stream(prompt, llm, bm25_retriever, vector_store)
     
     # Vòng lặp hỏi đáp
     while True:
@@ -113,8 +96,14 @@ def main():
                 print("Tạm biệt!")
                 break
                 
-            response = llm_chain(question)
-            print("\nCâu trả lời:", response['result'])
+            stats = {}
+            print("\nCâu trả lời: ", end="", flush=True)
+            for piece in qa_stream(question, stats):
+                print(piece, end="", flush=True)
+            print()
+            if stats.get("tokens"):
+                print(f"⏱️ Token đầu tiên: {stats['first_token_s']:.2f}s | "
+                      f"Tổng: {stats['total_s']:.2f}s | {stats['tokens']} tokens")
             
         except KeyboardInterrupt:
             print("\nTạm biệt!")
@@ -123,5 +112,7 @@ def main():
             print(f"\nCó lỗi xảy ra: {str(e)}")
             print("Vui lòng thử lại.")
 
+    shutdown_llm()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,199 @@
+import os
+import re
+import threading
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from hybrid import chunk_table, stored_vectors, table_vectors
+
+# Cau hinh
+GATE_ENABLED = True
+# Chunk tốt nhất dưới cả hai ngưỡng: coi như tài liệu không có thông tin, trả lời ngay
+MIN_SIMILARITY = 0.35
+MIN_COVERAGE = 0.34
+# Trả lời trích xuất (không gọi LLM): hai nhánh cùng xếp chunk lên đầu và chunk đủ gần câu hỏi
+EXTRACTIVE_AGREEMENT = 0.75
+EXTRACTIVE_SIMILARITY = 0.6
+EXTRACTIVE_COVERAGE = 0.6
+# Intent tra cứu (câu trả lời là một đoạn của chunk) và intent cần LLM diễn giải
+EXTRACTIVE_INTENTS = ("find", "list", "define", "reference")
+GENERATIVE_INTENTS = ("how", "why", "explain", "compare", "analyze", "summarize")
+EXTRACT_SENTENCES = 2
+LIST_SENTENCES = 4
+EXTRACT_CHUNKS = 2
+# Từ hỏi / hư từ không tính khi đo độ phủ của câu hỏi trên chunk
+QUERY_STOPWORDS = {
+    "là", "gì", "những", "các", "của", "và", "có", "không", "cho", "tôi", "về", "trong", "được",
+    "nào", "như", "thế", "hãy", "với", "một", "này", "đó", "thì", "ở", "đâu", "bao", "nhiêu",
+    "tìm", "tra", "cứu", "xem", "kiếm", "liệt", "kê", "nêu", "khái", "niệm",
+    "tham", "khảo", "nguồn", "trích", "dẫn",
+}
+
+_WORD = re.compile(r"\w+")
+_SENTENCE_END = re.compile(r"(?<=[.!?;])\s+|\n+")
+
+
+def query_terms(text: str) -> List[str]:
+    """Các từ mang nội dung của câu hỏi (chữ thường, bỏ dấu câu và từ hỏi), giữ thứ tự"""
+    terms = []
+    for word in _WORD.findall(text.lower()):
+        if word not in QUERY_STOPWORDS and word not in terms:
+            terms.append(word)
+    return terms
+
+
+def coverage(terms: Sequence[str], text: str) -> float:
+    """Tỉ lệ từ của câu hỏi xuất hiện trong đoạn văn"""
+    if not terms:
+        return 0.0
+    words = set(_WORD.findall(text.lower()))
+    return sum(term in words for term in terms) / len(terms)
+
+
+class GateDecision(NamedTuple):
+    action: str  # "not_found" | "extractive" | "llm"
+    reason: str
+    agreement: float
+    similarity: float
+    coverage: float
+
+
+class RetrievalGate:
+    """Quyết định sau retrieval: không tìm thấy / trích xuất câu trả lời / sinh bằng LLM
+
+    Dựa trên chunk có điểm kết hợp cao nhất: điểm kết hợp quy về [0, 1] (1 = đứng đầu cả hai nhánh),
+    cosine với câu hỏi (vector đã lưu, không embed lại) và độ phủ từ của câu hỏi.
+    Điểm RRF chỉ phản ánh thứ hạng nên không tự nói được là chunk có liên quan hay không.
+    """
+
+    def __init__(self,
+                 enabled: bool = GATE_ENABLED,
+                 min_similarity: float = MIN_SIMILARITY,
+                 min_coverage: float = MIN_COVERAGE,
+                 extractive_agreement: float = EXTRACTIVE_AGREEMENT,
+                 extractive_similarity: float = EXTRACTIVE_SIMILARITY,
+                 extractive_coverage: float = EXTRACTIVE_COVERAGE):
+        self.enabled = enabled
+        self.min_similarity = min_similarity
+        self.min_coverage = min_coverage
+        self.extractive_agreement = extractive_agreement
+        self.extractive_similarity = extractive_similarity
+        self.extractive_coverage = extractive_coverage
+        self._lock = threading.Lock()
+        self.stats = {"not_found": 0, "extractive": 0, "llm": 0}
+
+    def thresholds(self) -> Dict[str, float]:
+        return {"min_similarity": self.min_similarity, "min_coverage": self.min_coverage,
+                "extractive_agreement": self.extractive_agreement,
+                "extractive_similarity": self.extractive_similarity,
+                "extractive_coverage": self.extractive_coverage}
+
+    @staticmethod
+    def _top_similarity(bm25_retriever, vector_store, doc: Document, chunk_id: Optional[int],
+                        query_vector) -> Optional[float]:
+        table = chunk_table(bm25_retriever, vector_store)
+        if table is not None and chunk_id is not None:
+            vectors = table_vectors(vector_store, table, np.array([chunk_id], dtype=np.int64))
+        else:
+            vectors = stored_vectors(vector_store, [doc])
+        if vectors is None:
+            return None
+        vector = vectors[0]
+        query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        norms = float(np.linalg.norm(vector) * np.linalg.norm(query))
+        return float(vector @ query) / norms if norms > 0 else 0.0
+
+    def decide(self, query: str, intents: Sequence[str], scored_docs: List[Tuple[Document, float]],
+               chunk_ids, query_vector, max_score: Optional[float], bm25_retriever,
+               vector_store) -> GateDecision:
+        """`max_score=None`: điểm không phải điểm kết hợp hai nhánh (xếp hạng lại chunk ấm theo cosine
+        hoặc thứ hạng) nên không đo được độ đồng thuận, không bao giờ trả lời trích xuất"""
+        top = int(np.argmax([score for _, score in scored_docs]))
+        doc, score = scored_docs[top]
+        if max_score is None:
+            agreement = float("nan")
+        else:
+            agreement = min(score / max_score, 1.0) if max_score > 0 else 0.0
+        similarity = self._top_similarity(bm25_retriever, vector_store, doc,
+                                          None if chunk_ids is None else int(chunk_ids[top]), query_vector)
+        covered = coverage(query_terms(query), doc.page_content)
+
+        if similarity is None:
+            # Không có vector đã lưu của chunk (không embed lại khi trả lời): không đủ căn cứ để bỏ qua LLM
+            action, reason, similarity = "llm", "no_stored_vector", float("nan")
+        elif similarity < self.min_similarity and covered < self.min_coverage:
+            action, reason = "not_found", "low_confidence"
+        elif not set(intents) & set(EXTRACTIVE_INTENTS):
+            action, reason = "llm", "intent"
+        elif set(intents) & set(GENERATIVE_INTENTS):
+            action, reason = "llm", "generative_intent"
+        elif max_score is None:
+            action, reason = "llm", "no_fused_score"
+        elif agreement < self.extractive_agreement:
+            action, reason = "llm", "legs_disagree"
+        elif similarity < self.extractive_similarity and covered < self.extractive_coverage:
+            action, reason = "llm", "not_confident"
+        else:
+            action, reason = "extractive", "lookup_intent"
+        return GateDecision(action, reason, agreement, similarity, covered)
+
+    def evaluate(self, query: str, intents: Sequence[str], scored_docs: List[Tuple[Document, float]],
+                 chunk_ids, query_vector, max_score: Optional[float], bm25_retriever,
+                 vector_store) -> Tuple[GateDecision, Optional[str]]:
+        """Quyết định và câu trả lời trích xuất (nếu có); không trích được câu nào thì để LLM trả lời"""
+        decision = self.decide(query, intents, scored_docs, chunk_ids, query_vector, max_score,
+                               bm25_retriever, vector_store)
+        answer = None
+        if decision.action == "extractive":
+            answer = self.extract(query, intents, scored_docs)
+            if answer is None:
+                decision = decision._replace(action="llm", reason="no_matching_sentence")
+        with self._lock:
+            self.stats[decision.action] += 1
+        return decision, answer
+
+    def extract(self, query: str, intents: Sequence[str],
+                scored_docs: List[Tuple[Document, float]]) -> Optional[str]:
+        """Các câu khớp câu hỏi nhất trong những chunk đầu, kèm trang nguồn; None nếu không có câu nào khớp"""
+        terms = query_terms(query)
+        ranked = sorted(scored_docs, key=lambda item: item[1], reverse=True)[:EXTRACT_CHUNKS]
+        candidates = []
+        for rank, (doc, _) in enumerate(ranked):
+            for position, sentence in enumerate(_SENTENCE_END.split(doc.page_content)):
+                sentence = " ".join(sentence.split())
+                if len(sentence.split()) < 3:
+                    continue
+                overlap = coverage(terms, sentence)
+                if overlap > 0:
+                    # Ưu tiên câu phủ nhiều từ của câu hỏi, sau đó chunk xếp trên
+                    candidates.append((-overlap, rank, position, sentence, doc))
+        if not candidates:
+            return None
+        limit = LIST_SENTENCES if "list" in intents else EXTRACT_SENTENCES
+        chosen = sorted(sorted(candidates)[:limit], key=lambda item: (item[1], item[2]))
+
+        cited: Dict[str, List[int]] = {}
+        for *_, doc in chosen:
+            source = os.path.basename(str(doc.metadata.get("source", "")))
+            page = doc.metadata.get("page")
+            pages = cited.setdefault(source, [])
+            if page is not None and int(page) + 1 not in pages:
+                pages.append(int(page) + 1)
+        citation = "; ".join(f"{source}, trang {', '.join(map(str, pages))}" if pages else source
+                             for source, pages in cited.items())
+        text = "\n".join(f"- {item[3]}" for item in chosen) if "list" in intents else " ".join(
+            item[3] for item in chosen)
+        return f"{text}\n(Nguồn: {citation})"
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            total = sum(self.stats.values())
+            return {**self.stats,
+                    "skipped_llm_rate": (self.stats["not_found"] + self.stats["extractive"]) / total if total else 0.0,
+                    "enabled": self.enabled, "thresholds": self.thresholds()}
+
+
+# Dùng chung cho cả tiến trình
+retrieval_gate = RetrievalGate()
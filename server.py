@@ -0,0 +1,335 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http import HTTPStatus
+from typing import Dict, Optional
+
+from indexer import index_version
+from model_registry import get_embedding_stats, get_llm, shutdown_llm
+from retrieval_gate import retrieval_gate
+from session_store import WARM_SIMILARITY, session_store
+from smart_ans import answer_cache, generate_stream, pattern_answer, plan_response
+import utils
+from tracing import tracer
+from utils import initialize_retrievers
+
+# Cau hinh
+HOST = "0.0.0.0"
+PORT = 8000
+LLM_WORKERS = 1
+QUEUE_SIZE = 16
+RETRIEVAL_THREADS = 4
+REQUEST_TIMEOUT = 60.0
+MAX_BODY_BYTES = 64 * 1024
+MAX_SESSION_ID_CHARS = 128
+STAGES = ("pattern", "retrieval", "queue_wait", "generation", "total")
+
+
+class RequestError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class LatencyStats:
+    """Độ trễ gần đây của một giai đoạn (giữ `window` mẫu cuối)"""
+
+    def __init__(self, window: int = 1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+        self.count += 1
+
+    def summary(self) -> dict:
+        if not self.samples:
+            return {"count": self.count}
+        ordered = sorted(self.samples)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+        return {"count": self.count, "mean_ms": sum(ordered) / len(ordered) * 1000,
+                "p50_ms": pick(0.5), "p95_ms": pick(0.95), "max_ms": ordered[-1] * 1000}
+
+
+class GenerationJob:
+    def __init__(self, query: str, plan: dict, deadline: float, future: asyncio.Future):
+        self.query = query
+        self.plan = plan
+        self.deadline = deadline
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.stats: Dict[str, float] = {}
+        # Hàm sinh mang theo trace của request sang thread của LLM worker
+        self.generate = None
+
+
+class RagServer:
+    """Phục vụ rag_search qua HTTP: retrieval trong thread pool, sinh câu trả lời qua hàng đợi giới hạn
+
+    Mỗi LLM worker giữ một bản LlamaCpp riêng và chạy trên thread riêng của nó
+    (một context llama.cpp không dùng được đồng thời từ nhiều thread).
+    """
+
+    def __init__(self, llm_workers: int = LLM_WORKERS, queue_size: int = QUEUE_SIZE,
+                 retrieval_threads: int = RETRIEVAL_THREADS, timeout: float = REQUEST_TIMEOUT):
+        self.llm_workers = llm_workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retrieval_pool = ThreadPoolExecutor(retrieval_threads, thread_name_prefix="retrieval")
+        self.generation_pools = [ThreadPoolExecutor(1, thread_name_prefix=f"llm-{i}") for i in range(llm_workers)]
+        self.queue: Optional[asyncio.Queue] = None
+        self.bm25_retriever = None
+        self.vector_store = None
+        self.llms = []
+        self.busy = 0
+        self.counters = {"requests": 0, "pattern": 0, "cached": 0, "not_found": 0, "extractive": 0,
+                         "generated": 0, "rejected": 0, "timeouts": 0, "errors": 0}
+        self.latency = {stage: LatencyStats() for stage in STAGES}
+        self._workers = []
+
+    # ---- Khởi động / dừng ----
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.bm25_retriever, self.vector_store = await loop.run_in_executor(
+            self.retrieval_pool, initialize_retrievers)
+        if self.bm25_retriever is None or self.vector_store is None:
+            raise RuntimeError("Không khởi tạo được retrievers")
+        answer_cache.set_version(index_version())
+        session_store.set_version(index_version())
+        # Load sẵn các bản LLM trên chính thread sẽ dùng chúng (replica 0 dùng chung với smart_ans)
+        self.llms = []
+        for replica, pool in enumerate(self.generation_pools):
+            self.llms.append(await loop.run_in_executor(pool, partial(get_llm, replica=replica)))
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._workers = [asyncio.create_task(self._generation_worker(i)) for i in range(self.llm_workers)]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self.retrieval_pool.shutdown(wait=False)
+        for pool in self.generation_pools:
+            pool.shutdown(wait=True)
+        shutdown_llm()
+        answer_cache.save()
+
+    # ---- Xử lý câu hỏi ----
+    async def answer(self, query: str, timeout: Optional[float] = None,
+                     session_id: Optional[str] = None) -> dict:
+        with tracer.trace("http_chat", profile=False):
+            return await self._answer(query, timeout, session_id)
+
+    async def _answer(self, query: str, timeout: Optional[float] = None,
+                      session_id: Optional[str] = None) -> dict:
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        deadline = start + (timeout or self.timeout)
+        self.counters["requests"] += 1
+        try:
+            # Chitchat có sẵn câu trả lời: trả lời ngay, không qua thread pool hay hàng đợi
+            with tracer.span("pattern") as span:
+                answer = pattern_answer(query, session_id)
+                span.set(cache_hit=answer is not None)
+            self.latency["pattern"].add(time.monotonic() - start)
+            if answer is not None:
+                self.counters["pattern"] += 1
+                tracer.annotate(source="pattern")
+                return {"answer": answer, "source": "pattern"}
+
+            retrieval_start = time.monotonic()
+            plan = await asyncio.wait_for(
+                loop.run_in_executor(self.retrieval_pool, tracer.wrap(plan_response), query,
+                                     self.bm25_retriever, self.vector_store, session_id),
+                deadline - time.monotonic())
+            self.latency["retrieval"].add(time.monotonic() - retrieval_start)
+            if "answer" in plan:
+                # Trả lời không cần LLM: cache, không tìm thấy hoặc trích xuất từ chunk
+                source = plan.get("source", "cache")
+                self.counters["cached" if source == "cache" else source] += 1
+                return {"answer": plan["answer"], "source": source}
+
+            job = GenerationJob(query, plan, deadline, loop.create_future())
+            job.generate = tracer.wrap(self._generate)
+            try:
+                self.queue.put_nowait(job)
+            except asyncio.QueueFull:
+                self.counters["rejected"] += 1
+                tracer.count("rejected_total")
+                raise RequestError(HTTPStatus.TOO_MANY_REQUESTS, "Máy chủ đang bận, vui lòng thử lại sau")
+            answer = await asyncio.wait_for(job.future, deadline - time.monotonic())
+            self.counters["generated"] += 1
+            return {"answer": answer, "source": "llm", "stats": job.stats}
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            tracer.count("timeouts_total")
+            raise RequestError(HTTPStatus.GATEWAY_TIMEOUT, "Hết thời gian xử lý câu hỏi")
+        finally:
+            self.latency["total"].add(time.monotonic() - start)
+
+    def _generate(self, llm, job: GenerationJob) -> str:
+        """Chạy trên thread của LLM worker, dừng sinh khi quá hạn để nhả worker"""
+        tracer.record("queue_wait", time.monotonic() - job.enqueued)
+        pieces = []
+        for piece in generate_stream(job.plan, job.query, llm, job.stats):
+            if time.monotonic() > job.deadline:
+                raise asyncio.TimeoutError()
+            pieces.append(piece)
+        return "".join(pieces)
+
+    async def _generation_worker(self, index: int) -> None:
+        loop = asyncio.get_running_loop()
+        llm, pool = self.llms[index], self.generation_pools[index]
+        while True:
+            job = await self.queue.get()
+            try:
+                self.latency["queue_wait"].add(time.monotonic() - job.enqueued)
+                # Bỏ qua câu hỏi đã quá hạn hoặc client đã ngắt trong lúc chờ
+                if job.future.done() or time.monotonic() > job.deadline:
+                    if not job.future.done():
+                        job.future.set_exception(asyncio.TimeoutError())
+                    continue
+                self.busy += 1
+                start = time.monotonic()
+                try:
+                    answer = await loop.run_in_executor(pool, job.generate, llm, job)
+                    if not job.future.done():
+                        job.future.set_result(answer)
+                except Exception as e:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                finally:
+                    self.busy -= 1
+                    self.latency["generation"].add(time.monotonic() - start)
+            finally:
+                self.queue.task_done()
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "queue_capacity": self.queue_size,
+            "llm_workers": self.llm_workers,
+            "busy_workers": self.busy,
+            "counters": self.counters,
+            "latency": {stage: stats.summary() for stage, stats in self.latency.items()},
+            "answer_cache": answer_cache.get_stats(),
+            "embeddings": get_embedding_stats(),
+            "sessions": session_store.get_stats(),
+            "gate": retrieval_gate.get_stats(),
+            "tracing": tracer.snapshot(),
+        }
+
+    # ---- HTTP ----
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            status, payload = await self._dispatch(reader)
+        except RequestError as e:
+            status, payload = e.status, {"error": str(e)}
+        except Exception as e:
+            self.counters["errors"] += 1
+            print(f"\n❌ Lỗi: {str(e)}")
+            status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi của bạn."}
+        if isinstance(payload, str):
+            body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        headers = [f"HTTP/1.1 {status.value} {status.phrase}",
+                   f"Content-Type: {content_type}",
+                   f"Content-Length: {len(body)}",
+                   "Connection: close"]
+        if status == HTTPStatus.TOO_MANY_REQUESTS:
+            headers.append("Retry-After: 1")
+        try:
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, reader: asyncio.StreamReader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Yêu cầu không hợp lệ")
+        method, path, _ = request_line
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if method == "GET" and path == "/health":
+            return HTTPStatus.OK, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            return HTTPStatus.OK, self.metrics()
+        if method == "GET" and path == "/metrics/prometheus":
+            return HTTPStatus.OK, tracer.prometheus()
+        if method != "POST" or path != "/chat":
+            raise RequestError(HTTPStatus.NOT_FOUND, "Không tìm thấy đường dẫn")
+
+        try:
+            length = int(headers.get("content-length", 0))
+            if length < 0:
+                raise ValueError(f"Content-Length âm: {length}")
+            if length > MAX_BODY_BYTES:
+                raise RequestError(HTTPStatus.BAD_REQUEST, f"Body quá dài (tối đa {MAX_BODY_BYTES} bytes)")
+            data = json.loads(await reader.readexactly(length))
+            query = str(data["query"]).strip()
+            timeout = float(data["timeout"]) if data.get("timeout") else None
+            # Tùy chọn: cùng session_id thì câu hỏi nối tiếp dùng lại ngữ cảnh của các lượt trước
+            session_id = str(data["session_id"])[:MAX_SESSION_ID_CHARS] if data.get("session_id") else None
+        except (ValueError, KeyError, TypeError, asyncio.IncompleteReadError):
+            raise RequestError(HTTPStatus.BAD_REQUEST, 'Body phải là JSON dạng {"query": "...", "session_id": "..."}')
+        if not query:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "Câu hỏi rỗng")
+        return HTTPStatus.OK, await self.answer(query, timeout, session_id)
+
+
+async def serve(host: str = HOST, port: int = PORT, **kwargs) -> None:
+    rag_server = RagServer(**kwargs)
+    await rag_server.start()
+    server = await asyncio.start_server(rag_server.handle, host, port)
+    print(f"🚀 Đang phục vụ tại http://{host}:{port} (POST /chat, GET /metrics) | "
+          f"{rag_server.llm_workers} LLM worker, hàng đợi {rag_server.queue_size}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await rag_server.stop()
+        print(f"📊 Cache câu trả lời: {answer_cache.get_stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP server cho chatbot RAG")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--llm-workers", type=int, default=LLM_WORKERS, help="Số bản LlamaCpp thường trú")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="Số câu hỏi chờ sinh tối đa (quá sẽ trả 429)")
+    parser.add_argument("--retrieval-threads", type=int, default=RETRIEVAL_THREADS)
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="Hạn xử lý mỗi câu hỏi (giây)")
+    parser.add_argument("--no-tracing", action="store_true", help="Tắt đo thời gian từng giai đoạn")
+    parser.add_argument("--trace-log", help="Ghi trace của từng request vào file JSON lines")
+    parser.add_argument("--no-gate", action="store_true",
+                        help="Tắt cổng độ tin cậy: mọi câu hỏi tài liệu đều sinh bằng LLM")
+    parser.add_argument("--mmr", type=float, nargs="?", const=utils.MMR_LAMBDA, metavar="LAMBDA",
+                        help="Đa dạng hóa context bằng MMR (mặc định tắt; không giá trị = %(const)s)")
+    parser.add_argument("--warm-similarity", type=float, default=WARM_SIMILARITY,
+                        help="Cosine tối thiểu với chủ đề của phiên để dùng lại chunk ấm "
+                             "(hiệu chỉnh bằng session_store.calibrate_warm_similarity)")
+    args = parser.parse_args()
+    tracer.enabled = not args.no_tracing
+    tracer.jsonl_path = args.trace_log
+    retrieval_gate.enabled = not args.no_gate
+    utils.mmr_lambda = args.mmr
+    session_store.warm_similarity = args.warm_similarity
+    try:
+        asyncio.run(serve(args.host, args.port, llm_workers=args.llm_workers, queue_size=args.queue_size,
+                          retrieval_threads=args.retrieval_threads, timeout=args.timeout))
+    except KeyboardInterrupt:
+        print("\n👋 Dừng máy chủ.")
@@ -0,0 +1,281 @@
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Cau hinh
+# Giới hạn chung cho mọi phiên: số phiên và tổng bộ nhớ ước tính
+MAX_SESSIONS = 10_000
+MEMORY_BUDGET_MB = 64
+# Phiên không hoạt động quá lâu bị xóa trước, sau đó mới xóa theo LRU
+SESSION_IDLE_S = 30 * 60
+# Số lượt gần nhất giữ nguyên văn, các lượt cũ hơn được nén vào bản tóm tắt
+RECENT_TURNS = 4
+SUMMARY_TOKENS = 96
+# Ước lượng token tiếng Việt theo số từ (không cần gọi tokenizer của LLM)
+TOKENS_PER_WORD = 2.0
+MAX_QUERY_CHARS = 300
+MAX_ANSWER_CHARS = 600
+# Tập chunk "ấm" của chủ đề hiện tại, dùng lại cho câu hỏi nối tiếp
+MAX_WARM_CHUNKS = 32
+# Cosine giữa câu hỏi mới và chủ đề để coi là cùng chủ đề; phụ thuộc model embedding nên cần
+# hiệu chỉnh lại bằng calibrate_warm_similarity trên tập câu hỏi nối tiếp đã gán nhãn khi đổi model
+WARM_SIMILARITY = 0.75
+# Câu hỏi ngắn có từ chỉ định ("cái đó", "còn ... thì sao") được coi là câu hỏi nối tiếp
+FOLLOWUP_PATTERN = re.compile(r"\b(đó|đấy|nó|kia|còn|thì sao|nói trên|ở trên|vừa rồi)\b", re.IGNORECASE)
+FOLLOWUP_MAX_WORDS = 8
+# Chi phí cố định ước tính của một phiên / một lượt (đối tượng, deque, tuple)
+SESSION_OVERHEAD_BYTES = 1024
+TURN_OVERHEAD_BYTES = 120
+
+
+def approx_tokens(text: str) -> int:
+    return int(len(text.split()) * TOKENS_PER_WORD)
+
+
+def is_followup(query: str) -> bool:
+    """Câu hỏi ngắn tham chiếu tới nội dung trước đó"""
+    return len(query.split()) <= FOLLOWUP_MAX_WORDS and FOLLOWUP_PATTERN.search(query) is not None
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def calibrate_warm_similarity(labelled: Sequence[Tuple[str, str, bool]],
+                              embed_query: Callable[[str], Sequence[float]]) -> Tuple[float, float]:
+    """Ngưỡng cosine phân loại đúng nhiều nhất trên tập (câu hỏi trước, câu hỏi sau, cùng chủ đề?)
+
+    Câu hỏi nối tiếp dạng "cái đó" luôn được coi là cùng chủ đề nên không dùng để hiệu chỉnh.
+    Trả về (ngưỡng, độ chính xác); nhiều ngưỡng chính xác như nhau thì lấy ngưỡng ở giữa.
+    """
+    pairs = [(float(_unit(embed_query(previous)) @ _unit(embed_query(query))), same)
+             for previous, query, same in labelled if not is_followup(query)]
+    if not pairs:
+        raise ValueError("Tập gán nhãn không có câu hỏi nào ngoài dạng nối tiếp")
+    similarities = sorted({similarity for similarity, _ in pairs})
+    # Ứng viên: điểm giữa hai cosine liên tiếp, cộng hai đầu mút
+    candidates = [similarities[0] - 1e-6] + [(a + b) / 2 for a, b in zip(similarities, similarities[1:])] \
+        + [similarities[-1] + 1e-6]
+    scores = [sum((similarity >= threshold) == same for similarity, same in pairs) / len(pairs)
+              for threshold in candidates]
+    best = max(scores)
+    chosen = [threshold for threshold, score in zip(candidates, scores) if score == best]
+    return chosen[len(chosen) // 2], best
+
+
+def _first_sentence(text: str, max_words: int = 30) -> str:
+    sentence = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0]
+    words = sentence.split()
+    return " ".join(words[:max_words]) + (" ..." if len(words) > max_words else "")
+
+
+class Session:
+    """Trạng thái hội thoại của một người dùng"""
+
+    __slots__ = ("id", "turns", "summary", "chunk_ids", "topic", "last_seen", "bytes")
+
+    def __init__(self, session_id: str, recent_turns: int):
+        self.id = session_id
+        # (câu hỏi, câu trả lời) của các lượt gần nhất
+        self.turns: Deque[Tuple[str, str]] = deque(maxlen=recent_turns)
+        self.summary = ""
+        # id chunk (trong bảng chunk) đã lấy cho chủ đề hiện tại, mới nhất trước
+        self.chunk_ids = np.zeros(0, dtype=np.int32)
+        # Vector chủ đề (đã chuẩn hóa, float16 cho gọn)
+        self.topic: Optional[np.ndarray] = None
+        self.last_seen = time.monotonic()
+        self.bytes = 0
+
+    def estimate_bytes(self) -> int:
+        size = SESSION_OVERHEAD_BYTES + sys.getsizeof(self.id) + sys.getsizeof(self.summary)
+        size += sum(TURN_OVERHEAD_BYTES + sys.getsizeof(query) + sys.getsizeof(answer)
+                    for query, answer in self.turns)
+        size += self.chunk_ids.nbytes + (self.topic.nbytes if self.topic is not None else 0)
+        return size
+
+
+class SessionStore:
+    """Kho phiên hội thoại theo session id, giới hạn số phiên và tổng bộ nhớ
+
+    Mỗi phiên giữ vài lượt gần nhất, bản tóm tắt giới hạn token của các lượt cũ và tập chunk
+    của chủ đề hiện tại. Phiên quá hạn không hoạt động bị xóa trước, sau đó xóa theo LRU.
+    """
+
+    def __init__(self,
+                 max_sessions: int = MAX_SESSIONS,
+                 memory_budget_mb: float = MEMORY_BUDGET_MB,
+                 idle_ttl: float = SESSION_IDLE_S,
+                 recent_turns: int = RECENT_TURNS,
+                 summary_tokens: int = SUMMARY_TOKENS,
+                 warm_similarity: float = WARM_SIMILARITY,
+                 count_tokens: Callable[[str], int] = approx_tokens):
+        self.max_sessions = max_sessions
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.idle_ttl = idle_ttl
+        self.recent_turns = recent_turns
+        self.summary_tokens = summary_tokens
+        self.warm_similarity = warm_similarity
+        self.count_tokens = count_tokens
+        self.version = ""
+        self._lock = threading.Lock()
+        # Thứ tự LRU: phiên ít được dùng gần đây nhất ở đầu
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._bytes = 0
+        self.stats = {"turns": 0, "warm_hits": 0, "warm_misses": 0,
+                      "idle_evictions": 0, "lru_evictions": 0}
+
+    def _evict(self, now: float) -> None:
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_seen > self.idle_ttl:
+                self.stats["idle_evictions"] += 1
+            elif len(self._sessions) > self.max_sessions or self._bytes > self.memory_budget:
+                self.stats["lru_evictions"] += 1
+            else:
+                break
+            self._drop(session.id)
+
+    def _drop(self, session_id: str) -> None:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._bytes -= session.bytes
+
+    def _touch(self, session_id: str, create: bool) -> Optional[Session]:
+        session = self._sessions.get(session_id)
+        now = time.monotonic()
+        if session is not None and now - session.last_seen > self.idle_ttl:
+            self.stats["idle_evictions"] += 1
+            self._drop(session_id)
+            session = None
+        if session is None:
+            if not create:
+                return None
+            session = self._sessions[session_id] = Session(session_id, self.recent_turns)
+        session.last_seen = now
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _resize(self, session: Session) -> None:
+        size = session.estimate_bytes()
+        self._bytes += size - session.bytes
+        session.bytes = size
+
+    def set_version(self, version: str) -> None:
+        """Đổi phiên bản index: id chunk cũ không còn đúng nên bỏ tập chunk ấm (giữ lịch sử)"""
+        with self._lock:
+            if version == self.version:
+                return
+            self.version = version
+            for session in self._sessions.values():
+                session.chunk_ids = np.zeros(0, dtype=np.int32)
+                session.topic = None
+                self._resize(session)
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._drop(session_id)
+
+    def _compress(self, summary: str, query: str, answer: str) -> str:
+        """Thêm lượt cũ vào bản tóm tắt, bỏ phần cũ nhất khi vượt SUMMARY_TOKENS"""
+        lines = [line for line in summary.split("\n") if line]
+        lines.append(f"- {_first_sentence(query)} → {_first_sentence(answer)}")
+        while len(lines) > 1 and self.count_tokens("\n".join(lines)) > self.summary_tokens:
+            lines.pop(0)
+        words = lines[0].split()
+        while words and self.count_tokens(" ".join(words)) > self.summary_tokens:
+            words = words[len(words) // 4 + 1:]
+        lines[0] = " ".join(words)
+        return "\n".join(line for line in lines if line)
+
+    def add_turn(self, session_id: str, query: str, answer: str,
+                 chunk_ids: Optional[Sequence[int]] = None, query_vector=None, warm: bool = False) -> None:
+        """Ghi một lượt hỏi đáp; lượt có retrieval cập nhật tập chunk và vector chủ đề"""
+        with self._lock:
+            session = self._touch(session_id, create=True)
+            if len(session.turns) == session.turns.maxlen:
+                session.summary = self._compress(session.summary, *session.turns[0])
+            session.turns.append((query[:MAX_QUERY_CHARS], answer[:MAX_ANSWER_CHARS]))
+
+            if chunk_ids is not None and query_vector is not None:
+                ids = np.asarray(chunk_ids, dtype=np.int32)
+                unit = _unit(query_vector)
+                if warm and session.topic is not None:
+                    # Cùng chủ đề: gộp chunk mới vào tập cũ, chủ đề trôi dần theo câu hỏi mới
+                    merged = np.concatenate([ids, session.chunk_ids])
+                    _, first = np.unique(merged, return_index=True)
+                    ids = merged[np.sort(first)]
+                    unit = _unit(session.topic.astype(np.float32) + unit)
+                session.chunk_ids = ids[:MAX_WARM_CHUNKS].copy()
+                session.topic = unit.astype(np.float16)
+
+            self.stats["turns"] += 1
+            self._resize(session)
+            self._evict(time.monotonic())
+
+    def has_topic(self, session_id: str) -> bool:
+        """Phiên có chủ đề tài liệu (tập chunk ấm) đang dùng"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session is not None and session.topic is not None and len(session.chunk_ids) > 0
+
+    def warm_candidates(self, session_id: str, query: str,
+                        query_vector) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """(id chunk, vector xếp hạng) nếu câu hỏi tiếp tục chủ đề trước, ngược lại None"""
+        with self._lock:
+            session = self._touch(session_id, create=False)
+            if session is None or session.topic is None or not len(session.chunk_ids):
+                self.stats["warm_misses"] += 1
+                return None
+            unit = _unit(query_vector)
+            topic = session.topic.astype(np.float32)
+            followup = is_followup(query)
+            if not followup and float(unit @ topic) < self.warm_similarity:
+                self.stats["warm_misses"] += 1
+                return None
+            self.stats["warm_hits"] += 1
+            # Câu hỏi nối tiếp ngắn ("cái đó") mang ít thông tin nên xếp hạng theo cả chủ đề
+            rank_vector = _unit(unit + topic) if followup else unit
+            return session.chunk_ids.astype(np.int64), rank_vector
+
+    def history(self, session_id: str, count_tokens: Optional[Callable[[str], int]] = None,
+                budget: int = 256) -> str:
+        """Tóm tắt + các lượt gần nhất dạng văn bản cho prompt, bỏ phần cũ nhất khi vượt `budget` token"""
+        count_tokens = count_tokens or self.count_tokens
+        with self._lock:
+            session = self._touch(session_id, create=False)
+            if session is None:
+                return ""
+            turns = list(session.turns)
+            summary = session.summary
+        lines: List[str] = []
+        used = 0
+        for query, answer in reversed(turns):
+            line = f"Người dùng: {query}\nTrợ lý: {answer}"
+            cost = count_tokens(line)
+            if used + cost > budget:
+                break
+            lines.insert(0, line)
+            used += cost
+        if summary and len(lines) == len(turns):
+            line = f"Tóm tắt trước đó:\n{summary}"
+            if used + count_tokens(line) <= budget:
+                lines.insert(0, line)
+        return "\n".join(lines)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            self._evict(time.monotonic())
+            return {**self.stats, "sessions": len(self._sessions),
+                    "memory_mb": self._bytes / 1024 / 1024,
+                    "memory_budget_mb": self.memory_budget / 1024 / 1024}
+
+
+# Kho phiên dùng chung cho cả tiến trình
+session_store = SessionStore()
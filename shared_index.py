@@ -0,0 +1,133 @@
+import json
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+
+from bm25_index import BM25_INDEX_PATH, BM25Index
+from chunk_store import CHUNK_STORE_PATH, ChunkStore
+from faiss_index import build_index, faiss_metric, load_index_params, set_search_param
+from generations import commit_generation, current_path, new_generation
+from quantized_store import vectors_in_store_order
+
+# Cau hinh
+SHARED_FAISS_PATH = "vectorstores/shared_faiss"
+STORE_VERSION = 1
+
+
+class SharedVectorStore:
+    """Nhánh FAISS cho nhiều worker: index.faiss được mmap (không copy), chunk lấy từ kho chunk mmap
+
+    Vector nằm theo thứ tự kho chunk nên id FAISS chính là id chunk, không cần docstore pickle.
+    """
+
+    def __init__(self, index, docs: Optional[Sequence[Document]] = None, embeddings=None, metric: str = "l2"):
+        self.index = index
+        self.docs = docs
+        self.embeddings = embeddings
+        self.metric = metric
+        # Giữ giao diện giống FAISS của LangChain cho các hàm trong hybrid.py
+        self.distance_strategy = (DistanceStrategy.MAX_INNER_PRODUCT if metric == "ip"
+                                  else DistanceStrategy.EUCLIDEAN_DISTANCE)
+        self._normalize_L2 = False
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    def search_many(self, query_vectors, k: int = 5) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Trả về (chỉ số chunk, điểm) cho mỗi truy vấn, điểm càng cao càng gần"""
+        vectors = np.ascontiguousarray(np.atleast_2d(query_vectors), dtype=np.float32)
+        scores, indices = self.index.search(vectors, k)
+        sign = 1.0 if self.metric == "ip" else -1.0
+        results = []
+        for row_scores, row_indices in zip(scores, indices):
+            keep = row_indices >= 0
+            results.append((row_indices[keep], sign * row_scores[keep]))
+        return results
+
+    def search(self, query_vector, k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        return self.search_many(query_vector, k)[0]
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 4) -> List[Tuple[Document, float]]:
+        """Cùng quy ước với FAISS của LangChain: L2 trả về khoảng cách (càng nhỏ càng gần)"""
+        ids, scores = self.search(embedding, k)
+        sign = 1.0 if self.metric == "ip" else -1.0
+        return [(self.docs[i], sign * float(score)) for i, score in zip(ids, scores)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    @staticmethod
+    def save(index, path: str = SHARED_FAISS_PATH, metric: str = "l2", signature: str = "") -> None:
+        """Ghi vào một thế hệ mới: worker đang mmap index.faiss cũ không bị cắt file giữa chừng"""
+        gen_path = new_generation(path)
+        faiss.write_index(index, os.path.join(gen_path, "index.faiss"))
+        meta = {"version": STORE_VERSION, "metric": metric, "count": index.ntotal, "signature": signature}
+        with open(os.path.join(gen_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=2)
+        commit_generation(path, gen_path)
+
+    @classmethod
+    def load(cls, path: str = SHARED_FAISS_PATH, docs: Optional[Sequence[Document]] = None,
+             embeddings=None, signature: Optional[str] = None) -> Optional["SharedVectorStore"]:
+        """Mở thế hệ hiện tại bằng mmap, trả về None nếu chưa có hoặc không khớp với kho chunk"""
+        path = current_path(path)
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != STORE_VERSION:
+            return None
+        if signature is not None and meta.get("signature") != signature:
+            return None
+        index_path = os.path.join(path, "index.faiss")
+        try:
+            # Flat: vector được map thẳng từ file, các worker dùng chung page cache
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # Loại index chưa hỗ trợ map trực tiếp (HNSW...)
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        return cls(index, docs, embeddings, meta["metric"])
+
+
+def store_signature(store: ChunkStore, embeddings, db_path: str = "vectorstores/db_faiss") -> str:
+    """Đổi khi kho chunk, model embedding hoặc loại index (faiss_index.py --save) thay đổi"""
+    params = json.dumps(load_index_params(db_path), sort_keys=True)
+    return f"{store.signature()}:{getattr(embeddings, 'model_id', '')}:{params}"
+
+
+def save_shared_index(store: ChunkStore, vector_store: FAISS, embeddings,
+                      path: str = SHARED_FAISS_PATH, db_path: str = "vectorstores/db_faiss") -> None:
+    """Ghi lại FAISS index theo thứ tự kho chunk (cùng loại index đã chọn khi tune)"""
+    params = load_index_params(db_path)
+    index = build_index(vectors_in_store_order(vector_store, store), params["kind"], faiss_metric(vector_store))
+    if params.get("param"):
+        set_search_param(index, params["param"], params["value"])
+    metric = "ip" if vector_store.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT else "l2"
+    SharedVectorStore.save(index, path, metric, store_signature(store, embeddings, db_path))
+
+
+def open_shared_index(embeddings, store_path: str = CHUNK_STORE_PATH, bm25_path: str = BM25_INDEX_PATH,
+                      faiss_path: str = SHARED_FAISS_PATH,
+                      db_path: str = "vectorstores/db_faiss") -> Tuple[BM25Index, SharedVectorStore]:
+    """Mở kho chunk, BM25 và FAISS chỉ bằng mmap: không chia PDF, không dựng lại, không unpickle
+
+    Dành cho worker; index được tạo/cập nhật bởi indexer.py.
+    """
+    store = ChunkStore.load(store_path)
+    if store is None:
+        raise FileNotFoundError(f"Chưa có kho chunk tại {store_path}, hãy chạy indexer.py trước")
+    bm25 = BM25Index.load(bm25_path, docs=store, signature=store.signature())
+    vector_store = SharedVectorStore.load(faiss_path, docs=store, embeddings=embeddings,
+                                          signature=store_signature(store, embeddings, db_path))
+    if bm25 is None or vector_store is None:
+        raise FileNotFoundError("Index chia sẻ đã cũ hoặc chưa được tạo, hãy chạy indexer.py")
+    return bm25, vector_store
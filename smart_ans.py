@@ -1,12 +1,64 @@
 from datetime import datetime
-import re
-from langchain_community.llms import LlamaCpp
+import time
+from typing import Iterable, Iterator, Optional
 from langchain.prompts import PromptTemplate
 from pattern_manager import PatternManager
-from langchain.chains import LLMChain
-from utils import hybrid_retriever
+from utils import fused_score_ceiling, hybrid_retriever_with_ids
+from model_registry import LLM_CONFIG, get_llm
+from context_packer import pack_context
+from answer_cache import ANSWER_CACHE_PATH, AnswerCache
+from prompt_cache import prompt_prefix_cache
+from session_store import is_followup, session_store
+from retrieval_gate import retrieval_gate
+from tracing import TOKENS_PER_S_BUCKETS, tracer
 
 pattern_manager = PatternManager()
+# Cache câu trả lời cho các câu hỏi tài liệu (khớp chính xác + khớp ngữ nghĩa)
+answer_cache = AnswerCache(path=ANSWER_CACHE_PATH)
+
+# Prompt cho từng loại câu hỏi
+DOC_PROMPT = PromptTemplate(
+    template="""<|im_start|>system\nBạn là AI HÀN BẢO, một trợ lý AI thân thiện. Sử dụng thông tin sau đây để trả lời câu hỏi. Nếu bạn không biết câu trả lời, hãy nói không biết, đừng cố tạo ra câu trả lời\n
+    {context}<|im_end|>\n<|im_start|>user\n{question}<|im_end|>\n<|im_start|>assistant""",
+    input_variables=["context", "question"]
+)
+
+CHITCHAT_PROMPT = PromptTemplate(
+    template="""Bạn là AI HÀN BẢO, một trợ lý AI thân thiện. 
+    Hãy trả lời câu hỏi sau một cách tự nhiên và thân thiện:
+    
+    Câu hỏi: {question}
+    
+    Intent: {intent}
+    Confidence: {confidence}
+    
+    Trả lời:""",
+    input_variables=["question", "intent", "confidence"]
+)
+
+GENERAL_PROMPT = PromptTemplate(
+    template="""Bạn là AI HÀN BẢO. Hãy trả lời câu hỏi sau một cách thân thiện và vui nhộn:
+    
+    Câu hỏi: {question}
+    
+    Intent: {intent}
+    Confidence: {confidence}
+    
+    Trả lời:""",
+    input_variables=["question", "intent", "confidence"]
+)
+
+# Số chunk ứng viên lấy từ hybrid search, context được xếp theo điểm cho tới khi hết ngân sách token
+CONTEXT_CANDIDATES = 8
+# Chừa thêm vài token cho sai lệch khi tách token từng phần riêng lẻ
+PROMPT_MARGIN_TOKENS = 16
+# Tối đa token lịch sử hội thoại (tóm tắt + lượt gần nhất) đưa vào context
+HISTORY_TOKENS = 256
+
+NOT_FOUND_ANSWER = "Tôi không tìm thấy thông tin liên quan trong tài liệu."
+
+# Ký tự bị cắt ở hai đầu câu trả lời sau khi bỏ phần lặp lại câu hỏi
+STRIP_CHARS = " ,.:"
 
 
 def preprocess_query(query: str) -> str:
@@ -27,43 +79,13 @@ def preprocess_query(query: str) -> str:
 def classify_query(query: str) -> tuple[str, float, str]:
     """Phân loại và cho điểm câu hỏi thông minh hơn"""
     query = preprocess_query(query)
-    pm = PatternManager()
-    
-    # Tính điểm với trọng số cho chitchat
-    chitchat_score = 0
-    chitchat_weights = {
-        'greeting': 1.5,
-        'emotion': 1.3,
-        'personal': 1.2,
-        'smalltalk': 1.1,
-        'opinion': 0.9
-    }
-    
-    found_chitchat_intent = None
-    for intent, pattern in pm.chitchat_patterns.items():
-        if re.search(pattern, query):
-            weight = chitchat_weights.get(intent, 1.0)
-            chitchat_score += weight
-            if not found_chitchat_intent:
-                found_chitchat_intent = intent
-            
-    # Tính điểm với trọng số cho document
-    doc_score = 0
-    doc_weights = {
-        'technical': 1.5,
-        'analyze': 1.3,
-        'find': 1.2,
-        'what': 1.1,
-        'how': 1.1
-    }
-    
-    found_doc_intent = None
-    for intent, pattern in pm.doc_patterns.items():
-        if re.search(pattern, query):
-            weight = doc_weights.get(intent, 1.0)
-            doc_score += weight
-            if not found_doc_intent:
-                found_doc_intent = intent
+    
+    # Quét tất cả pattern một lần, điểm đã tính theo trọng số của PatternManager
+    match = pattern_manager.match(query)
+    chitchat_score = match.chitchat_score
+    doc_score = match.doc_score
+    found_chitchat_intent = match.chitchat_intents[0] if match.chitchat_intents else None
+    found_doc_intent = match.doc_intents[0] if match.doc_intents else None
     
     # Quyết định loại câu hỏi với ngưỡng điểm
     if chitchat_score > doc_score and chitchat_score >= 1.0:
@@ -74,91 +96,253 @@ def classify_query(query: str) -> tuple[str, float, str]:
         # Nếu không rõ ràng, chuyển xuống LLM xử lý
         return "general", 0.5, "general"
 
-def smart_response(query: str, bm25_retriever, vector_store):
-    """Xử lý câu hỏi và trả về câu trả lời phù hợp"""
-    llm = None
-    try:
-        # Phân loại câu hỏi trước
+def pattern_answer(query: str, session_id: Optional[str] = None) -> Optional[str]:
+    """Câu trả lời chitchat có sẵn từ PatternManager (không cần retrieval hay LLM), nếu có
+
+    Có `session_id` thì lượt này cũng được ghi vào lịch sử hội thoại như các nhánh trả lời khác.
+    """
+    answer = pattern_manager.direct_answer(query)
+    if answer is not None:
+        remember_turn({"session_id": session_id}, query, answer)
+    return answer
+
+def remember_turn(plan: dict, query: str, answer: str) -> None:
+    """Ghi lượt hỏi đáp vào phiên hội thoại của plan (nếu có)"""
+    if plan.get("session_id"):
+        session_store.add_turn(plan["session_id"], query, answer, plan.get("chunk_ids"),
+                               plan.get("query_vector"), warm=plan.get("warm", False))
+
+def plan_response(query: str, bm25_retriever, vector_store, session_id: Optional[str] = None) -> dict:
+    """Chuẩn bị câu trả lời: trả lời ngay ({"answer"}) hoặc prompt cần sinh bằng LLM
+
+    Có `session_id` thì câu hỏi nối tiếp cùng chủ đề dùng lại chunk của các lượt trước
+    và lịch sử hội thoại được đưa vào context.
+    """
+    plan = _plan_response(query, bm25_retriever, vector_store, session_id)
+    plan["session_id"] = session_id
+    if "answer" in plan:
+        remember_turn(plan, query, plan["answer"])
+    return plan
+
+def _plan_response(query: str, bm25_retriever, vector_store, session_id: Optional[str]) -> dict:
+    # Phân loại câu hỏi trước
+    with tracer.span("classification") as span:
         query_type, confidence, intent = classify_query(query)
-        
-        # Kiểm tra trong PatternManager cho chitchat
-        pattern_manager = PatternManager()
+        span.set(query_type=query_type, intent=intent)
+    tracer.annotate(query_type=query_type)
+    
+    # Kiểm tra trong PatternManager cho chitchat
+    with tracer.span("pattern") as span:
         responses = pattern_manager.get_responses(query)
+        span.set(cache_hit=responses[0] not in ["DOCUMENT_QUERY", "GENERAL_QUERY"])
+    
+    # Nếu có câu trả lời chitchat rõ ràng
+    if responses[0] not in ["DOCUMENT_QUERY", "GENERAL_QUERY"]:
+        tracer.annotate(source="pattern")
+        return {"answer": responses[0]}
+
+    # Câu hỏi nối tiếp ("còn cái đó thì sao?") trong phiên đang hỏi về tài liệu cũng đi nhánh tài liệu;
+    # nó chỉ có nghĩa trong phiên nên không tra cache chung
+    followup = bool(session_id) and is_followup(query) and session_store.has_topic(session_id)
+    
+    # Xử lý câu hỏi liên quan đến tài liệu
+    if responses[0] == "DOCUMENT_QUERY" or (query_type == "document") or followup:
+        # Tra cache theo câu hỏi đã chuẩn hóa trước khi truy vấn RAG
+        cache_key = preprocess_query(query)
+        if not followup:
+            with tracer.span("answer_cache_exact") as span:
+                cached = answer_cache.get_exact(cache_key)
+                span.set(cache_hit=cached is not None)
+            if cached is not None:
+                tracer.annotate(source="cache")
+                return {"answer": cached}
         
-        # Nếu có câu trả lời chitchat rõ ràng
-        if responses[0] not in ["DOCUMENT_QUERY", "GENERAL_QUERY"]:
-            return responses[0]
-
-        # Khởi tạo LLM
-        llm = LlamaCpp(
-            model_path="models/vinallama-7b-chat_q5_0.gguf",
-            temperature=0.3,
-            max_tokens=512,
-            n_ctx=2048,
-            top_p=0.9,
-            verbose=False,
-            n_gpu_layers=32,
-            n_batch=512       
-        )
-
-        # Xử lý câu hỏi liên quan đến tài liệu
-        if responses[0] == "DOCUMENT_QUERY" or (query_type == "document"):
-            # Truy vấn RAG
-            docs = hybrid_retriever(query, bm25_retriever, vector_store)
-            if not docs:
-                return "Tôi không tìm thấy thông tin liên quan trong tài liệu."
-            
-            context = "\n".join([doc.page_content for doc in docs])
-            
-            # Tạo Prompt
-            template = """<|im_start|>system\nBạn là AI HÀN BẢO, một trợ lý AI thân thiện. Sử dụng thông tin sau đây để trả lời câu hỏi. Nếu bạn không biết câu trả lời, hãy nói không biết, đừng cố tạo ra câu trả lời\n
-                {context}<|im_end|>\n<|im_start|>user\n{question}<|im_end|>\n<|im_start|>assistant"""
-            prompt = PromptTemplate(template=template, input_variables=["context", "question"])
-            
-            chain = LLMChain(llm=llm, prompt=prompt)
-            response = chain.run(context=context, question=query)
-            
-            # Loại bỏ phần lặp lại câu hỏi nếu có
-            if response.lower().startswith(query.lower()):
-                response = response[len(query):].strip(" ,.:")
-            
-            return response
+        # Vector câu hỏi dùng cho cả tầng cache ngữ nghĩa và nhánh FAISS
+        with tracer.span("embedding"):
+            query_vector = vector_store.embeddings.embed_query(query)
+        if not followup:
+            with tracer.span("answer_cache_semantic") as span:
+                cached = answer_cache.get_semantic(query_vector)
+                span.set(cache_hit=cached is not None)
+            if cached is not None:
+                tracer.annotate(source="cache")
+                return {"answer": cached}
         
-        # Xử lý câu hỏi chitchat
-        elif query_type == "chitchat" and confidence >= 0.7:
-            chitchat_prompt = PromptTemplate(
-                template="""Bạn là AI HÀN BẢO, một trợ lý AI thân thiện. 
-                Hãy trả lời câu hỏi sau một cách tự nhiên và thân thiện:
-                
-                Câu hỏi: {question}
-                
-                Intent: {intent}
-                Confidence: {confidence}
-                
-                Trả lời:""",
-                input_variables=["question", "intent", "confidence"]
-            )
-            
-            chain = LLMChain(llm=llm, prompt=chitchat_prompt)
-            response = chain.run(question=query, intent=intent, confidence=confidence)
-            return f"[Chitchat - {intent}] {response}"
+        # Cùng chủ đề với lượt trước: chỉ xếp hạng lại các chunk đã lấy, bỏ qua hybrid search
+        warm = session_store.warm_candidates(session_id, query, query_vector) if session_id else None
+        candidates, rank_vector = warm if warm is not None else (None, None)
         
-        # Xử lý câu hỏi thông thường
-        else:
-            general_prompt = PromptTemplate(
-                template="""Bạn là AI HÀN BẢO. Hãy trả lời câu hỏi sau một cách thân thiện và vui nhộn:
-                
-                Câu hỏi: {question}
-                
-                Intent: {intent}
-                Confidence: {confidence}
-                
-                Trả lời:""",
-                input_variables=["question", "intent", "confidence"]
+        # Truy vấn RAG
+        with tracer.span("retrieval", warm=warm is not None) as span:
+            scored_docs, chunk_ids = hybrid_retriever_with_ids(
+                query, bm25_retriever, vector_store, query_vector, k=CONTEXT_CANDIDATES,
+                candidates=candidates, rank_vector=rank_vector
             )
-            
-            chain = LLMChain(llm=llm, prompt=general_prompt)
-            return chain.run(question=query, intent=intent, confidence=confidence)
-    finally:
-        if llm:
-            del llm
+            span.set(candidates=len(scored_docs))
+        session = {"chunk_ids": chunk_ids, "query_vector": query_vector, "warm": warm is not None}
+        if not scored_docs:
+            tracer.annotate(source="not_found")
+            return {"answer": NOT_FOUND_ANSWER, "source": "not_found", **session}
+        
+        # Cổng độ tin cậy: không tìm thấy / trích xuất câu trả lời cho câu hỏi tra cứu, bỏ qua LLM.
+        # Lượt dùng lại chunk ấm cũng qua cổng, đo độ gần bằng vector xếp hạng (câu nối tiếp kèm chủ đề);
+        # điểm của nó là cosine / thứ hạng chứ không phải điểm kết hợp nên không được trả lời trích xuất
+        if retrieval_gate.enabled:
+            with tracer.span("gate", warm=warm is not None) as span:
+                intents = pattern_manager.match(preprocess_query(query)).doc_intents
+                gate_vector = rank_vector if rank_vector is not None else query_vector
+                max_score = fused_score_ceiling() if warm is None else None
+                decision, answer = retrieval_gate.evaluate(query, intents, scored_docs, chunk_ids, gate_vector,
+                                                           max_score, bm25_retriever, vector_store)
+                span.set(**decision._asdict(), intents=",".join(intents), **retrieval_gate.thresholds())
+            tracer.count("gate_decisions_total", decision=decision.action)
+            if decision.action == "not_found":
+                tracer.annotate(source="not_found")
+                return {"answer": NOT_FOUND_ANSWER, "source": "not_found", **session}
+            if decision.action == "extractive":
+                tracer.annotate(source="extractive")
+                return {"answer": answer, "source": "extractive", **session}
+        
+        # Ngân sách token cho context: n_ctx trừ phần sinh câu trả lời và phần còn lại của prompt
+        with tracer.span("context") as span:
+            llm = get_llm()
+            prompt_tokens = llm.get_num_tokens(DOC_PROMPT.format(context="", question=query))
+            budget = LLM_CONFIG["n_ctx"] - LLM_CONFIG["max_tokens"] - prompt_tokens - PROMPT_MARGIN_TOKENS
+            # Lịch sử chỉ cần cho câu hỏi tiếp tục chủ đề trước; câu hỏi độc lập giữ prompt ngắn và cache được
+            history = ""
+            if followup or warm is not None:
+                history = session_store.history(session_id, llm.get_num_tokens, HISTORY_TOKENS)
+            if history:
+                history = f"Lịch sử hội thoại:\n{history}\nTài liệu:\n"
+                budget -= llm.get_num_tokens(history)
+            context, context_info = pack_context(scored_docs, llm.get_num_tokens, budget)
+            context_info["history_tokens"] = llm.get_num_tokens(history) if history else 0
+            span.set(chunks=context_info["chunks"], tokens=context_info["tokens"])
+        return {
+            "template": "document",
+            "prompt": DOC_PROMPT,
+            "inputs": {"context": history + context, "question": query},
+            "strip_query": True,
+            # Câu trả lời dựa trên lịch sử của một phiên không được dùng lại cho người khác
+            "cache": None if history or followup or warm is not None else (cache_key, query_vector),
+            "context_info": context_info,
+            **session,
+        }
+    
+    # Xử lý câu hỏi chitchat
+    elif query_type == "chitchat" and confidence >= 0.7:
+        return {
+            "template": "chitchat",
+            "prompt": CHITCHAT_PROMPT,
+            "inputs": {"question": query, "intent": intent, "confidence": confidence},
+            "prefix": f"[Chitchat - {intent}] ",
+        }
+    
+    # Xử lý câu hỏi thông thường
+    else:
+        return {
+            "template": "general",
+            "prompt": GENERAL_PROMPT,
+            "inputs": {"question": query, "intent": intent, "confidence": confidence},
+        }
+
+def strip_repeated_question(tokens: Iterable[str], query: str) -> Iterator[str]:
+    """Bỏ phần lặp lại câu hỏi ở đầu câu trả lời, xử lý dần theo từng token"""
+    tokens = iter(tokens)
+    target = query.lower()
+    
+    # Gom token cho tới khi đủ dài để biết câu trả lời có lặp lại câu hỏi không
+    buffer = ""
+    for token in tokens:
+        buffer += token
+        if len(buffer) >= len(target) or not target.startswith(buffer.lower()):
+            break
+    
+    if not buffer.lower().startswith(target):
+        if buffer:
+            yield buffer
+        yield from tokens
+        return
+    
+    # Câu trả lời lặp lại câu hỏi: bỏ phần đó và cắt " ,.:" ở hai đầu như bản không stream
+    started = False
+    held = ""
+    for piece in [buffer[len(query):]] + [token for token in tokens]:
+        if not started:
+            piece = piece.lstrip(STRIP_CHARS)
+            if not piece:
+                continue
+            started = True
+        # Giữ lại các ký tự cần cắt ở cuối cho tới khi biết chúng không nằm ở cuối câu trả lời
+        text = held + piece
+        kept = text.rstrip(STRIP_CHARS)
+        held = text[len(kept):]
+        if kept:
+            yield kept
+
+def generate_stream(plan: dict, query: str, llm, stats: Optional[dict] = None,
+                    start: Optional[float] = None) -> Iterator[str]:
+    """Sinh câu trả lời cho prompt đã chuẩn bị bởi plan_response, yield từng token"""
+    stats = stats if stats is not None else {}
+    start = start if start is not None else time.perf_counter()
+    # Khôi phục KV state của phần system prompt cố định, chỉ phải đánh giá context + câu hỏi
+    prompt_prefix_cache.prepare(llm, plan["template"], plan["prompt"])
+    tracer.annotate(source="llm", template=plan["template"])
+    stream_start = time.perf_counter()
+    tokens = llm.stream(plan["prompt"].format(**plan["inputs"]))
+    if plan.get("strip_query"):
+        tokens = strip_repeated_question(tokens, query)
+    
+    if plan.get("prefix"):
+        yield plan["prefix"]
+    
+    pieces = []
+    first_token = None
+    for piece in tokens:
+        if not pieces:
+            first_token = time.perf_counter()
+            stats["first_token_s"] = first_token - start
+            # Tới token đầu tiên chủ yếu là thời gian đánh giá prompt
+            tracer.record("prompt_eval", first_token - stream_start, _start=stream_start)
+        pieces.append(piece)
+        yield piece
+    
+    end = time.perf_counter()
+    stats["total_s"] = end - start
+    stats["tokens"] = len(pieces)
+    if first_token is not None:
+        generation_s = end - first_token
+        tokens_per_s = len(pieces) / generation_s if generation_s > 0 else 0.0
+        tracer.record("generation", generation_s, _start=first_token,
+                      tokens=len(pieces), tokens_per_s=tokens_per_s)
+        tracer.observe("generation_tokens_per_s", tokens_per_s, TOKENS_PER_S_BUCKETS)
+        tracer.count("generated_tokens_total", len(pieces))
+    if plan.get("cache"):
+        cache_key, query_vector = plan["cache"]
+        answer_cache.put(cache_key, "".join(pieces), query_vector)
+    remember_turn(plan, query, "".join(pieces))
+
+def smart_response_stream(query: str, bm25_retriever, vector_store,
+                          stats: Optional[dict] = None, session_id: Optional[str] = None) -> Iterator[str]:
+    """Trả về câu trả lời dạng stream: từng token được yield ngay khi LLM sinh ra"""
+    stats = stats if stats is not None else {}
+    with tracer.trace("smart_response"):
+        start = time.perf_counter()
+        plan = plan_response(query, bm25_retriever, vector_store, session_id)
+        stats["prepare_s"] = time.perf_counter() - start
+        if plan.get("context_info"):
+            stats["context_tokens"] = plan["context_info"]["tokens"]
+            stats["context_chunks"] = plan["context_info"]["chunks"]
+        
+        if "answer" in plan:
+            stats["first_token_s"] = stats["total_s"] = time.perf_counter() - start
+            stats["tokens"] = 0
+            yield plan["answer"]
+            return
+        
+        # Lấy LLM dùng chung (chỉ load một lần cho cả tiến trình)
+        yield from generate_stream(plan, query, get_llm(), stats, start)
+
+def smart_response(query: str, bm25_retriever, vector_store, session_id: Optional[str] = None):
+    """Xử lý câu hỏi và trả về câu trả lời phù hợp"""
+    return "".join(smart_response_stream(query, bm25_retriever, vector_store, session_id=session_id))
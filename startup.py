@@ -0,0 +1,89 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+# Mốc thời gian tính từ lúc module này được import (import nó đầu tiên trong script)
+LAUNCH = time.perf_counter()
+
+
+class StartupReport:
+    """Thời gian từng bước khởi động (import module, load index/model), kèm thread thực hiện"""
+
+    def __init__(self, launch: float = LAUNCH):
+        self.launch = launch
+        self.steps: List[dict] = []
+        self.marks: dict = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def step(self, kind: str, name: str):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            with self._lock:
+                self.steps.append({"kind": kind, "name": name, "thread": threading.current_thread().name,
+                                   "start_s": start - self.launch, "seconds": time.perf_counter() - start,
+                                   "error": error})
+
+    def mark(self, name: str) -> None:
+        """Ghi một mốc (ví dụ lần đầu hiện dấu nhắc) tính từ lúc khởi động"""
+        self.marks.setdefault(name, time.perf_counter() - self.launch)
+
+    def format(self) -> str:
+        with self._lock:
+            steps = sorted(self.steps, key=lambda step: step["start_s"])
+        lines = [f"{'bước':<40} | {'loại':<6} | {'thread':<8} | {'bắt đầu':>8} | {'thời gian':>9}"]
+        for step in steps:
+            name = step["name"] + (f" ({step['error']})" if step["error"] else "")
+            lines.append(f"{name:<40} | {step['kind']:<6} | {step['thread'][:8]:<8} | "
+                         f"{step['start_s']:>7.2f}s | {step['seconds']:>8.2f}s")
+        for name, seconds in self.marks.items():
+            lines.append(f"⏱️ {name}: {seconds:.2f}s sau khi khởi động")
+        return "\n".join(lines)
+
+
+class Warmup:
+    """Chạy các bước khởi động nặng trên thread nền; `wait()` khi thật sự cần kết quả"""
+
+    def __init__(self, load: Callable[[], None]):
+        self.load = load
+        self.error: Optional[BaseException] = None
+        self._thread: Optional[threading.Thread] = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def _run(self) -> None:
+        try:
+            self.load()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._done.set()
+
+    def start(self) -> "Warmup":
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+                self._thread.start()
+        return self
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set() and self.error is None
+
+    def wait(self) -> None:
+        self.start()
+        self._done.wait()
+        if self.error is not None:
+            # Lần gọi sau sẽ thử load lại từ đầu
+            error, self.error = self.error, None
+            with self._lock:
+                self._thread = None
+                self._done.clear()
+            raise error
@@ -0,0 +1,60 @@
+import json
+import os
+
+import numpy as np
+
+from answer_cache import AnswerCache
+
+
+def unit(i: int, dim: int = 16) -> np.ndarray:
+    vector = np.zeros(dim, dtype=np.float32)
+    vector[i % dim] = 1.0
+    return vector
+
+
+def test_put_same_key_replaces_semantic_entry():
+    cache = AnswerCache(max_entries=3)
+    for i in range(10):
+        cache.put("điều 3 quy định gì", f"trả lời {i}", unit(0))
+    cache.put("mục 5 là gì", "mục 5", unit(1))
+    cache.put("khoản 2 là gì", "khoản 2", unit(2))
+
+    # Câu hỏi lặp lại chỉ giữ một mục nên không đẩy các câu hỏi khác ra khỏi tầng ngữ nghĩa
+    assert cache.get_stats()["semantic_size"] == 3 and cache.get_stats()["evictions"] == 0
+    assert cache.get_semantic(unit(0)) == "trả lời 9"
+    assert cache.get_semantic(unit(1)) == "mục 5"
+
+
+def test_save_keeps_answers_and_vectors_together(tmp_path):
+    path = str(tmp_path)
+    cache = AnswerCache(path=path)
+    cache.put("a", "trả lời a", unit(0))
+    cache.save()
+    with open(os.path.join(path, "answers.json"), encoding="utf-8") as f:
+        first = json.load(f)
+
+    cache.put("b", "trả lời b", unit(1))
+    cache.save()
+    # Lần lưu mới trỏ tới file vector riêng, file của lần trước đã được dọn
+    with open(os.path.join(path, "answers.json"), encoding="utf-8") as f:
+        second = json.load(f)
+    assert second["vectors"] != first["vectors"]
+    assert sorted(name for name in os.listdir(path) if name.endswith(".npy")) == [second["vectors"]]
+    assert not [name for name in os.listdir(path) if name.endswith(".tmp")]
+
+    loaded = AnswerCache(path=path)
+    assert loaded.get_semantic(unit(0)) == "trả lời a"
+    assert loaded.get_semantic(unit(1)) == "trả lời b"
+
+
+def test_load_skips_vectors_from_another_save(tmp_path):
+    path = str(tmp_path)
+    cache = AnswerCache(path=path)
+    cache.put("a", "trả lời a", unit(0))
+    cache.save()
+    # Bị ngắt sau khi ghi vector của lần lưu sau: JSON cũ vẫn chỉ tới vector của chính nó
+    np.save(os.path.join(path, "vectors-9999.npy"), np.stack([unit(1), unit(2)]))
+
+    loaded = AnswerCache(path=path)
+    assert loaded.get_semantic(unit(0)) == "trả lời a"
+    assert loaded.get_stats()["semantic_size"] == 1
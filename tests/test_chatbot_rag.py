@@ -0,0 +1,24 @@
+import model_registry
+import smart_ans
+import utils
+
+import chatbot_rag
+
+
+def test_failed_retriever_load_is_retried(monkeypatch):
+    results = [(None, None), ("bm25", "faiss")]
+    monkeypatch.setattr(utils, "initialize_retrievers", lambda: results.pop(0))
+    monkeypatch.setattr(model_registry, "get_llm", lambda: None)
+    monkeypatch.setattr(model_registry, "get_llm_stats", lambda: [])
+    monkeypatch.setattr(smart_ans, "smart_response",
+                        lambda query, bm25, vector_store, session_id=None: f"{bm25}+{vector_store}")
+    monkeypatch.setattr(chatbot_rag, "bm25_retriever", None)
+    monkeypatch.setattr(chatbot_rag, "vector_store", None)
+    monkeypatch.setattr(chatbot_rag, "warmup", chatbot_rag.Warmup(chatbot_rag.load_pipeline))
+
+    # Lần đầu không mở được index: không được coi là đã load xong
+    assert chatbot_rag.rag_search("điều 3 quy định gì") == "Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi của bạn."
+    assert not chatbot_rag.warmup.done
+    # Câu hỏi sau load lại và dùng được retrievers mới
+    assert chatbot_rag.rag_search("điều 3 quy định gì") == "bm25+faiss"
+    assert chatbot_rag.warmup.done and results == []
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+from langchain_core.documents import Document
+
+from bm25_index import BM25Index
+from chunk_store import ChunkStore
+from generations import CURRENT_FILE, new_generation
+
+SOURCES = {"a.pdf": {"size": 0, "mtime": 0, "sha256": ""}}
+
+
+def make_docs(n: int, tag: str = "chunk"):
+    return [Document(page_content=f"{tag} số {i} nội dung {i * 7 % 13}",
+                     metadata={"source": "a.pdf", "page": i // 10, "start_index": i})
+            for i in range(n)]
+
+
+def test_save_switches_generation_atomically(tmp_path):
+    path = str(tmp_path / "chunks")
+    first = ChunkStore.save(path, make_docs(50), SOURCES, {})
+    # Lượt ghi bị ngắt giữa chừng: thế hệ mới chưa được commit nên kho cũ vẫn là kho hiện tại
+    with open(os.path.join(new_generation(path), "texts.bin"), "wb") as f:
+        f.write(b"partial")
+    assert len(ChunkStore.load(path)) == 50
+
+    second = ChunkStore.save(path, make_docs(20, "mới"), SOURCES, {})
+    assert len(ChunkStore.load(path)) == 20
+    assert ChunkStore.load(path).text(3) == "mới số 3 nội dung 8"
+    # Kho cũ vẫn đọc được, chỉ giữ lại thế hệ liền trước
+    assert first.text(49) == "chunk số 49 nội dung 5"
+    generations = [name for name in os.listdir(path) if name.startswith("gen-")]
+    assert len(generations) == 2 and os.path.exists(os.path.join(path, CURRENT_FILE))
+    assert second.signature() != first.signature()
+
+
+def test_bm25_save_keeps_mapped_generation(tmp_path):
+    path = str(tmp_path / "bm25")
+    docs = make_docs(100)
+    BM25Index.from_documents(docs).save(path, "v1")
+    old = BM25Index.load(path, docs=docs)
+    BM25Index.from_documents(make_docs(5, "khác")).save(path, "v2")
+
+    assert BM25Index.load(path, signature="v1") is None
+    assert BM25Index.load(path, signature="v2").n_docs == 5
+    ids, scores = old.search("chunk số 77", k=3)
+    assert ids[0] == 77 and np.all(scores > 0)
@@ -0,0 +1,52 @@
+import multiprocessing as mp
+
+import numpy as np
+
+from bench_suite import HashEmbeddings
+from embedding_cache import CachedEmbeddings
+
+
+def _texts(worker: int, n: int = 200):
+    # Mỗi tiến trình có đoạn riêng, cộng một phần đoạn chung mà tiến trình khác cũng embed
+    return [f"tiến trình {worker} đoạn {i}" if i % 4 else f"đoạn chung {i}" for i in range(n)]
+
+
+def _append_worker(path: str, worker: int, barrier) -> None:
+    cache = CachedEmbeddings(HashEmbeddings(dim=32), "hash-32", path=path)
+    texts = _texts(worker)
+    barrier.wait()
+    # Nhiều batch nhỏ để các lượt ghi của các tiến trình xen kẽ nhau
+    for start in range(0, len(texts), 5):
+        cache.embed_documents(texts[start:start + 5])
+
+
+def test_concurrent_appends_keep_rows_aligned(tmp_path):
+    path = str(tmp_path)
+    ctx = mp.get_context("fork")
+    barrier = ctx.Barrier(4)
+    workers = [ctx.Process(target=_append_worker, args=(path, worker, barrier)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        assert process.exitcode == 0
+
+    model = HashEmbeddings(dim=32)
+    cache = CachedEmbeddings(model, "hash-32", path=path)
+    texts = sorted({text for worker in range(4) for text in _texts(worker)})
+    vectors = np.array(cache.embed_documents(texts))
+    assert cache.stats["model_calls"] == 0
+    np.testing.assert_allclose(vectors, np.array(model.embed_documents(texts)), rtol=1e-6)
+
+
+def test_reload_keys_appended_by_other_instance(tmp_path):
+    model = HashEmbeddings(dim=32)
+    first = CachedEmbeddings(model, "hash-32", path=str(tmp_path))
+    second = CachedEmbeddings(model, "hash-32", path=str(tmp_path))
+    first.embed_documents(["đoạn một", "đoạn hai"])
+    second.embed_documents(["đoạn ba"])
+    # second phải đánh số sau các dòng do first ghi, và đọc được vector của first mà không gọi model
+    assert second.embed_documents(["đoạn một"]) == [model.embed_query("đoạn một")]
+    assert second.stats["model_calls"] == 1
+    assert first.embed_documents(["đoạn ba"]) == [model.embed_query("đoạn ba")]
+    assert first.stats["model_calls"] == 1
@@ -0,0 +1,76 @@
+import json
+import os
+
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from bench_suite import HashEmbeddings
+from embedding_cache import CachedEmbeddings
+from faiss_index import INDEX_PARAMS_FILE, delete_ids, rebuild_index
+
+
+class CountingEmbeddings(HashEmbeddings):
+    """Đếm số đoạn được đưa vào model"""
+
+    def __init__(self):
+        super().__init__(dim=64)
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return super().embed_documents(texts)
+
+
+def _text(i: int) -> str:
+    return f"tài liệu {i} chương {i % 7} mục {i * 31 % 97} điều khoản số{i}"
+
+
+@pytest.mark.parametrize("kind", ["ivf_flat", "ivf_pq", "hnsw"])
+def test_delete_then_search_keeps_ids_aligned(tmp_path, kind):
+    path = str(tmp_path)
+    with open(os.path.join(path, INDEX_PARAMS_FILE), "w", encoding="utf-8") as f:
+        json.dump({"kind": kind}, f)
+    model = CountingEmbeddings()
+    embeddings = CachedEmbeddings(model, model.model_id, path=str(tmp_path / "cache"))
+    ids = [f"c{i}" for i in range(400)]
+    store = FAISS.from_documents([Document(page_content=_text(i)) for i in range(350)], embeddings,
+                                 ids=ids[:350], distance_strategy="METRIC_INNER_PRODUCT")
+    rebuild_index(store, path)
+
+    # Đồng bộ lần sau: thêm chunk mới vào index đã train rồi xóa chunk đã mất
+    store.add_documents([Document(page_content=_text(i)) for i in range(350, 400)], ids=ids[350:])
+    removed = set(ids[::3])
+    if kind != "ivf_pq":
+        # Index giữ vector gốc: không cần cả cache embedding
+        store.embedding_function = model
+    embedded = model.embedded
+    delete_ids(store, sorted(removed), path)
+    # Vector dựng lại từ index (PQ: lấy từ cache embedding), không embed lại corpus
+    assert model.embedded == embedded
+
+    assert store.index.ntotal == len(ids) - len(removed) == len(store.index_to_docstore_id)
+    for i in range(1, 400, 17):
+        if ids[i] in removed:
+            continue
+        docs = store.similarity_search(_text(i), k=5, fetch_k=5)
+        assert all(doc.page_content in {_text(j) for j in range(400) if ids[j] not in removed} for doc in docs)
+        if kind != "ivf_pq":
+            assert docs[0].page_content == _text(i)
+
+
+def test_pq_delete_without_cached_vectors_does_not_call_model(tmp_path):
+    path = str(tmp_path)
+    with open(os.path.join(path, INDEX_PARAMS_FILE), "w", encoding="utf-8") as f:
+        json.dump({"kind": "ivf_pq"}, f)
+    model = CountingEmbeddings()
+    ids = [f"c{i}" for i in range(300)]
+    store = FAISS.from_documents([Document(page_content=_text(i)) for i in range(300)], model,
+                                 ids=ids, distance_strategy="METRIC_INNER_PRODUCT")
+    rebuild_index(store, path)
+    # Cache trống (hoặc model không có cache): báo lỗi thay vì embed lại toàn bộ
+    store.embedding_function = CachedEmbeddings(model, model.model_id, path=str(tmp_path / "cold"))
+    embedded = model.embedded
+    with pytest.raises(RuntimeError, match="indexer.py"):
+        delete_ids(store, ids[:3], path)
+    assert model.embedded == embedded
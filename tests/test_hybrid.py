@@ -0,0 +1,80 @@
+import threading
+
+import faiss
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from bench_suite import HashEmbeddings
+from bm25_index import BM25Index
+from chunk_store import ChunkStore, assign_chunk_ids
+from embedding_cache import CachedEmbeddings
+from faiss_index import build_index
+from hybrid import HybridRetriever, table_vectors
+
+SOURCES = {"a.pdf": {"size": 0, "mtime": 0, "sha256": ""}}
+
+
+class RecordingEmbeddings(HashEmbeddings):
+    """Ghi lại các đoạn được embed và thread đã gọi model"""
+
+    def __init__(self):
+        super().__init__(dim=64)
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append((list(texts), threading.current_thread().name))
+        return super().embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def make_stores(tmp_path, embeddings, kind):
+    docs = [Document(page_content=f"điều {i} quy định về mục {i % 9} và khoản {i % 5} số {i}",
+                     metadata={"source": "a.pdf", "page": i, "start_index": 0}) for i in range(600)]
+    table = ChunkStore.save(str(tmp_path / "chunks"), docs, SOURCES, {})
+    bm25 = BM25Index.from_texts([table.text(i) for i in range(len(table))], docs=table)
+    vector_store = FAISS.from_documents(docs, embeddings, ids=assign_chunk_ids(docs),
+                                        distance_strategy="METRIC_INNER_PRODUCT")
+    vector_store.index = build_index(vector_store.index.reconstruct_n(0, len(docs)), kind,
+                                     faiss.METRIC_INNER_PRODUCT)
+    return docs, table, bm25, vector_store
+
+
+@pytest.mark.parametrize("kind", ["flat", "ivf_pq"])
+def test_mmr_embeds_query_once_on_faiss_leg(tmp_path, kind):
+    model = RecordingEmbeddings()
+    _, _, bm25, vector_store = make_stores(tmp_path, model, kind)
+    retriever = HybridRetriever(bm25, vector_store, k=5, mmr_lambda=0.7)
+    model.calls.clear()
+
+    ids, _ = retriever.search_ids(["quy định về mục 3"])
+    assert len(ids) == 5
+    # Chỉ câu hỏi được embed, trên thread của nhánh FAISS; vector ứng viên lấy từ index
+    assert [texts for texts, _ in model.calls] == [["quy định về mục 3"]]
+    assert model.calls[0][1].startswith("hybrid")
+
+
+def test_document_path_does_not_reembed_candidates(tmp_path):
+    model = RecordingEmbeddings()
+    docs, _, _, vector_store = make_stores(tmp_path, model, "ivf_pq")
+    retriever = HybridRetriever(BM25Index.from_documents(docs), vector_store, k=5, mmr_lambda=0.7)
+    model.calls.clear()
+
+    assert len(retriever.search_with_scores("khoản 4 số 19")) == 5
+    assert [texts for texts, _ in model.calls] == [["khoản 4 số 19"]]
+
+
+def test_ivf_pq_prefers_exact_cached_vectors(tmp_path):
+    model = RecordingEmbeddings()
+    cached = CachedEmbeddings(model, "hash-64", path=str(tmp_path / "cache"))
+    _, table, bm25, vector_store = make_stores(tmp_path, cached, "ivf_pq")
+    retriever = HybridRetriever(bm25, vector_store, k=5, mmr_lambda=0.7)
+    model.calls.clear()
+
+    retriever.search_ids(["điều 7 quy định"])
+    assert [texts for texts, _ in model.calls] == [["điều 7 quy định"]]
+    vectors = table_vectors(vector_store, table, np.array([3, 4], dtype=np.int64))
+    np.testing.assert_allclose(vectors, model.embed_documents([table.text(3), table.text(4)]), rtol=1e-6)
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+from langchain_core.documents import Document
+
+import chunk_store
+from bench_suite import HashEmbeddings
+from chunk_store import ChunkStore, assign_chunk_ids
+from indexer import sync_index
+
+
+def fake_chunks(pdf_path, config=None, pool=None):
+    """Thay cho việc đọc PDF: mỗi dòng của file là một chunk"""
+    with open(pdf_path, encoding="utf-8") as f:
+        for page, line in enumerate(f.read().splitlines()):
+            yield Document(page_content=line, metadata={"source": pdf_path, "page": page, "start_index": 0})
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunk_store, "iter_pdf_chunks", fake_chunks)
+    monkeypatch.setattr(chunk_store, "count_pages", lambda pdf_path: 1)
+
+    # Đồng bộ không được gom toàn bộ kho thành danh sách Document
+    def no_documents(self):
+        raise AssertionError("sync_index không được gọi ChunkStore.documents()")
+    monkeypatch.setattr(ChunkStore, "documents", no_documents)
+
+    data = tmp_path / "data"
+    data.mkdir()
+    paths = {name: str(tmp_path / name) for name in ("db", "chunks", "bm25", "shared", "checkpoint")}
+    paths["manifest"] = str(tmp_path / "manifest.json")
+    return data, paths
+
+
+def sync(data, paths):
+    return sync_index(HashEmbeddings(dim=32), str(data), paths["db"], paths["manifest"], paths["chunks"],
+                      paths["bm25"], paths["shared"], batch_size=7, workers=1,
+                      checkpoint_path=paths["checkpoint"])
+
+
+def write(path, prefix: str, n: int) -> None:
+    path.write_text("\n".join(f"{prefix} đoạn {i} quy định số {i * 3}" for i in range(n)), encoding="utf-8")
+
+
+def test_sync_streams_chunks_by_id(workspace):
+    data, paths = workspace
+    write(data / "a.pdf", "luật", 40)
+    write(data / "b.pdf", "nghị định", 30)
+    _, vector_store, report = sync(data, paths)
+    assert report["chunks"] == 70 and report["embedded"] == 70 and report["full_rebuild"]
+
+    store = ChunkStore.load(paths["chunks"])
+    documents = [store.document(i) for i in range(len(store))]
+    assert store.chunk_ids() == assign_chunk_ids(documents)
+    assert store.text(45) == "nghị định đoạn 5 quy định số 15"
+
+    # b.pdf đổi: chỉ chunk mới được embed, chunk cũ của b bị xóa, chunk của a được chép lại từ kho cũ
+    write(data / "b.pdf", "thông tư", 10)
+    os.utime(data / "b.pdf", (1, 1))
+    _, vector_store, report = sync(data, paths)
+    assert (report["chunks"], report["embedded"], report["removed"]) == (50, 10, 30)
+    assert not report["full_rebuild"]
+    assert vector_store.index.ntotal == 50
+    found = vector_store.similarity_search("thông tư đoạn 3 quy định số 9", k=1)
+    assert found[0].page_content == "thông tư đoạn 3 quy định số 9"
@@ -0,0 +1,30 @@
+import pytest
+from langchain_core.prompts import PromptTemplate
+
+import model_registry
+import query
+
+
+def test_sampling_params_do_not_create_a_second_model():
+    with pytest.raises(ValueError):
+        model_registry.get_llm(query.model_file, temperature=0.2)
+    assert not model_registry._models
+
+
+class FakeLlm:
+    def __init__(self):
+        self.calls = []
+
+    def stream(self, prompt, **kwargs):
+        self.calls.append(kwargs)
+        yield "trả lời"
+
+
+def test_query_stream_passes_temperature_per_call(monkeypatch):
+    monkeypatch.setattr(query, "hybrid_search", lambda *args, **kwargs: [])
+    monkeypatch.setattr(query.prompt_prefix_cache, "prepare", lambda *args, **kwargs: None)
+    llm = FakeLlm()
+    prompt = PromptTemplate(template="{context}\n{question}", input_variables=["context", "question"])
+    stream = query.create_qa_stream(prompt, llm, None, None)
+    assert "".join(stream("câu hỏi")) == "trả lời"
+    assert llm.calls == [{"temperature": query.temperature}]
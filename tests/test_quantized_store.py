@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from bench_suite import HashEmbeddings
+from chunk_store import ChunkStore, assign_chunk_ids
+from quantized_store import vectors_in_store_order
+
+SOURCES = {"a.pdf": {"size": 0, "mtime": 0, "sha256": ""}}
+
+
+def make_docs(n):
+    # Có chunk trùng nội dung để kiểm tra cách đánh số id "#1"
+    return [Document(page_content=f"điều {i % 40} quy định về mục {i % 40}", metadata={"source": "a.pdf", "page": i})
+            for i in range(n)]
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_vectors_follow_chunk_store_order(tmp_path, legacy):
+    embeddings = HashEmbeddings(dim=32)
+    docs = make_docs(60)
+    store = ChunkStore.save(str(tmp_path / "chunks"), docs, SOURCES, {})
+    # Index cũ: LangChain tự sinh uuid làm id, thứ tự vector khác thứ tự kho chunk
+    ids = None if legacy else assign_chunk_ids(docs[::-1])
+    vector_store = FAISS.from_documents(docs[::-1], embeddings, ids=ids)
+
+    vectors = vectors_in_store_order(vector_store, store)
+    expected = np.array(embeddings.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+    np.testing.assert_allclose(vectors, expected, atol=1e-6)
+
+
+def test_mismatched_index_asks_to_rerun_indexer(tmp_path):
+    embeddings = HashEmbeddings(dim=32)
+    store = ChunkStore.save(str(tmp_path / "chunks"), make_docs(60), SOURCES, {})
+    vector_store = FAISS.from_documents(make_docs(30), embeddings)
+
+    with pytest.raises(ValueError, match="indexer.py"):
+        vectors_in_store_order(vector_store, store)
@@ -0,0 +1,33 @@
+import asyncio
+from http import HTTPStatus
+
+import pytest
+
+from server import MAX_BODY_BYTES, RagServer, RequestError
+
+
+def dispatch(raw: bytes):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        server = RagServer(llm_workers=0, retrieval_threads=1)
+        try:
+            return await server._dispatch(reader)
+        finally:
+            server.retrieval_pool.shutdown(wait=False)
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("length", ["abc", "-5", "1.5", str(MAX_BODY_BYTES + 1)])
+def test_bad_content_length_is_rejected_with_400(length):
+    body = b'{"query": "xin ch\\u00e0o"}'
+    with pytest.raises(RequestError) as error:
+        dispatch(f"POST /chat HTTP/1.1\r\nContent-Length: {length}\r\n\r\n".encode("latin-1") + body)
+    assert error.value.status == HTTPStatus.BAD_REQUEST
+
+
+def test_missing_body_is_rejected_with_400():
+    with pytest.raises(RequestError) as error:
+        dispatch(b"POST /chat HTTP/1.1\r\n\r\n")
+    assert error.value.status == HTTPStatus.BAD_REQUEST
@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+import smart_ans
+from bench_suite import HashEmbeddings
+from bm25_index import BM25Index
+from chunk_store import ChunkStore, assign_chunk_ids
+from session_store import SessionStore, calibrate_warm_similarity
+
+SOURCES = {"a.pdf": {"size": 0, "mtime": 0, "sha256": ""}}
+
+# (câu hỏi trước, câu hỏi sau, cùng chủ đề?)
+LABELLED = [
+    ("quy trình tuyển dụng nhân viên mới gồm những bước nào",
+     "quy trình tuyển dụng nhân viên mới kéo dài bao lâu", True),
+    ("chính sách nghỉ phép năm của công ty",
+     "chính sách nghỉ phép năm áp dụng cho thực tập sinh không", True),
+    ("mức lương khởi điểm của kỹ sư phần mềm",
+     "mức lương khởi điểm của kỹ sư phần mềm có thưởng không", True),
+    ("quy định về giờ làm việc", "cách đăng ký bảo hiểm y tế", False),
+    ("chính sách nghỉ phép năm của công ty", "thủ tục thanh toán công tác phí", False),
+    ("mức lương khởi điểm của kỹ sư phần mềm", "địa chỉ văn phòng chi nhánh hà nội", False),
+    ("quy trình tuyển dụng nhân viên mới gồm những bước nào",
+     "quy trình đánh giá hiệu suất cuối năm", False),
+    # Câu nối tiếp dạng "cái đó" luôn dùng lại chủ đề, không tính khi hiệu chỉnh
+    ("chính sách nghỉ phép năm của công ty", "còn cái đó thì sao", True),
+]
+
+
+def warm_hit(store, embeddings, previous, query):
+    session_id = f"{previous}|{query}"
+    store.add_turn(session_id, previous, "trả lời", [1, 2, 3], embeddings.embed_query(previous))
+    return store.warm_candidates(session_id, query, embeddings.embed_query(query)) is not None
+
+
+def test_calibrated_threshold_separates_labelled_followups():
+    embeddings = HashEmbeddings(dim=64)
+    threshold, accuracy = calibrate_warm_similarity(LABELLED, embeddings.embed_query)
+    assert accuracy == 1.0
+
+    store = SessionStore(warm_similarity=threshold)
+    assert [warm_hit(store, embeddings, previous, query) for previous, query, _ in LABELLED] == \
+        [same for *_, same in LABELLED]
+
+
+def test_warm_similarity_is_per_store():
+    embeddings = HashEmbeddings(dim=64)
+    previous, query, _ = LABELLED[0]
+    similarity = float(np.dot(embeddings.embed_query(previous), embeddings.embed_query(query)))
+
+    assert warm_hit(SessionStore(warm_similarity=similarity - 0.01), embeddings, previous, query)
+    strict = SessionStore(warm_similarity=similarity + 0.01)
+    assert not warm_hit(strict, embeddings, previous, query)
+    assert strict.get_stats()["warm_misses"] == 1
+
+
+def test_calibration_needs_non_followup_pairs():
+    with pytest.raises(ValueError):
+        calibrate_warm_similarity([("a", "còn cái đó thì sao", True)], HashEmbeddings(dim=64).embed_query)
+
+
+def test_pattern_answer_records_turn(monkeypatch):
+    store = SessionStore()
+    monkeypatch.setattr(smart_ans, "session_store", store)
+    monkeypatch.setattr(smart_ans.pattern_manager, "direct_answer", lambda query: "Xin chào!")
+
+    assert smart_ans.pattern_answer("xin chào", "s1") == "Xin chào!"
+    assert "Xin chào!" in store.history("s1")
+    assert store.get_stats()["turns"] == 1
+
+
+class FakeLlm:
+    def get_num_tokens(self, text):
+        return len(text.split())
+
+
+def make_stores(tmp_path, embeddings):
+    docs = [Document(page_content=f"điều {i} quy định về mục {i % 9} và khoản {i % 5} số {i}",
+                     metadata={"source": "a.pdf", "page": i, "start_index": 0}) for i in range(50)]
+    table = ChunkStore.save(str(tmp_path / "chunks"), docs, SOURCES, {})
+    bm25 = BM25Index.from_texts([table.text(i) for i in range(len(table))], docs=table)
+    vector_store = FAISS.from_documents(docs, embeddings, ids=assign_chunk_ids(docs),
+                                        distance_strategy="METRIC_INNER_PRODUCT")
+    return bm25, vector_store
+
+
+def test_warm_lookup_is_never_extractive(tmp_path, monkeypatch):
+    embeddings = HashEmbeddings(dim=64)
+    bm25, vector_store = make_stores(tmp_path, embeddings)
+    store = SessionStore()
+    store.add_turn("s1", "điều 3 quy định gì", "mục 3", [3, 12], embeddings.embed_query("điều 3 quy định về mục 3"))
+    monkeypatch.setattr(smart_ans, "session_store", store)
+    monkeypatch.setattr(smart_ans.retrieval_gate, "enabled", True)
+    monkeypatch.setattr(smart_ans, "get_llm", FakeLlm)
+
+    # Câu tra cứu nối tiếp phủ hết từ của chunk ấm: cổng thật vẫn chạy nhưng điểm cosine của lượt ấm
+    # không phải điểm kết hợp hai nhánh nên phải để LLM trả lời
+    plan = smart_ans.plan_response("tìm điều 3 đó", bm25, vector_store, "s1")
+    assert plan["warm"] and list(plan["chunk_ids"]) == [3, 12]
+    assert "answer" not in plan and plan["template"] == "document"
+
+    intents = smart_ans.pattern_manager.match("tìm điều 3 đó").doc_intents
+    assert "find" in intents
+    docs = [(Document(page_content="điều 3 quy định về mục 3 và khoản 3 số 3"), 0.41)]
+    decision = smart_ans.retrieval_gate.decide("tìm điều 3 đó", intents, docs, [3],
+                                               embeddings.embed_query("điều 3"), None, bm25, vector_store)
+    assert (decision.action, decision.reason) == ("llm", "no_fused_score")
+    # Cùng điểm đó nếu bị chia cho trần điểm kết hợp thì luôn coi là hai nhánh đồng thuận
+    decision = smart_ans.retrieval_gate.decide("tìm điều 3 đó", intents, docs, [3],
+                                               embeddings.embed_query("điều 3"), 0.0164, bm25, vector_store)
+    assert decision.action == "extractive"
+
+
+def test_warm_turn_still_reports_not_found(tmp_path, monkeypatch):
+    embeddings = HashEmbeddings(dim=64)
+    bm25, vector_store = make_stores(tmp_path, embeddings)
+    store = SessionStore()
+    store.add_turn("s1", "điều 3 quy định gì", "mục 3", [3], embeddings.embed_query("điều 3 quy định về mục 3"))
+    monkeypatch.setattr(smart_ans, "session_store", store)
+    monkeypatch.setattr(smart_ans.retrieval_gate, "enabled", True)
+    monkeypatch.setattr(smart_ans.retrieval_gate, "min_similarity", 2.0)
+
+    plan = smart_ans.plan_response("còn cái kia thì sao", bm25, vector_store, "s1")
+    assert plan["warm"] and plan["source"] == "not_found"
+    assert store.get_stats()["turns"] == 2
@@ -0,0 +1,59 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Chạy trong process riêng: đọc file đang mmap đã bị cắt ngắn làm process chết vì SIGBUS
+REWRITE_WHILE_MAPPED = textwrap.dedent("""
+    import sys
+
+    import faiss
+    import numpy as np
+    from langchain_core.documents import Document
+
+    from chunk_store import ChunkStore
+    from quantized_store import QuantizedVectorStore
+    from shared_index import SharedVectorStore
+
+    path = sys.argv[1]
+    sources = {"a.pdf": {"size": 0, "mtime": 0, "sha256": ""}}
+
+    def docs(n):
+        return [Document(page_content=f"chunk {i} " + "nội dung " * 20, metadata={"source": "a.pdf", "page": i})
+                for i in range(n)]
+
+    def vectors(n):
+        return np.random.default_rng(n).normal(size=(n, 32)).astype(np.float32)
+
+    def flat(n):
+        index = faiss.IndexFlatL2(32)
+        index.add(vectors(n))
+        return index
+
+    store = ChunkStore.save(path + "/chunks", docs(2000), sources, {})
+    QuantizedVectorStore.from_vectors(vectors(2000), "int8").save(path + "/quantized")
+    quantized = QuantizedVectorStore.load(path + "/quantized")
+    SharedVectorStore.save(flat(2000), path + "/faiss")
+    shared = SharedVectorStore.load(path + "/faiss")
+
+    # Indexer ghi lại với ít chunk hơn trong khi worker vẫn giữ bản map cũ
+    ChunkStore.save(path + "/chunks", docs(10), sources, {})
+    QuantizedVectorStore.from_vectors(vectors(10), "int8").save(path + "/quantized")
+    SharedVectorStore.save(flat(10), path + "/faiss")
+
+    assert store.text(1999).startswith("chunk 1999 ")
+    assert quantized.search(vectors(2000)[1999], k=1)[0][0] == 1999
+    assert shared.search(vectors(2000)[1999], k=1)[0][0] == 1999
+    # Lần mở sau chỉ thấy thế hệ mới
+    assert len(ChunkStore.load(path + "/chunks")) == 10
+    assert len(QuantizedVectorStore.load(path + "/quantized").vectors) == 10
+    assert len(SharedVectorStore.load(path + "/faiss")) == 10
+""")
+
+
+def test_rewrite_while_reader_has_files_mapped(tmp_path):
+    result = subprocess.run([sys.executable, "-c", REWRITE_WHILE_MAPPED, str(tmp_path)],
+                            cwd=ROOT, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,282 @@
+import contextvars
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics import Histogram
+
+# Cau hinh
+TRACING_ENABLED = True
+# Ghi mỗi trace đã xong thành một dòng JSON (None: không ghi)
+TRACE_LOG_PATH: Optional[str] = None
+# Tỉ lệ request được chạy cProfile; chỉ giữ profile của request chậm hơn SLOW_REQUEST_S
+PROFILE_SAMPLE_RATE = 0.0
+SLOW_REQUEST_S = 5.0
+PROFILE_DIR = "logs/profiles"
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TOKENS_PER_S_BUCKETS = (1, 2, 5, 10, 20, 40, 80)
+
+_current: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+
+
+class _NoopSpan:
+    """Span khi tắt tracing: không đo gì, dùng chung một đối tượng"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    def __init__(self, tracer: "Tracer", name: str, attrs: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer.record(self.name, time.perf_counter() - self.start, _start=self.start, **self.attrs)
+        return False
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+
+class Trace:
+    """Một request: danh sách span theo thứ tự kết thúc, thời điểm tính từ lúc bắt đầu trace"""
+
+    def __init__(self, name: str, attrs: dict):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.spans: List[dict] = []
+        self.profiler: Optional[cProfile.Profile] = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> dict:
+        return {"trace_id": self.id, "name": self.name, "started_at": self.started_at,
+                "duration_ms": self.duration * 1000, **self.attrs, "spans": self.spans}
+
+
+class _TraceContext:
+    def __init__(self, tracer: "Tracer", trace: Trace, profile: bool):
+        self.tracer = tracer
+        self.trace = trace
+        self.profile = profile
+        self._token = None
+
+    def __enter__(self) -> Trace:
+        self._token = _current.set(self.trace)
+        if self.profile:
+            self.tracer._start_profile(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.trace.attrs["error"] = exc_type.__name__
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # Generator bị đóng ở context khác (ví dụ bị bỏ dở rồi gc thu hồi)
+            pass
+        self.tracer._finish(self.trace)
+        return False
+
+
+class Tracer:
+    """Span theo từng giai đoạn, counter và histogram; xuất Prometheus text hoặc JSON lines
+
+    Khi tắt (`enabled=False`) mọi lời gọi chỉ là một phép kiểm tra cờ và trả về span rỗng dùng chung.
+    Trace của request hiện tại nằm trong contextvars; thread pool cần `wrap` để mang trace theo.
+    """
+
+    def __init__(self, enabled: bool = TRACING_ENABLED, jsonl_path: Optional[str] = TRACE_LOG_PATH,
+                 profile_rate: float = PROFILE_SAMPLE_RATE, slow_request_s: float = SLOW_REQUEST_S,
+                 profile_dir: str = PROFILE_DIR):
+        self.enabled = enabled
+        self.jsonl_path = jsonl_path
+        self.profile_rate = profile_rate
+        self.slow_request_s = slow_request_s
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._histograms: Dict[Tuple[str, tuple], Histogram] = {}
+        self._profiling = False
+        # Hàm được gọi với mỗi trace đã xong (ví dụ bench gom span theo giai đoạn)
+        self.listeners: List[Callable[[Trace], None]] = []
+
+    # ---- Ghi nhận ----
+    def trace(self, name: str, profile: bool = True, **attrs):
+        """Bắt đầu trace của một request
+
+        cProfile chỉ đo thread gọi trace, nên `profile=False` cho request chạy trên event loop
+        (profile khi đó sẽ lẫn cả các request khác).
+        """
+        if not self.enabled:
+            return _NOOP
+        return _TraceContext(self, Trace(name, attrs), profile)
+
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return _NOOP
+        return Span(self, name, attrs)
+
+    def record(self, name: str, seconds: float, _start: Optional[float] = None, **attrs) -> None:
+        """Span đo sẵn (ví dụ prompt eval tính từ lúc gọi stream tới token đầu tiên)"""
+        if not self.enabled:
+            return
+        self.observe("stage_seconds", seconds, STAGE_BUCKETS, stage=name)
+        for flag in ("cache_hit", "error"):
+            if flag in attrs:
+                self.count(f"stage_{flag}_total", stage=name, value=str(attrs[flag]).lower())
+        trace = _current.get()
+        if trace is not None:
+            start = (_start if _start is not None else time.perf_counter() - seconds) - trace.start
+            trace.spans.append({"name": name, "start_ms": start * 1000, "duration_ms": seconds * 1000, **attrs})
+
+    def count(self, name: str, n: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def observe(self, name: str, value: float, buckets=STAGE_BUCKETS, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(buckets))
+        histogram.observe(value)
+
+    def register(self, name: str, histogram: Histogram, **labels) -> None:
+        """Xuất cùng các metric khác một histogram do module khác tự ghi (ví dụ bộ gom batch embedding)"""
+        with self._lock:
+            self._histograms[(name, tuple(sorted(labels.items())))] = histogram
+
+    def annotate(self, **attrs) -> None:
+        """Gắn thuộc tính vào trace hiện tại (ví dụ loại câu hỏi, nguồn câu trả lời)"""
+        if not self.enabled:
+            return
+        trace = _current.get()
+        if trace is not None:
+            trace.set(**attrs)
+
+    def wrap(self, fn):
+        """Cho hàm chạy trên thread pool mang theo trace hiện tại"""
+        if not self.enabled or _current.get() is None:
+            return fn
+        return partial(contextvars.copy_context().run, fn)
+
+    # ---- Kết thúc trace / profile ----
+    def _start_profile(self, trace: Trace) -> None:
+        if self.profile_rate <= 0 or random.random() >= self.profile_rate:
+            return
+        with self._lock:
+            # cProfile chỉ chạy được một profiler mỗi lúc
+            if self._profiling:
+                return
+            self._profiling = True
+        trace.profiler = cProfile.Profile()
+        try:
+            trace.profiler.enable()
+        except ValueError:
+            trace.profiler = None
+            self._profiling = False
+
+    def _finish(self, trace: Trace) -> None:
+        trace.duration = time.perf_counter() - trace.start
+        self.observe("request_seconds", trace.duration, STAGE_BUCKETS, trace=trace.name)
+        self.count("requests_total", trace=trace.name)
+        if trace.profiler is not None:
+            trace.profiler.disable()
+            if trace.duration >= self.slow_request_s:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                path = os.path.join(self.profile_dir, f"{trace.name}-{trace.id}.prof")
+                trace.profiler.dump_stats(path)
+                trace.attrs["profile"] = path
+            trace.profiler = None
+            self._profiling = False
+        for listener in self.listeners:
+            listener(trace)
+        if self.jsonl_path:
+            line = json.dumps(trace.to_dict(), ensure_ascii=False, default=str)
+            with self._lock:
+                directory = os.path.dirname(self.jsonl_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+
+    # ---- Xuất ----
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+        return {
+            "counters": [{"name": name, **dict(labels), "count": value} for (name, labels), value in counters.items()],
+            "histograms": [{"name": name, **dict(labels), **histogram.snapshot()}
+                           for (name, labels), histogram in histograms.items()],
+        }
+
+    def prometheus(self, prefix: str = "rag_") -> str:
+        """Định dạng text của Prometheus (counter và histogram với bucket cộng dồn)"""
+        def fmt(labels, extra=()) -> str:
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {prefix}{name} counter")
+                typed.add(name)
+            lines.append(f"{prefix}{name}{fmt(labels)} {value:g}")
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                typed.add(name)
+            counts, total, n = histogram.totals()
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ["+Inf"], counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else f"{bound:g}"
+                lines.append(f"{prefix}{name}_bucket{fmt(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{prefix}{name}_sum{fmt(labels)} {total:g}")
+            lines.append(f"{prefix}{name}_count{fmt(labels)} {n}")
+        return "\n".join(lines) + "\n"
+
+
+# Tracer dùng chung cho toàn tiến trình
+tracer = Tracer()
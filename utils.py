@@ -1,32 +1,39 @@
-from langchain_community.embeddings import GPT4AllEmbeddings
 from langchain_community.vectorstores import FAISS
-from langchain.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.retrievers import BM25Retriever
+from chunk_store import load_chunk_store
+from bm25_index import load_bm25_index
+from faiss_index import apply_index_params
+from hybrid import MMR_LAMBDA, MMR_POOL, HybridRetriever
+from indexer import list_pdfs
+from model_registry import get_embeddings
+from quantized_store import load_quantized_store
+from shared_index import open_shared_index
 
 vector_db_path = "vectorstores/db_faiss"
-def initialize_retrievers():
+# Nhánh FAISS: "faiss" (index đầy đủ), "int8" / "binary" (vector nén + tính lại bằng float32 mmap)
+# hoặc "mmap" (chỉ mở index dùng chung do indexer.py tạo, cho nhiều worker trên một máy)
+vector_mode = "faiss"
+# Đa dạng hóa kết quả bằng MMR trên MMR_POOL ứng viên đầu, mặc định tắt (bật: mmr_lambda = MMR_LAMBDA)
+mmr_lambda = None
+mmr_pool = MMR_POOL
+def initialize_retrievers(mode=None):
     try:
-        # Tải và xử lý PDF
-        loader = PyPDFLoader("data/working.pdf")
-        docs = loader.load()
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=512,
-            chunk_overlap=50,
-            separators=["\n\n", "\n", ".", "!", "?", ";", ":", ",", " ", ""],
-            length_function=len,
-            add_start_index=True
-        )
-        all_splits = text_splitter.split_documents(docs)
+        mode = mode or vector_mode
+        if mode == "mmap":
+            return open_shared_index(get_embeddings(), db_path=vector_db_path)
+
+        # Lấy chunks từ kho đã lưu, chỉ chia lại PDF khi tài liệu hoặc cấu hình thay đổi
+        store = load_chunk_store(list_pdfs())
         
-        # Tạo BM25 retriever
-        bm25_retriever = BM25Retriever.from_documents(all_splits)
-        bm25_retriever.k = 5
+        # Tạo BM25 retriever (inverted index lưu sẵn trên đĩa)
+        bm25_retriever = load_bm25_index(store)
         
         # Tạo FAISS retriever
-        embedding_model = GPT4AllEmbeddings(model_file=r"models\vinallama-7b-chat_q5_0.gguf")
+        embedding_model = get_embeddings()
+        if mode != "faiss":
+            db = load_quantized_store(store, embedding_model, mode, db_path=vector_db_path)
+            return bm25_retriever, db
         db = FAISS.load_local(vector_db_path, embedding_model, allow_dangerous_deserialization=True)
+        apply_index_params(db, vector_db_path)
         
         return bm25_retriever, db
     except Exception as e:
@@ -34,26 +41,31 @@ def initialize_retrievers():
         return None, None
     
 
-def hybrid_retriever(query, bm25_retriever, vector_store):
-    # Lấy kết quả từ cả BM25 và FAISS
-    bm25_docs = bm25_retriever.get_relevant_documents(query)[:5]
-    faiss_docs = vector_store.similarity_search(query, k=5)
-    
-    # Kết hợp và loại bỏ trùng lặp
-    seen_content = set()
-    final_docs = []
-    
-    # Xen kẽ kết quả từ cả hai nguồn
-    for i in range(max(len(bm25_docs), len(faiss_docs))):
-        if i < len(bm25_docs):
-            if bm25_docs[i].page_content not in seen_content:
-                seen_content.add(bm25_docs[i].page_content)
-                final_docs.append(bm25_docs[i])
-                
-        if i < len(faiss_docs):
-            if faiss_docs[i].page_content not in seen_content:
-                seen_content.add(faiss_docs[i].page_content)
-                final_docs.append(faiss_docs[i])
+def hybrid_retriever(query, bm25_retriever, vector_store, query_vector=None):
+    # BM25 và FAISS chạy song song, kết hợp theo reciprocal-rank fusion
+    return [doc for doc, _ in hybrid_retriever_with_scores(query, bm25_retriever, vector_store, query_vector)]
+
+def _retriever(bm25_retriever, vector_store, k):
+    return HybridRetriever(bm25_retriever, vector_store, k=k, bm25_k=k, faiss_k=k,
+                           mmr_lambda=mmr_lambda, mmr_pool=mmr_pool)
+
+def hybrid_retriever_with_scores(query, bm25_retriever, vector_store, query_vector=None, k=5):
+    # Trả về (document, điểm kết hợp) để xếp context theo độ liên quan
+    return _retriever(bm25_retriever, vector_store, k).search_with_scores(query, query_vector=query_vector)
 
-    return final_docs[:5]
+def fused_score_ceiling():
+    # Điểm kết hợp lớn nhất có thể với cấu hình hybrid hiện tại (dùng để quy điểm về [0, 1])
+    return _retriever(None, None, 1).max_score()
 
+def hybrid_retriever_with_ids(query, bm25_retriever, vector_store, query_vector=None, k=5,
+                              candidates=None, rank_vector=None):
+    # Như hybrid_retriever_with_scores nhưng trả thêm id chunk (None khi không có bảng chunk).
+    # `candidates`: chỉ xếp hạng lại các chunk có sẵn theo `rank_vector` (câu hỏi nối tiếp cùng chủ đề)
+    retriever = _retriever(bm25_retriever, vector_store, k)
+    if retriever.table is None:
+        return retriever.search_with_scores(query, query_vector=query_vector), None
+    if candidates is not None:
+        ids, scores = retriever.rank_ids(candidates, rank_vector if rank_vector is not None else query_vector)
+    else:
+        ids, scores = retriever.search_ids([query], query_vectors=query_vector)
+    return retriever.documents(ids, scores), ids